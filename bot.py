@@ -1,13 +1,27 @@
 import os
-import requests
+import json
+import httpx
 import asyncio
-import google.generativeai as genai
-from telegram import Update
-from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler
+import signal
+import socket
+import struct
+import zlib
+from contextlib import asynccontextmanager
+from telegram import Bot, Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler, BaseUpdateProcessor
 import logging
 from io import BytesIO
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
+import functools
+import re
+import time
+import bisect
+import heapq
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,111 +35,2359 @@ NEWS_API_KEY = os.environ.get("NEWS_API_KEY")
 HUGGING_FACE_TOKEN = os.environ.get("HUGGING_FACE_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-# Initialize Gemini
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    logger.info("✅ Gemini AI Initialized")
-else:
+# Upstream endpoints (override to go through a proxy or to run loadtest.py offline)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip('/')
+GROQ_URL = os.environ.get("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+WEATHER_URL = os.environ.get("OPENWEATHER_API_URL", "http://api.openweathermap.org/data/2.5/weather")
+NEWS_URL = os.environ.get("NEWS_API_URL", "https://newsapi.org/v2/top-headlines")
+
+# Webhook mode (used when WEBHOOK_URL is set, otherwise long polling)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "false").lower() == "true"
+
+# Sharded webhook mode: a front process fans updates out to worker processes by chat
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "1"))
+
+# Update processing: chats run in parallel, each chat stays in order. AI handlers
+# get their own slots on top of this (see MAX_CONCURRENT_AI / MAX_QUEUED_AI)
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "32"))
+
+# HTTP client tuning
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "50"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+# HTTP/2 lets concurrent calls to one host share a connection (needs: pip install httpx[http2])
+HTTP2_ENABLED = os.environ.get("HTTP2", "false").lower() == "true"
+
+# Groq micro-batching for non-streaming calls (0 disables it)
+GROQ_BATCH_WINDOW_MS = float(os.environ.get("GROQ_BATCH_WINDOW_MS", "0"))
+GROQ_BATCH_MAX = int(os.environ.get("GROQ_BATCH_MAX", "16"))
+
+# Streaming replies
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+TELEGRAM_MAX_MESSAGE = 4096
+
+# Telegram flood limits (about 1 message/s per chat and 30/s overall)
+TELEGRAM_CHAT_RATE_PER_MIN = float(os.environ.get("TELEGRAM_CHAT_RATE_PER_MIN", "60"))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GLOBAL_RATE_PER_SEC = float(os.environ.get("TELEGRAM_GLOBAL_RATE_PER_SEC", "30"))
+TYPING_INTERVAL = 4.5
+
+# Session store
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(2 * 60 * 60)))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "100000"))
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory").lower()
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "sessions.db")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "1.0"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Conversation context size
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_MESSAGES = int(os.environ.get("CONTEXT_MAX_MESSAGES", "40"))
+# Compress the history of sessions idle for this many seconds (0 disables)
+HISTORY_PACK_AFTER = float(os.environ.get("HISTORY_PACK_AFTER", "600"))
+
+# Background summaries of trimmed history
+SUMMARIZE_HISTORY = os.environ.get("SUMMARIZE_HISTORY", "false").lower() == "true"
+SUMMARY_MAX_CHARS = int(os.environ.get("SUMMARY_MAX_CHARS", "800"))
+
+# Weather/news response caching
+WEATHER_CACHE_TTL = float(os.environ.get("WEATHER_CACHE_TTL", "600"))
+NEWS_CACHE_TTL = float(os.environ.get("NEWS_CACHE_TTL", "300"))
+CACHE_STALE_TTL = float(os.environ.get("CACHE_STALE_TTL", "600"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "1000"))
+
+# Background prefetch of /news and the most asked-for /weather cities, in seconds
+# (0 disables it; NewsAPI's free plan only allows 100 calls a day)
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", os.environ.get("NEWS_PREWARM_INTERVAL", "0")))
+PREFETCH_TOP_CITIES = int(os.environ.get("PREFETCH_TOP_CITIES", "10"))
+
+# Subscribed /weather and /news digests (0 disables /subscribe)
+DIGEST_INTERVAL = float(os.environ.get("DIGEST_INTERVAL", str(6 * 60 * 60)))
+DIGEST_MAX_PER_CHAT = int(os.environ.get("DIGEST_MAX_PER_CHAT", "5"))
+
+NEWS_CATEGORIES = ['general', 'technology', 'sports', 'business', 'entertainment', 'science', 'health']
+
+# Answer cache for context-free /ai and /gemini questions
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX = int(os.environ.get("ANSWER_CACHE_MAX", "2000"))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0"))
+
+# Admission control (rates are per minute, 0 disables the limit)
+USER_RATE_PER_MIN = float(os.environ.get("USER_RATE_PER_MIN", "20"))
+USER_BURST = int(os.environ.get("USER_BURST", "5"))
+GEMINI_RATE_PER_MIN = float(os.environ.get("GEMINI_RATE_PER_MIN", "0"))
+GROQ_RATE_PER_MIN = float(os.environ.get("GROQ_RATE_PER_MIN", "30"))
+MAX_CONCURRENT_AI = int(os.environ.get("MAX_CONCURRENT_AI", "50"))
+MAX_QUEUED_AI = int(os.environ.get("MAX_QUEUED_AI", "200"))
+
+# Provider routing: sequential | hedged | race
+ROUTING_POLICY = os.environ.get("ROUTING_POLICY", "sequential").lower()
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "2.0"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "8.0"))
+
+# Gemini concurrency limits
+GEMINI_MAX_IN_FLIGHT = int(os.environ.get("GEMINI_MAX_IN_FLIGHT", "8"))
+GEMINI_MAX_QUEUED = int(os.environ.get("GEMINI_MAX_QUEUED", "32"))
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "30"))
+# Longest wait for the next piece of a streamed Gemini reply
+GEMINI_CHUNK_TIMEOUT = float(os.environ.get("GEMINI_CHUNK_TIMEOUT", "20"))
+GEMINI_DEMOTE_TTL = float(os.environ.get("GEMINI_DEMOTE_TTL", "300"))
+
+# Circuit breakers per upstream (each Gemini model, Groq, OpenWeatherMap, NewsAPI)
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+BREAKER_WINDOW_SECONDS = float(os.environ.get("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL = float(os.environ.get("BREAKER_SLOW_CALL", "15"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+BREAKER_MAX_COOLDOWN = float(os.environ.get("BREAKER_MAX_COOLDOWN", "300"))
+
+# Gemini model discovery: background (after the bot starts serving) | blocking | off
+GEMINI_DISCOVERY = os.environ.get("GEMINI_DISCOVERY", "background").lower()
+
+# Metrics endpoint (loopback only by default, METRICS_PORT=0 disables it;
+# shard workers listen on METRICS_PORT + shard index)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+ADMIN_USER_IDS = {int(uid) for uid in os.environ.get("ADMIN_USER_IDS", "").replace(",", " ").split()}
+
+# ✅ NEW 2024 GEMINI MODELS (in order of preference):
+GEMINI_MODELS = [
+    'gemini-1.5-flash-latest',    # Latest flash model
+    'gemini-1.5-pro-latest',      # Latest pro model  
+    'gemini-1.0-pro-latest',      # Legacy latest
+    'models/gemini-pro',          # Full path
+]
+
+# The Gemini SDK takes most of a second to import, so it is loaded on first
+# use (see get_genai()) and only when a key is configured
+if not GEMINI_API_KEY:
     logger.warning("❌ Gemini API Key not found")
 
-# Memory Storage
-user_sessions = {}
+# Fun responses
+FUN_RESPONSES = {
+    "greetings": ["🎉 Hello there!", "👋 Hey! Great to see you!", "😊 Namaste! Kaise ho?", "🚀 Welcome back!"],
+    "thinking": ["🤔 Let me think...", "💭 Processing...", "🧠 Analyzing...", "⚡ Crunching data..."],
+    "errors": ["😅 Oops! Something went wrong", "🔄 Let's try that again", "📡 Connection issue", "🤖 Bot moment!"]
+}
+
+# ========== ASYNC HTTP CLIENT ==========
+# One shared client for every outbound call. httpx keeps a keep-alive pool
+# per origin, and the per-host semaphore stops one slow upstream from
+# hogging every connection in the pool.
+_http_client = None
+_host_semaphores = {}
+
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        settings = dict(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(30, connect=HTTP_CONNECT_TIMEOUT)
+        )
+        try:
+            _http_client = httpx.AsyncClient(http2=HTTP2_ENABLED, **settings)
+        except ImportError:
+            logger.warning("⚠️ HTTP2=true needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+            _http_client = httpx.AsyncClient(**settings)
+        logger.info("🌐 HTTP client pool created")
+    return _http_client
+
+def _host_semaphore(url):
+    host = httpx.URL(url).host
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return semaphore
+
+async def http_request(method, url, timeout=30, **kwargs):
+    async with _host_semaphore(url):
+        return await get_http_client().request(
+            method, url, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT), **kwargs
+        )
+
+async def http_get(url, timeout=10, **kwargs):
+    return await http_request("GET", url, timeout=timeout, **kwargs)
+
+async def http_post(url, timeout=30, **kwargs):
+    return await http_request("POST", url, timeout=timeout, **kwargs)
+
+@asynccontextmanager
+async def http_stream(method, url, timeout=30, **kwargs):
+    async with _host_semaphore(url):
+        async with get_http_client().stream(
+            method, url, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT), **kwargs
+        ) as response:
+            yield response
+
+async def close_http_client(application=None):
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("🌐 HTTP client pool closed")
+    _http_client = None
+
+# ========== CIRCUIT BREAKERS ==========
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+class CircuitBreaker:
+    """Tracks one upstream's health from its recent calls.
+
+    - closed: calls go through; once at least `min_calls` of the last
+      `window` calls (within `window_seconds`) are in, the circuit opens if
+      `error_rate` of them failed or took longer than `slow_call` seconds
+    - open: calls fail fast for `cooldown` seconds
+    - half_open: one trial call is let through; success closes the circuit,
+      failure reopens it with the cooldown doubled (up to `max_cooldown`)
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, window=20, window_seconds=60, min_calls=5, error_rate=0.5,
+                 slow_call=10.0, cooldown=30.0, max_cooldown=300.0, clock=time.monotonic):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self.cooldown = cooldown
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._retry_at = 0.0
+
+    def available(self):
+        """True if a call could go through now; does not claim the half-open trial."""
+        return self.state == self.CLOSED or self.clock() >= self._retry_at
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        now = self.clock()
+        if now < self._retry_at:
+            self.rejected += 1
+            return False
+        if self.state == self.OPEN:
+            logger.info(f"🔌 {self.name} circuit half-open, sending a trial call")
+            self.state = self.HALF_OPEN
+        # One trial at a time; if it never reports back, another is allowed after the cooldown
+        self._retry_at = now + self.cooldown
+        return True
+
+    def record(self, ok, seconds=0.0):
+        failed = not ok or seconds > self.slow_call
+        if self.state == self.HALF_OPEN:
+            if failed:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+            else:
+                logger.info(f"🔌 {self.name} circuit closed")
+                self.state = self.CLOSED
+                self.cooldown = self.base_cooldown
+                self._outcomes.clear()
+            return
+        if self.state == self.OPEN:
+            # A call that started before the circuit opened
+            return
+        
+        now = self.clock()
+        self._outcomes.append((now, failed))
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+        if len(self._outcomes) >= self.min_calls:
+            failures = sum(1 for _, was_failure in self._outcomes if was_failure)
+            if failures >= self.error_rate * len(self._outcomes):
+                self._open()
+
+    def _open(self):
+        logger.warning(f"🔌 {self.name} circuit open for {self.cooldown:.0f}s")
+        self.state = self.OPEN
+        self.opened += 1
+        self._retry_at = self.clock() + self.cooldown
+        self._outcomes.clear()
+
+class CircuitBreakers:
+    """One CircuitBreaker per upstream, keyed by (provider, model)."""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+
+    def get(self, provider, model):
+        breaker = self._breakers.get((provider, model))
+        if breaker is None:
+            breaker = self._breakers[(provider, model)] = CircuitBreaker(f"{provider}/{model}", **self.settings)
+        return breaker
+
+    def items(self):
+        return list(self._breakers.items())
+
+breakers = CircuitBreakers(
+    window=BREAKER_WINDOW, window_seconds=BREAKER_WINDOW_SECONDS, min_calls=BREAKER_MIN_CALLS,
+    error_rate=BREAKER_ERROR_RATE, slow_call=BREAKER_SLOW_CALL,
+    cooldown=BREAKER_COOLDOWN, max_cooldown=BREAKER_MAX_COOLDOWN
+)
+
+# ========== GEMINI CALL GATE ==========
+class GeminiBusyError(Exception):
+    """Raised when too many Gemini calls are already running or waiting."""
+
+class GeminiGate:
+    """Caps concurrent Gemini calls and rejects new ones once the wait queue is full."""
+
+    def __init__(self, max_in_flight, max_queued):
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'queued': self.queued, 'rejected': self.rejected}
+
+    async def __aenter__(self):
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise GeminiBusyError(f"{self.in_flight} running, {self.queued} waiting")
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+        return False
+
+gemini_gate = GeminiGate(GEMINI_MAX_IN_FLIGHT, GEMINI_MAX_QUEUED)
+
+# ========== GEMINI MODEL CACHE ==========
+_genai = None
+
+def get_genai():
+    """Imports and configures the Gemini SDK the first time it is needed."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        _genai = genai
+        logger.info("✅ Gemini AI Initialized")
+    return _genai
+
+def _model_key(model_name):
+    return model_name[len('models/'):] if model_name.startswith('models/') else model_name
+
+class GeminiModelPool:
+    """Remembers the working Gemini model and reuses GenerativeModel instances.
+
+    Models that fail are demoted for `demote_ttl` seconds. Once that expires
+    they are re-probed in the background with a cheap count_tokens call, so
+    the reply path only ever tries the best known-good model first.
+    """
+
+    def __init__(self, candidates, demote_ttl):
+        self.candidates = list(candidates)
+        self.demote_ttl = demote_ttl
+        self.active = None
+        self._models = {}
+        self._demoted = {}
+        self._probing = set()
+
+    def set_available(self, model_names):
+        available = {_model_key(name): name for name in model_names}
+        preferred = [name for name in self.candidates if _model_key(name) in available]
+        # Fall back to whatever the API offers if none of our defaults exist
+        self.candidates = preferred or list(available.values())
+        self.active = self.candidates[0] if self.candidates else None
+        logger.info(f"🧭 Gemini model order: {self.candidates}")
+
+    def model(self, model_name):
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._models[model_name] = get_genai().GenerativeModel(model_name)
+        return model
+
+    def ordered(self):
+        now = time.monotonic()
+        healthy, demoted = [], []
+        for name in self.candidates:
+            retry_at = self._demoted.get(name)
+            if retry_at is None:
+                healthy.append(name)
+            else:
+                demoted.append(name)
+                if retry_at <= now:
+                    self._schedule_probe(name)
+        if self.active in healthy:
+            healthy.remove(self.active)
+            healthy.insert(0, self.active)
+        # Demoted models are a last resort when nothing else is left
+        return healthy + demoted
+
+    def mark_ok(self, model_name):
+        self._demoted.pop(model_name, None)
+        if self.active != model_name:
+            logger.info(f"🧭 Gemini active model: {model_name}")
+        self.active = model_name
+
+    def mark_failed(self, model_name):
+        self._demoted[model_name] = time.monotonic() + self.demote_ttl
+        if self.active == model_name:
+            self.active = None
+
+    def _schedule_probe(self, model_name):
+        if model_name in self._probing:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self._probe(model_name))
+        except RuntimeError:
+            return
+        self._probing.add(model_name)
+
+    async def _probe(self, model_name):
+        try:
+            # GenerativeModel.count_tokens_async() is broken in google-generativeai 0.3.0
+            # (it uses the sync client), so ask the async client directly
+            from google.generativeai import client
+            request = {"model": self.model(model_name).model_name, "contents": [{"role": "user", "parts": [{"text": "ping"}]}]}
+            await asyncio.wait_for(client.get_default_generative_async_client().count_tokens(request), GEMINI_TIMEOUT)
+        except Exception as e:
+            logger.info(f"🔁 Re-probe of {model_name} failed: {e}")
+            self._demoted[model_name] = time.monotonic() + self.demote_ttl
+        else:
+            logger.info(f"🔁 Re-probe of {model_name} succeeded")
+            self._demoted.pop(model_name, None)
+            # Discovery may have replaced the candidates while the probe ran
+            if model_name not in self.candidates:
+                return
+            # Promote it back if it ranks above the current working model
+            if self.active not in self.candidates or self.candidates.index(model_name) < self.candidates.index(self.active):
+                self.active = model_name
+        finally:
+            self._probing.discard(model_name)
+
+gemini_models = GeminiModelPool(GEMINI_MODELS, GEMINI_DEMOTE_TTL)
+
+# ========== GEMINI AI FUNCTION ==========
+async def get_gemini_response(contents):
+    """`contents` is a Gemini multi-turn list, see build_gemini_contents()."""
+    if not GEMINI_API_KEY:
+        logger.error("❌ Gemini API Key missing")
+        return None
+    if not gemini_healthy():
+        logger.warning("🔌 Every Gemini model circuit is open")
+        return None
+    
+    # Raises GeminiBusyError so callers can shed load instead of waiting
+    async with gemini_gate:
+        return await _generate_gemini(contents)
+
+def gemini_healthy():
+    return any(breakers.get("gemini", name).available() for name in gemini_models.candidates)
+
+def _gemini_model_fault(error):
+    """Whether an error says something about the model rather than this one request.
+
+    Only a safety-blocked or empty answer (the SDK raises ValueError from
+    .text) and a 400 about the prompt itself are per-request: another model
+    would get the same prompt. Everything else counts against the model,
+    including 4xx like NotFound (model retired) or PermissionDenied (key
+    can't use it), so the next candidate is tried and this one demoted.
+    """
+    if isinstance(error, ValueError):
+        return False
+    from google.api_core import exceptions as api_errors
+    if isinstance(error, api_errors.BadRequest):
+        # "models/x is not found / not supported for generateContent" is about the model
+        return "model" in str(error).lower()
+    return True
+
+async def _generate_gemini(contents):
+    try:
+        for model_name in gemini_models.ordered():
+            if not breakers.get("gemini", model_name).allow():
+                continue
+            started = time.monotonic()
+            try:
+                model = gemini_models.model(model_name)
+                response = await asyncio.wait_for(model.generate_content_async(contents), GEMINI_TIMEOUT)
+                text = response.text
+            except Exception as model_error:
+                if not _gemini_model_fault(model_error):
+                    observe_call("gemini", model_name, started)
+                    logger.info(f"🚫 Gemini gave no answer for this prompt: {model_error}")
+                    return None
+                observe_call("gemini", model_name, started, ok=False)
+                logger.warning(f"❌ Model {model_name} failed: {model_error}")
+                gemini_models.mark_failed(model_name)
+                continue
+            
+            observe_call("gemini", model_name, started)
+            gemini_models.mark_ok(model_name)
+            return text or None
+        
+        logger.error("❌ All Gemini models failed")
+        return None
+            
+    except Exception as e:
+        logger.error(f"💥 Gemini API Error: {str(e)}")
+        return None
+
+async def _within(stream, timeout):
+    """Re-yields an async stream, raising asyncio.TimeoutError if any item takes longer than `timeout`."""
+    items = stream.__aiter__()
+    while True:
+        try:
+            item = await asyncio.wait_for(items.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+        yield item
+
+async def stream_gemini_response(contents):
+    """Yield Gemini reply text as it is generated.
+
+    Falls through to the next model only if a model fails before producing
+    any text; a failure mid-stream is raised to the caller.
+    """
+    if not GEMINI_API_KEY:
+        return
+    if not gemini_healthy():
+        raise CircuitOpenError("every Gemini model circuit is open")
+    
+    async with gemini_gate:
+        for model_name in gemini_models.ordered():
+            if not breakers.get("gemini", model_name).allow():
+                continue
+            started = False
+            call_started = time.monotonic()
+            try:
+                model = gemini_models.model(model_name)
+                response = await asyncio.wait_for(
+                    model.generate_content_async(contents, stream=True), GEMINI_TIMEOUT
+                )
+                # A stalled stream would otherwise hold its gate slot for as long as the SDK allows
+                async for chunk in _within(response, GEMINI_CHUNK_TIMEOUT):
+                    if chunk.text:
+                        if not started:
+                            started = True
+                            first_text = time.monotonic() - call_started
+                        yield chunk.text
+                observe_call("gemini", model_name, call_started, latency=first_text if started else None)
+                gemini_models.mark_ok(model_name)
+                return
+            except Exception as model_error:
+                fault = _gemini_model_fault(model_error)
+                observe_call("gemini", model_name, call_started, ok=not fault,
+                             latency=first_text if started else None)
+                if started:
+                    raise
+                if not fault:
+                    logger.info(f"🚫 Gemini gave no answer for this prompt: {model_error}")
+                    return
+                logger.warning(f"❌ Model {model_name} failed: {model_error}")
+                gemini_models.mark_failed(model_name)
+        
+        logger.error("❌ All Gemini models failed")
+
+# ========== GROQ AI FUNCTION ==========
+GROQ_MODEL = "llama-3.1-8b-instant"
+groq_in_flight = 0
+
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+@functools.lru_cache(maxsize=16)
+def _groq_skeleton(temperature, max_tokens, stream):
+    # Everything but the messages, serialized once per distinct setting
+    head = json.dumps({"model": GROQ_MODEL, "temperature": temperature, "max_tokens": max_tokens, "stream": stream},
+                      separators=(",", ":"))
+    return head[:-1].encode() + b',"messages":'
+
+def groq_request_body(messages, temperature=0.8, max_tokens=500, stream=False):
+    return _groq_skeleton(temperature, max_tokens, stream) + json.dumps(messages, separators=(",", ":")).encode() + b"}"
+
+class GroqBatcher:
+    """Micro-batches non-streaming Groq completions.
+
+    Requests are collected for up to `window` seconds or until `max_batch`
+    are waiting, then sent together as concurrent requests on the shared
+    client (multiplexed on one connection when HTTP/2 is on). Identical
+    request bodies in a batch share a single upstream call. Each caller
+    gets its own response back.
+    """
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self.coalesced = 0
+        self._pending = []
+        self._timer = None
+        self._dispatching = set()
+
+    def stats(self):
+        return {'batches': self.batches, 'requests': self.requests, 'coalesced': self.coalesced}
+
+    async def post(self, body):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((body, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch):
+        waiters = {}
+        for body, future in batch:
+            # Callers that gave up while waiting for the batch are skipped
+            if not future.done():
+                waiters.setdefault(body, []).append(future)
+        self.batches += 1
+        self.requests += len(batch)
+        self.coalesced += sum(len(futures) - 1 for futures in waiters.values())
+        
+        results = await asyncio.gather(
+            *(http_post(GROQ_URL, headers=GROQ_HEADERS, content=body, timeout=30) for body in waiters),
+            return_exceptions=True
+        )
+        for futures, result in zip(waiters.values(), results):
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+groq_batcher = GroqBatcher(GROQ_BATCH_WINDOW_MS / 1000, GROQ_BATCH_MAX) if GROQ_BATCH_WINDOW_MS > 0 else None
+
+async def get_groq_response(messages, temperature=0.8, max_tokens=500):
+    if not breakers.get("groq", GROQ_MODEL).allow():
+        logger.warning("🔌 Groq circuit is open")
+        return None
+    
+    global groq_in_flight
+    groq_in_flight += 1
+    started = time.monotonic()
+    try:
+        body = groq_request_body(messages, temperature, max_tokens)
+        if groq_batcher is not None:
+            response = await groq_batcher.post(body)
+        else:
+            response = await http_post(GROQ_URL, headers=GROQ_HEADERS, content=body, timeout=30)
+    except Exception:
+        observe_call("groq", GROQ_MODEL, started, ok=False)
+        raise
+    finally:
+        groq_in_flight -= 1
+    
+    observe_call("groq", GROQ_MODEL, started, ok=response.status_code == 200)
+    if response.status_code == 200:
+        return response.json()['choices'][0]['message']['content']
+    logger.warning(f"❌ Groq returned HTTP {response.status_code}")
+    return None
+
+async def stream_groq_response(messages, temperature=0.8, max_tokens=500):
+    """Yield Groq reply text from its server-sent event stream."""
+    if not breakers.get("groq", GROQ_MODEL).allow():
+        raise CircuitOpenError("Groq circuit is open")
+    
+    global groq_in_flight
+    groq_in_flight += 1
+    started = time.monotonic()
+    first_text = None
+    try:
+        body = groq_request_body(messages, temperature, max_tokens, stream=True)
+        async with http_stream("POST", GROQ_URL, headers=GROQ_HEADERS, content=body, timeout=30) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Groq returned HTTP {response.status_code}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                delta = json.loads(payload)['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    if first_text is None:
+                        first_text = time.monotonic() - started
+                    yield delta
+    except Exception:
+        # A cancelled hedge loser is not an error, so only real failures count
+        observe_call("groq", GROQ_MODEL, started, ok=False, latency=first_text)
+        raise
+    else:
+        observe_call("groq", GROQ_MODEL, started, latency=first_text)
+    finally:
+        groq_in_flight -= 1
+
+# ========== PROVIDER ROUTING ==========
+class LatencyHistogram:
+    """Bucketed latency histogram plus a window of recent samples for quantiles."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, float('inf'))
+
+    def __init__(self, window=256):
+        self.counts = [0] * len(self.BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+class ProviderRateLimited(RuntimeError):
+    """Raised instead of calling a provider whose request budget is used up."""
+
+async def _prepend(first, stream):
+    yield first
+    async for chunk in stream:
+        yield chunk
+
+async def _single_reply(awaitable):
+    # Lets non-streaming provider calls take part in routing
+    text = await awaitable
+    if text:
+        yield text
+
+class ProviderRouter:
+    """Picks which AI provider answers a message.
+
+    Providers are given as (name, factory) pairs where factory() returns an
+    async iterator of reply text. A provider "answers" when it yields its
+    first chunk; the winner's stream is handed back to the caller and every
+    other attempt is cancelled.
+
+    - sequential: try providers one after another (the original behaviour)
+    - hedged: start the next provider if the current ones have not answered
+      within the primary provider's recent p50 latency
+    - race: start all providers at once
+    """
+
+    POLICIES = ('sequential', 'hedged', 'race')
+    # Refusals that happen before any upstream call, so they say nothing about its latency
+    REJECTIONS = (CircuitOpenError, GeminiBusyError, ProviderRateLimited)
+
+    def __init__(self, policy, default_delay, min_delay, max_delay):
+        if policy not in self.POLICIES:
+            logger.warning(f"⚠️ Unknown routing policy '{policy}', using sequential")
+            policy = 'sequential'
+        self.policy = policy
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latency = {}
+        self.errors = {}
+        self.rejected = {}
+
+    def histogram(self, name):
+        hist = self.latency.get(name)
+        if hist is None:
+            hist = self.latency[name] = LatencyHistogram()
+        return hist
+
+    def hedge_delay(self, name):
+        hist = self.latency.get(name)
+        if hist is None or len(hist.recent) < 5:
+            return self.default_delay
+        return min(max(hist.quantile(0.5), self.min_delay), self.max_delay)
+
+    async def first_response(self, providers):
+        """Returns (provider name, reply stream), or (None, None) if every provider failed.
+
+        Every attempt that reached the upstream has its elapsed time
+        recorded, not just the winner's: a failure after N seconds or a loser
+        cancelled at N seconds still says the provider took at least that
+        long, and leaving those out would pull hedge_delay below what the
+        provider really delivers. Instant refusals (REJECTIONS) and empty
+        answers are only counted, as they would pull it towards zero.
+        """
+        pending = {}
+        next_index = 0
+        
+        def launch():
+            nonlocal next_index
+            name, factory = providers[next_index]
+            next_index += 1
+            stream = factory()
+            task = asyncio.ensure_future(stream.__anext__())
+            pending[task] = (name, stream, time.monotonic())
+        
+        try:
+            if providers:
+                launch()
+            if self.policy == 'race':
+                while next_index < len(providers):
+                    launch()
+            
+            while pending:
+                timeout = None
+                if self.policy == 'hedged' and next_index < len(providers):
+                    timeout = self.hedge_delay(providers[0][0])
+                
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"🏁 Hedging with {providers[next_index][0]} after {timeout:.2f}s")
+                    launch()
+                    continue
+                
+                for task in done:
+                    name, stream, started = pending.pop(task)
+                    elapsed = time.monotonic() - started
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        logger.warning(f"❌ {name} returned no answer")
+                    except self.REJECTIONS as e:
+                        logger.info(f"🚦 {name} skipped: {e}")
+                        self.rejected[name] = self.rejected.get(name, 0) + 1
+                        continue
+                    except Exception as e:
+                        logger.warning(f"❌ {name} failed: {e}")
+                        self.histogram(name).observe(elapsed)
+                    else:
+                        self.histogram(name).observe(elapsed)
+                        return name, _prepend(first, stream)
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                
+                if not pending and next_index < len(providers):
+                    launch()
+            return None, None
+        finally:
+            for task, (name, stream, started) in pending.items():
+                self.histogram(name).observe(time.monotonic() - started)
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+AI_SOURCES = {
+    'gemini': "Google Gemini 🧠",
+    'groq': "Groq AI ⚡"
+}
+
+chat_router = ProviderRouter(ROUTING_POLICY, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY)
+
+# ========== METRICS ==========
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Metrics:
+    """Counters and latency histograms rendered in the Prometheus text format.
+
+    Recording is a dict lookup and a few integer updates, cheap enough to
+    leave on in production. Numbers other components already keep (cache
+    stats, queue depths, session counts) are not copied here; collectors
+    read them only when /metrics is scraped.
+    """
+
+    def __init__(self, prefix="meraai"):
+        self.prefix = prefix
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + amount
+
+    def histogram(self, name, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = LatencyHistogram()
+        return hist
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def collect(self, name, kind, help_text, fn):
+        """Registers a metric read at scrape time.
+
+        fn() returns a number, or a list of (labels dict, value) pairs where
+        value is a number or, for kind='histogram', a LatencyHistogram.
+        """
+        self._help[name] = help_text
+        self._collectors[name] = (kind, fn)
+
+    def counter_value(self, name, **labels):
+        return self._counters.get(name, {}).get(tuple(labels.items()), 0)
+
+    def series(self, name):
+        """{labels dict as tuple: LatencyHistogram} for a recorded histogram."""
+        return dict(self._histograms.get(name, {}))
+
+    def render(self):
+        lines = []
+        
+        def header(name, kind):
+            full = f"{self.prefix}_{name}"
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            return full
+        
+        def histogram_lines(full, labels, hist):
+            cumulative = 0
+            for bound, count in zip(hist.BUCKETS, hist.counts):
+                cumulative += count
+                lines.append(f"{full}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{full}_sum{_format_labels(labels)} {hist.sum:.6f}")
+            lines.append(f"{full}_count{_format_labels(labels)} {hist.total}")
+        
+        for name, series in self._counters.items():
+            full = header(name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{full}{_format_labels(labels)} {_format_value(value)}")
+        
+        for name, series in self._histograms.items():
+            full = header(name, "histogram")
+            for labels, hist in series.items():
+                histogram_lines(full, labels, hist)
+        
+        for name, (kind, fn) in self._collectors.items():
+            try:
+                samples = fn()
+            except Exception as e:
+                logger.warning(f"📈 Metric {name} failed: {e}")
+                continue
+            if not isinstance(samples, list):
+                samples = [({}, samples)]
+            full = header(name, kind)
+            for labels, value in samples:
+                labels = tuple(labels.items())
+                if kind == "histogram":
+                    histogram_lines(full, labels, value)
+                else:
+                    lines.append(f"{full}{_format_labels(labels)} {_format_value(value)}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("handler_seconds", "Time spent in each Telegram handler")
+metrics.describe("handler_errors_total", "Handler calls that raised")
+metrics.describe("time_to_first_reply_seconds", "From receiving a message to the first answer text sent back")
+metrics.describe("provider_call_seconds", "Upstream call latency per provider and model")
+metrics.describe("provider_errors_total", "Failed upstream calls per provider and model")
+metrics.describe("history_unpacked_total", "Compressed session histories unpacked on use")
+
+def timed_handler(name):
+    """Records how long a handler takes under meraai_handler_seconds{handler=name}."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.monotonic()
+            try:
+                return await handler(update, context)
+            except Exception:
+                metrics.inc("handler_errors_total", handler=name)
+                raise
+            finally:
+                metrics.observe("handler_seconds", time.monotonic() - started, handler=name)
+        return wrapper
+    return decorate
+
+def observe_call(provider, model, started, ok=True, latency=None):
+    """Records one upstream call for metrics and for its circuit breaker.
+
+    Streams pass their time to first text as `latency`, so a long answer
+    is not mistaken for a slow upstream.
+    """
+    elapsed = time.monotonic() - started
+    metrics.observe("provider_call_seconds", elapsed, provider=provider, model=model)
+    if not ok:
+        metrics.inc("provider_errors_total", provider=provider, model=model)
+    breakers.get(provider, model).record(ok, elapsed if latency is None else latency)
+
+# ========== CONVERSATION CONTEXT ==========
+def estimate_tokens(text):
+    # ~4 characters per token plus per-message overhead; close enough for budgeting
+    return len(text) // 4 + 4
+
+class ConversationContext:
+    """A session's recent turns, trimmed to an approximate token budget.
+
+    Turns sit in a fixed-capacity ring: one list of contents plus a
+    bytearray of role codes interned in ROLES, rather than a tuple per turn.
+    A running token total is kept, and evicting a turn re-estimates just
+    that turn, so trimming never re-measures the history. pack() squeezes
+    an idle session's turns into one zlib blob; any later use unpacks them.
+    The rendered "You:/AI:" transcript and the per-turn chat messages are
+    cached until the next change.
+    """
+
+    __slots__ = ('capacity', 'tokens', 'summary', '_contents', '_roles', '_start', '_count', '_packed',
+                 '_text', '_messages')
+
+    ROLE_LABELS = {'user': "You", 'assistant': "AI"}
+    # Shared by every session; each turn stores its role as one byte indexing this
+    ROLES = ['user', 'assistant']
+    _ROLE_CODES = {'user': 0, 'assistant': 1}
+    # Below this much text a zlib blob isn't worth the unpacking
+    PACK_MIN_CHARS = 256
+    PACK_SEPARATOR = "\x00"
+
+    def __init__(self, capacity=CONTEXT_MAX_MESSAGES):
+        self.capacity = max(capacity, 1)
+        self.tokens = 0
+        self.summary = ""
+        # Grown up to `capacity` slots, then reused in place
+        self._contents = []
+        self._roles = bytearray()
+        self._start = 0
+        self._count = 0
+        self._packed = None
+        self._text = None
+        self._messages = None
+
+    def __len__(self):
+        return self._count
+
+    @classmethod
+    def _role_code(cls, role):
+        code = cls._ROLE_CODES.get(role)
+        if code is None:
+            code = cls._ROLE_CODES[role] = len(cls.ROLES)
+            cls.ROLES.append(role)
+        return code
+
+    def _ordered(self):
+        """Copies of the role codes and contents, oldest first."""
+        if self._packed is not None:
+            self._unpack()
+        start, end = self._start, self._start + self._count
+        if end <= self.capacity:
+            return self._roles[start:end], self._contents[start:end]
+        end -= self.capacity
+        return self._roles[start:] + self._roles[:end], self._contents[start:] + self._contents[:end]
+
+    def turns(self):
+        """(role, content) pairs, oldest first."""
+        roles, contents = self._ordered()
+        return list(zip(map(self.ROLES.__getitem__, roles), contents))
+
+    def append(self, role, content, budget=CONTEXT_TOKEN_BUDGET):
+        """Adds a turn and returns the (role, content) turns trimmed to make room."""
+        if self._packed is not None:
+            self._unpack()
+        evicted = []
+        if self._count == self.capacity:
+            evicted.append(self._popleft())
+        
+        slot = (self._start + self._count) % self.capacity
+        code = self._role_code(role)
+        if slot == len(self._contents):
+            self._contents.append(content)
+            self._roles.append(code)
+        else:
+            self._contents[slot] = content
+            self._roles[slot] = code
+        self._count += 1
+        self.tokens += estimate_tokens(content)
+        self._text = None
+        self._messages = None
+        
+        # Always keep the newest turn, even if it alone is over budget
+        while self._count > 1 and self.tokens > budget:
+            evicted.append(self._popleft())
+        return evicted
+
+    def _popleft(self):
+        slot = self._start
+        content = self._contents[slot]
+        self._contents[slot] = None
+        self._start = (slot + 1) % self.capacity
+        self._count -= 1
+        self.tokens -= estimate_tokens(content)
+        return self.ROLES[self._roles[slot]], content
+
+    def pack(self):
+        """Compresses the turns in place; returns False if there was too little to bother."""
+        if self._packed is not None or not self._count:
+            return False
+        roles, contents = self._ordered()
+        if sum(map(len, contents)) < self.PACK_MIN_CHARS or any(self.PACK_SEPARATOR in c for c in contents):
+            return False
+        # Level 1 is a little bigger than the default but more than twice as fast
+        self._packed = zlib.compress(self.PACK_SEPARATOR.join(contents).encode(), 1)
+        # Roles stay unpacked, in order, so unpacking only has to restore the contents
+        self._roles = roles
+        self._contents = None
+        self._start = 0
+        self._text = None
+        self._messages = None
+        return True
+
+    def _unpack(self):
+        self._contents = zlib.decompress(self._packed).decode().split(self.PACK_SEPARATOR)
+        self._packed = None
+        metrics.inc("history_unpacked_total")
+
+    @property
+    def packed(self):
+        return self._packed is not None
+
+    def set_summary(self, summary):
+        self.summary = summary
+        self._text = None
+
+    def _with_summary(self, prompt):
+        if not self.summary:
+            return prompt
+        return f"{prompt}\n\nEarlier in this conversation: {self.summary}"
+
+    def text(self):
+        if self._text is None:
+            prefix = f"Summary: {self.summary}\n" if self.summary else ""
+            self._text = prefix + "".join(
+                f"{self.ROLE_LABELS.get(role, 'AI')}: {content}\n" for role, content in self.turns()
+            )
+        return self._text
+
+    def groq_messages(self, system_prompt, pending=None):
+        if self._messages is None:
+            # Shared between calls; request builders only read them
+            names = self.ROLES
+            self._messages = tuple(
+                {"role": names[code], "content": content} for code, content in zip(*self._ordered())
+            )
+        messages = [{"role": "system", "content": self._with_summary(system_prompt)}]
+        messages.extend(self._messages)
+        if pending:
+            messages.append({"role": "user", "content": pending})
+        return messages
+
+    def gemini_contents(self, persona, pending=None):
+        # Gemini wants alternating user/model turns that start with the user
+        contents = []
+        roles, texts = self._ordered()
+        if pending:
+            roles.append(self._ROLE_CODES['user'])
+            texts.append(pending)
+        names = self.ROLES
+        for code, content in zip(roles, texts):
+            gemini_role = "user" if names[code] == "user" else "model"
+            if not contents and gemini_role == "model":
+                continue
+            if contents and contents[-1]["role"] == gemini_role:
+                contents[-1]["parts"].append(content)
+            else:
+                contents.append({"role": gemini_role, "parts": [content]})
+        if contents:
+            contents[0]["parts"].insert(0, self._with_summary(persona))
+        return contents
+
+    def to_list(self):
+        return [{"role": role, "content": content} for role, content in self.turns()]
+
+    @classmethod
+    def from_list(cls, items):
+        context = cls()
+        for item in items:
+            context.append(item["role"], item["content"])
+        return context
+
+# ========== MEMORY MANAGEMENT ==========
+class Session:
+    __slots__ = ('history', 'last_activity', 'user_name', 'message_count', 'preferred_ai')
+
+    def __init__(self, user_name, preferred_ai, last_activity):
+        self.history = ConversationContext()
+        self.last_activity = last_activity
+        self.user_name = user_name
+        self.message_count = 0
+        self.preferred_ai = preferred_ai
+
+    def to_dict(self):
+        return {
+            'history': self.history.to_list(),
+            'summary': self.history.summary,
+            'last_activity': self.last_activity,
+            'user_name': self.user_name,
+            'message_count': self.message_count,
+            'preferred_ai': self.preferred_ai
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data['user_name'], data['preferred_ai'], data['last_activity'])
+        session.history = ConversationContext.from_list(data['history'])
+        session.history.summary = data.get('summary', "")
+        session.message_count = data['message_count']
+        return session
+
+class SessionStore:
+    """Sessions kept in least-recently-used order with a TTL and a hard size cap.
+
+    Every session shares the same TTL, so LRU order is also expiry order:
+    expired sessions are always at the front and cleanup only looks at
+    those, instead of scanning every session on every message.
+    """
+
+    def __init__(self, ttl, max_sessions, clock=time.time):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.expired = 0
+        self.evicted = 0
+        self.packed = 0
+        self._sessions = OrderedDict()
+        # Sessions used since pack_idle last looked at them, in the same LRU order
+        self._unchecked = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None and self.clock() - session.last_activity > self.ttl:
+            del self._sessions[user_id]
+            self._unchecked.pop(user_id, None)
+            self.expired += 1
+            return None
+        return session
+
+    def touch(self, user_id, user_name, preferred_ai, restored=None):
+        """Returns (session, created) and marks the session as just used.
+
+        `restored` is a session loaded from the persistent backend to adopt
+        when the user has no session in memory.
+        """
+        now = self.clock()
+        self._expire(now)
+        
+        session = self._sessions.get(user_id)
+        created = session is None
+        if created:
+            session = restored or Session(user_name, preferred_ai, now)
+            session.last_activity = now
+            self._sessions[user_id] = session
+            if len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                self._unchecked.pop(evicted_id, None)
+                self.evicted += 1
+        else:
+            self._sessions.move_to_end(user_id)
+            session.last_activity = now
+        self._unchecked[user_id] = session
+        self._unchecked.move_to_end(user_id)
+        return session, created
+
+    def pop(self, user_id):
+        self._unchecked.pop(user_id, None)
+        return self._sessions.pop(user_id, None)
+
+    def pack_idle(self, idle, limit=None):
+        """Compresses the history of sessions unused for `idle` seconds; returns how many sessions it checked.
+
+        Only sessions touched since they were last checked are looked at,
+        and at most `limit` of them, so a pass never rescans sessions that
+        are already packed or too short to pack. History only grows or gets
+        unpacked after a touch(), which puts the session back in line.
+        """
+        cutoff = self.clock() - idle
+        checked = 0
+        # LRU order: the idle sessions are all at the front
+        while self._unchecked and checked != limit:
+            user_id, session = next(iter(self._unchecked.items()))
+            if session.last_activity >= cutoff:
+                break
+            del self._unchecked[user_id]
+            checked += 1
+            if session.history.pack():
+                self.packed += 1
+        return checked
+
+    def _expire(self, now):
+        cutoff = now - self.ttl
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if oldest.last_activity >= cutoff:
+                break
+            expired_id, _ = self._sessions.popitem(last=False)
+            self._unchecked.pop(expired_id, None)
+            self.expired += 1
+
+user_sessions = SessionStore(SESSION_TTL, SESSION_MAX)
+
+async def pack_idle_sessions(idle, batch=200):
+    """Periodically compresses idle sessions' history; it is unpacked again on next use."""
+    while True:
+        await asyncio.sleep(min(max(idle / 10, 5), 60))
+        # Small batches keep each pass short so replies aren't held up behind a big sweep
+        packed_before = user_sessions.packed
+        while user_sessions.pack_idle(idle, batch) == batch:
+            await asyncio.sleep(0)
+        packed = user_sessions.packed - packed_before
+        if packed:
+            logger.debug(f"🗜️ Compressed {packed} idle sessions")
+
+# ========== SESSION BACKENDS ==========
+class SessionBackend:
+    """Persists sessions behind the in-memory SessionStore.
+
+    Writes are write-behind: handlers only mark a session dirty and a
+    background flusher saves every dirty session in one batch each
+    SESSION_FLUSH_INTERVAL, so persistence never sits on the reply path.
+    Subclasses implement _load_raw, _write_batch and close.
+    """
+
+    def __init__(self, ttl, flush_interval):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._dirty = {}
+        self._flusher = None
+
+    async def load(self, user_id):
+        # A pending write is newer than whatever the backend holds
+        if user_id in self._dirty:
+            return self._dirty[user_id]
+        try:
+            raw = await self._load_raw(str(user_id))
+        except Exception as e:
+            logger.error(f"💾 Session load failed for {user_id}: {e}")
+            return None
+        if raw is None:
+            return None
+        session = Session.from_dict(json.loads(raw))
+        if time.time() - session.last_activity > self.ttl:
+            return None
+        return session
+
+    def mark_dirty(self, user_id, session):
+        self._dirty[user_id] = session
+
+    def mark_deleted(self, user_id):
+        self._dirty[user_id] = None
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        batch = [
+            (str(user_id), json.dumps(session.to_dict()) if session is not None else None)
+            for user_id, session in dirty.items()
+        ]
+        try:
+            await self._write_batch(batch)
+        except Exception as e:
+            logger.error(f"💾 Session flush failed ({len(batch)} sessions): {e}")
+            # Put them back unless something newer was written meanwhile
+            for user_id, session in dirty.items():
+                self._dirty.setdefault(user_id, session)
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        await self.close()
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _load_raw(self, key):
+        return None
+
+    async def _write_batch(self, batch):
+        pass
+
+    async def close(self):
+        pass
+
+class MemorySessionBackend(SessionBackend):
+    """No persistence: sessions live only in the SessionStore."""
+
+    def mark_dirty(self, user_id, session):
+        pass
+
+    def mark_deleted(self, user_id):
+        pass
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions in a local SQLite file (WAL mode), one writer thread."""
+
+    def __init__(self, path, ttl, flush_interval):
+        super().__init__(ttl, flush_interval)
+        # A single thread owns the connection, so no locking is needed
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions-db")
+        self._db = self._executor.submit(self._connect, path).result()
+
+    @staticmethod
+    def _connect(path):
+        import sqlite3
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        # Every flush prunes expired rows by `updated`
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        db.commit()
+        return db
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _select(self, key):
+        row = self._db.execute("SELECT data FROM sessions WHERE user_id = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, batch):
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated) VALUES (?, ?, ?)",
+                [(key, data, now) for key, data in batch if data is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM sessions WHERE user_id = ?",
+                [(key,) for key, data in batch if data is None]
+            )
+            self._db.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+
+    async def _load_raw(self, key):
+        return await self._run(self._select, key)
+
+    async def _write_batch(self, batch):
+        await self._run(self._write, batch)
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+class RedisSessionBackend(SessionBackend):
+    """Sessions in Redis (or anything speaking RESP) so several workers can share them.
+
+    Talks the protocol directly over one pipelined asyncio connection, which
+    keeps the bot free of a client-library dependency.
+    """
+
+    def __init__(self, url, ttl, flush_interval, prefix="meraai:session:"):
+        super().__init__(ttl, flush_interval)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args):
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {body.decode()}")
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            return [await self._read_reply() for _ in range(int(body))]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def _execute(self, *commands):
+        """Sends every command in one pipeline and returns their replies."""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                    setup = []
+                    if self.password:
+                        setup.append(("AUTH", self.password))
+                    if self.db:
+                        setup.append(("SELECT", self.db))
+                    commands = tuple(setup) + commands
+                else:
+                    setup = []
+                self._writer.write(b"".join(self._encode(*command) for command in commands))
+                await self._writer.drain()
+                replies = [await self._read_reply() for _ in commands]
+            except BaseException:
+                # Also on cancellation: unread replies would otherwise be taken by the next caller
+                await self._disconnect()
+                raise
+            return replies[len(setup):]
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _load_raw(self, key):
+        (data,) = await self._execute(("GET", self.prefix + key))
+        return data
+
+    async def _write_batch(self, batch):
+        ttl = int(self.ttl)
+        await self._execute(*[
+            ("SET", self.prefix + key, data, "EX", ttl) if data is not None else ("DEL", self.prefix + key)
+            for key, data in batch
+        ])
+
+    async def close(self):
+        await self._disconnect()
+
+def create_session_backend():
+    if SESSION_BACKEND == "sqlite":
+        logger.info(f"💾 Sessions persisted to SQLite: {SESSION_DB_PATH}")
+        return SQLiteSessionBackend(SESSION_DB_PATH, SESSION_TTL, SESSION_FLUSH_INTERVAL)
+    if SESSION_BACKEND == "redis":
+        logger.info(f"💾 Sessions persisted to Redis: {REDIS_URL}")
+        return RedisSessionBackend(REDIS_URL, SESSION_TTL, SESSION_FLUSH_INTERVAL)
+    if SESSION_BACKEND != "memory":
+        logger.warning(f"⚠️ Unknown SESSION_BACKEND '{SESSION_BACKEND}', keeping sessions in memory")
+    return MemorySessionBackend(SESSION_TTL, SESSION_FLUSH_INTERVAL)
+
+session_backend = MemorySessionBackend(SESSION_TTL, SESSION_FLUSH_INTERVAL)
+
+async def get_user_session(user_id, user_name):
+    restored = None
+    if user_sessions.get(user_id) is None:
+        restored = await session_backend.load(user_id)
+    
+    session, created = user_sessions.touch(
+        user_id, user_name, 'gemini' if GEMINI_API_KEY else 'groq', restored=restored
+    )
+    if restored is not None:
+        logger.info(f"♻️ Restored session for {user_name}")
+    elif created:
+        logger.info(f"🎯 New session for {user_name}")
+    
+    session.message_count += 1
+    session_backend.mark_dirty(user_id, session)
+    return session
+
+async def restore_user_session(user_id):
+    """The user's session, marked as used and brought back from the backend if it isn't in memory.
+
+    For commands that use history without starting a session themselves,
+    so that after a restart they still see (and add to) what was saved.
+    Returns None, without creating a session, if the user has none. Unlike
+    get_user_session it doesn't count a message.
+    """
+    session = user_sessions.get(user_id)
+    restored = None
+    if session is None:
+        restored = await session_backend.load(user_id)
+        if restored is None:
+            return None
+        session = restored
+        logger.info(f"♻️ Restored session for {restored.user_name}")
+    user_sessions.touch(user_id, session.user_name, session.preferred_ai, restored=restored)
+    return session
+
+def set_preferred_ai(user_id, preferred_ai):
+    session = user_sessions.get(user_id)
+    if session is not None:
+        session.preferred_ai = preferred_ai
+        session_backend.mark_dirty(user_id, session)
+
+def clear_user_session(user_id):
+    session = user_sessions.pop(user_id)
+    session_backend.mark_deleted(user_id)
+    return session is not None
+
+def add_to_memory(user_id, role, content):
+    session = user_sessions.get(user_id)
+    if session is not None:
+        evicted = session.history.append(role, content)
+        history_summarizer.submit(user_id, evicted)
+        session_backend.mark_dirty(user_id, session)
+
+def get_conversation_history(user_id):
+    session = user_sessions.get(user_id)
+    if session is not None:
+        return session.history.text()
+    return ""
+
+_EMPTY_CONTEXT = ConversationContext()
+
+def build_gemini_contents(user_id, user_name, pending=None):
+    """Multi-turn Gemini `contents`; `pending` is a user message not yet in memory.
+
+    With user_name=None the persona names nobody, for answers shared between users.
+    """
+    session = user_sessions.get(user_id)
+    history = session.history if session is not None else _EMPTY_CONTEXT
+    owner = f"{user_name}'s" if user_name is not None else "a"
+    persona = f"You are {owner} friendly AI assistant. Respond in Hinglish naturally, like a real friend."
+    return history.gemini_contents(persona, pending)
+
+def build_groq_messages(user_id, user_name, pending=None):
+    """Multi-turn Groq `messages`; `pending` is a user message not yet in memory."""
+    session = user_sessions.get(user_id)
+    history = session.history if session is not None else _EMPTY_CONTEXT
+    system_prompt = f"You are {user_name}'s friendly assistant. Respond in Hinglish. Be conversational and use emojis."
+    return history.groq_messages(system_prompt, pending)
+
+# ========== HISTORY SUMMARIES ==========
+class HistorySummarizer:
+    """Folds turns trimmed from a session's context into a short running summary.
+
+    Runs as one background worker, off the reply path. Evicted turns are
+    collected per user, so a burst of messages costs one summary call, and
+    each call goes to whichever configured provider has fewer calls in flight.
+    """
+
+    def __init__(self, enabled, max_chars):
+        self.enabled = enabled
+        self.max_chars = max_chars
+        self._pending = {}
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    def submit(self, user_id, evicted):
+        if not self.enabled or not evicted:
+            return
+        if user_id not in self._pending:
+            self._pending[user_id] = []
+            self._queue.put_nowait(user_id)
+        self._pending[user_id].extend(evicted)
+
+    def start(self):
+        if self.enabled and self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            turns = self._pending.pop(user_id, [])
+            try:
+                done = await self._summarize(user_id, turns)
+            except Exception as e:
+                logger.warning(f"📝 Summary failed for {user_id}: {e}")
+                continue
+            if not done:
+                # Summaries spend the same provider budgets as replies; wait for some to be left
+                self._requeue(user_id, turns)
+                await asyncio.sleep(max(min(admission.provider_wait(name) for name in self._providers()), 1.0))
+
+    def _requeue(self, user_id, turns):
+        if user_id in self._pending:
+            self._pending[user_id][:0] = turns
+        else:
+            self._pending[user_id] = turns
+            self._queue.put_nowait(user_id)
 
-# Fun responses
-FUN_RESPONSES = {
-    "greetings": ["🎉 Hello there!", "👋 Hey! Great to see you!", "😊 Namaste! Kaise ho?", "🚀 Welcome back!"],
-    "thinking": ["🤔 Let me think...", "💭 Processing...", "🧠 Analyzing...", "⚡ Crunching data..."],
-    "errors": ["😅 Oops! Something went wrong", "🔄 Let's try that again", "📡 Connection issue", "🤖 Bot moment!"]
-}
+    @staticmethod
+    def _providers():
+        """Configured providers, the one with fewer calls in flight first."""
+        providers = [name for name, key in (("gemini", GEMINI_API_KEY), ("groq", GROQ_API_KEY)) if key]
+        if len(providers) == 2 and gemini_gate.in_flight > groq_in_flight:
+            providers.reverse()
+        return providers
 
-# ========== GEMINI AI FUNCTION ==========
-def get_gemini_response(user_message, user_name, conversation_history):
-    try:
-        if not GEMINI_API_KEY:
-            logger.error("❌ Gemini API Key missing")
-            return None
+    async def _summarize(self, user_id, turns):
+        """Returns False, without calling anything, if no configured provider has budget left."""
+        session = user_sessions.get(user_id)
+        if session is None or not turns:
+            return True
+        
+        transcript = "".join(
+            f"{ConversationContext.ROLE_LABELS.get(role, 'AI')}: {content}\n" for role, content in turns
+        )
+        prompt = (
+            f"Summarize this conversation in at most {self.max_chars} characters. "
+            "Keep names, facts, preferences and open questions; drop small talk.\n\n"
+            f"Summary so far: {session.history.summary or '(none)'}\n\n"
+            f"New messages:\n{transcript}"
+        )
         
-        # Simple context
-        context = f"""You are {user_name}'s friendly AI assistant. Respond in Hinglish naturally.
+        summary = None
+        called = False
+        providers = self._providers()
+        for name in providers:
+            if not admission.provider_allowed(name):
+                continue
+            called = True
+            if name == "gemini":
+                try:
+                    summary = await get_gemini_response([{"role": "user", "parts": [prompt]}])
+                except GeminiBusyError:
+                    pass
+            else:
+                summary = await get_groq_response([{"role": "user", "content": prompt}], temperature=0.3, max_tokens=300)
+            if summary:
+                break
+        if not called:
+            return not providers
+        
+        # The session may have been cleared while we were waiting
+        if summary and user_sessions.get(user_id) is session:
+            session.history.set_summary(summary.strip()[:self.max_chars])
+            session_backend.mark_dirty(user_id, session)
+        return True
+
+history_summarizer = HistorySummarizer(SUMMARIZE_HISTORY, SUMMARY_MAX_CHARS)
+
+# ========== STREAMING REPLIES ==========
+class StreamingReply:
+    """Shows a reply as it streams in by editing one Telegram message in place.
+
+    The first text is sent as soon as it arrives; later edits are throttled to
+    one per `edit_interval` seconds. A new message is started only when the
+    current one reaches Telegram's 4096-character limit. Intermediate edits
+    are plain text because half-written Markdown often fails to parse.
+    """
+
+    def __init__(self, message, edit_interval=STREAM_EDIT_INTERVAL):
+        self._source = message
+        self.edit_interval = edit_interval
+        self._sent = None
+        self._text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self.full_text = ""
+        self.first_sent_at = None
+
+    async def consume(self, deltas):
+        """Feed a stream into the chat; returns the full text or None if nothing arrived."""
+        try:
+            async for delta in deltas:
+                await self.feed(delta)
+        except Exception as e:
+            if not self.full_text:
+                logger.warning(f"❌ Stream failed before first token: {e}")
+                return None
+            logger.warning(f"⚠️ Stream cut short: {e}")
+        return self.full_text or None
+
+    async def feed(self, delta):
+        if not delta:
+            return
+        self.full_text += delta
+        self._text += delta
+        while len(self._text) > TELEGRAM_MAX_MESSAGE:
+            head, self._text = self._text[:TELEGRAM_MAX_MESSAGE], self._text[TELEGRAM_MAX_MESSAGE:]
+            await self._finalize(head)
+            self._sent = None
+            self._shown = ""
+        await self._push(self._text)
+
+    async def finish(self, footer=""):
+        # As in the non-streamed replies: an answer whose Markdown doesn't close is
+        # escaped, so the footer's own formatting still renders
+        text = prepare_markdown(self._text)
+        if len(text) > TELEGRAM_MAX_MESSAGE:
+            text = self._text
+        if len(text) + len(footer) > TELEGRAM_MAX_MESSAGE:
+            await self._finalize(text)
+            self._sent = None
+            self._shown = ""
+            text = ""
+            footer = footer.lstrip()
+        self._text = ""
+        await self._finalize(text + footer)
+
+    async def _push(self, text):
+        now = time.monotonic()
+        if text == self._shown:
+            return
+        if self._sent is None:
+            self._sent = await outbox.reply(self._source, text)
+            if self.first_sent_at is None:
+                self.first_sent_at = time.monotonic()
+        elif now - self._last_edit >= self.edit_interval:
+            if not await outbox.edit(self._sent, text, wait=False):
+                return
+        else:
+            return
+        self._shown = text
+        self._last_edit = now
+
+    async def _finalize(self, text):
+        if not text:
+            return
+        # The scheduler falls back to plain text if the Markdown doesn't parse
+        if self._sent is None:
+            self._sent = await outbox.reply(self._source, text, parse_mode='Markdown')
+            if self.first_sent_at is None:
+                self.first_sent_at = time.monotonic()
+        else:
+            await outbox.edit(self._sent, text, parse_mode='Markdown')
+        self._shown = text
+
+# ========== ADMISSION CONTROL ==========
+class AdmissionRejected(Exception):
+    """Raised when an update is shed; the message is the reply for the user."""
+
+    def __init__(self, reason, reply):
+        super().__init__(reply)
+        self.reason = reason
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate_per_min, capacity, now):
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until the next token, as of the last refill."""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def try_take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class AdmissionController:
+    """Per-user and per-provider token buckets plus a global AI concurrency cap.
+
+    When every slot is busy, requests wait in per-user queues that are
+    served round-robin, so one chatty user can't starve everyone else.
+    Anything beyond `max_queued` is shed immediately. `clock` can be
+    replaced with a fake for testing.
+    """
+
+    def __init__(self, user_rate, user_burst, provider_rates, max_concurrent, max_queued,
+                 max_tracked_users=100000, clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_tracked_users = max_tracked_users
+        self.clock = clock
+        self.active = 0
+        self.queued = 0
+        self.shed = 0
+        self._user_buckets = OrderedDict()
+        self._provider_buckets = {
+            name: TokenBucket(rate, max(1, int(rate // 6)), clock())
+            for name, rate in provider_rates.items() if rate > 0
+        }
+        self._waiting = OrderedDict()
+
+    def stats(self):
+        return {'active': self.active, 'queued': self.queued, 'shed': self.shed}
+
+    def user_allowed(self, user_id):
+        if self.user_rate <= 0:
+            return True
+        now = self.clock()
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            # Idle users' buckets are full again anyway, so forgetting them is harmless
+            if len(self._user_buckets) > self.max_tracked_users:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(user_id)
+        return bucket.try_take(now)
 
-Previous chat:
-{conversation_history}
+    def provider_allowed(self, name):
+        bucket = self._provider_buckets.get(name)
+        return bucket is None or bucket.try_take(self.clock())
 
-User: {user_message}
+    def provider_wait(self, name):
+        """Seconds until `name` has budget for another call; 0 if it isn't limited."""
+        bucket = self._provider_buckets.get(name)
+        if bucket is None:
+            return 0.0
+        bucket.refill(self.clock())
+        return bucket.wait_time()
 
-Respond like a real friend:"""
+    async def acquire(self, user_id):
+        if not self.user_allowed(user_id):
+            self.shed += 1
+            raise AdmissionRejected('user', "🚦 Thoda slow! You're sending messages too fast. Try again in a few seconds.")
         
-        # ✅ NEW 2024 GEMINI MODELS:
-        models_to_try = [
-            'gemini-1.5-flash-latest',    # Latest flash model
-            'gemini-1.5-pro-latest',      # Latest pro model  
-            'gemini-1.0-pro-latest',      # Legacy latest
-            'models/gemini-pro',          # Full path
-        ]
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
         
-        for model_name in models_to_try:
-            try:
-                logger.info(f"🔄 Trying model: {model_name}")
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(context)
-                
-                if response.text:
-                    logger.info(f"✅ Success with model: {model_name}")
-                    return response.text
-            except Exception as model_error:
-                logger.warning(f"❌ Model {model_name} failed: {model_error}")
-                continue
+        if self.queued >= self.max_queued:
+            self.shed += 1
+            raise AdmissionRejected('overloaded', "🚦 I'm very busy right now. Please try again in a minute!")
         
-        logger.error("❌ All Gemini models failed")
-        return None
-            
-    except Exception as e:
-        logger.error(f"💥 Gemini API Error: {str(e)}")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We were handed a slot just as we got cancelled
+                self.release()
+            else:
+                self._forget(user_id, waiter)
+            raise
+
+    def release(self):
+        waiter = self._next_waiter()
+        if waiter is None:
+            self.active -= 1
+        else:
+            # The slot passes straight to the next waiter
+            waiter.set_result(None)
+
+    def _next_waiter(self):
+        while self._waiting:
+            user_id, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            self.queued -= 1
+            if not waiter.done():
+                return waiter
         return None
-# ========== MEMORY MANAGEMENT ==========
-def get_user_session(user_id, user_name):
-    current_time = datetime.now()
-    
-    # Clean old sessions (2 hours)
-    for uid in list(user_sessions.keys()):
-        if current_time - user_sessions[uid]['last_activity'] > timedelta(hours=2):
-            del user_sessions[uid]
-    
-    # Create new session or update existing
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {
-            'history': [],
-            'last_activity': current_time,
-            'user_name': user_name,
-            'message_count': 0,
-            'preferred_ai': 'gemini' if GEMINI_API_KEY else 'groq'
-        }
-        logger.info(f"🎯 New session for {user_name}")
-    
-    user_sessions[user_id]['last_activity'] = current_time
-    user_sessions[user_id]['message_count'] += 1
-    
-    return user_sessions[user_id]
 
-def add_to_memory(user_id, role, content):
-    if user_id in user_sessions:
-        user_sessions[user_id]['history'].append({"role": role, "content": content})
+    def _forget(self, user_id, waiter):
+        waiters = self._waiting.get(user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[user_id]
+
+admission = AdmissionController(
+    USER_RATE_PER_MIN, USER_BURST,
+    {'gemini': GEMINI_RATE_PER_MIN, 'groq': GROQ_RATE_PER_MIN},
+    MAX_CONCURRENT_AI, MAX_QUEUED_AI
+)
+
+def admission_controlled(handler):
+    """Runs an AI handler only once admission control lets the update in."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        try:
+            await admission.acquire(user_id)
+        except AdmissionRejected as rejected:
+            logger.info(f"🚦 Shed update from {user_id} ({rejected.reason})")
+            await outbox.reply(update.message, str(rejected))
+            return
+        try:
+            return await handler(update, context)
+        finally:
+            admission.release()
+    return wrapper
+
+async def _rate_limited(name, factory):
+    # Provider tokens are only spent when the router actually calls the provider
+    if not admission.provider_allowed(name):
+        raise ProviderRateLimited(f"{name} rate limit reached")
+    async for chunk in factory():
+        yield chunk
+
+# ========== REPLY TEMPLATES ==========
+# Telegram's legacy Markdown has no escapes inside entities and rejects a
+# message whose *, _ or ` entities don't close. Text we don't control (names,
+# cities, headlines, AI answers) is checked or escaped before it goes into a
+# Markdown reply, so Telegram doesn't reject it and make us send it again.
+# Complete entities, matched left to right like Telegram's parser (no nesting)
+_MARKDOWN_ENTITIES = re.compile(r"\\.|```.*?```|`[^`]*`|\*[^*]*\*|_[^_]*_|\[[^\]\n]*\]\([^)\n]*\)", re.S)
+_MARKDOWN_SPECIAL = re.compile(r"([_*`\[])")
+
+def markdown_balanced(text):
+    """True if every legacy Markdown entity in `text` is closed."""
+    rest = _MARKDOWN_ENTITIES.sub("", text)
+    return '*' not in rest and '_' not in rest and '`' not in rest
+
+def escape_md(text):
+    return _MARKDOWN_SPECIAL.sub(r"\\\1", str(text))
+
+def prepare_markdown(text):
+    """Keeps an AI answer's own formatting when it parses, escapes it otherwise."""
+    return text if markdown_balanced(text) else escape_md(text)
+
+GEMINI_STATUS = "✅ Available" if GEMINI_API_KEY else "❌ Not configured"
+
+START_TEMPLATE = f"""
+🎉 **Hello {{user_name}}!** 
+
+🤖 **I'm MeraAI - Now with Google Gemini!**
+
+✨ **AI Options:**
+• 🧠 `/gemini` - Google Gemini (High Quality)
+• ⚡ `/ai` - Groq AI (Ultra Fast)  
+• 💬 Normal chat - Auto smart selection
+
+🛠 **Other Features:**
+• 🌤️ Weather updates
+• 📰 Latest news  
+• 🧠 Conversation memory
+• 😊 Friendly personality
+
+🔧 **Commands:**
+/start - This message
+/help - Full guide
+/weather [city] - Weather
+/news [category] - News
+/gemini [question] - Gemini AI
+/ai [message] - Groq AI
+/clear - Clear memory
+
+🚀 **Gemini Status:** {GEMINI_STATUS}
+
+**Let's chat! I'll remember our conversation!** 😊
+"""
+
+HELP_TEXT = """
+🆘 **MeraAI Help Guide**
+
+🎯 **AI Chat Options:**
+• **Normal Chat** - I automatically choose best AI
+• **/gemini** - Google Gemini (Highest quality)
+• **/ai** - Groq AI (Fastest responses)
+
+📝 **All Commands:**
+/start - Welcome message
+/help - This guide
+/weather [city] - Weather
+/news [category] - News
+/gemini [question] - Gemini AI
+/ai [message] - Groq AI
+/subscribe news|weather [...] - Regular digest
+/unsubscribe - Stop digests
+/clear - Clear memory
+/stats - Conversation stats
+
+🌐 **News Categories:**
+technology, sports, business, entertainment, science, health, general
+
+💡 **Pro Tip:** Use `/gemini` for complex questions and `/ai` for quick chats!
+
+🚀 **Now with dual AI power!**
+"""
+
+GEMINI_USAGE = """
+🧠 **Google Gemini Pro**
+
+Usage: `/gemini your question here`
+
+**Examples:**
+• `/gemini explain quantum computing`
+• `/gemini write a python code`
+• `/gemini how to learn AI`
+
+🚀 **Powered by Google's most advanced AI**
+🎯 **High quality responses**
+"""
+
+AI_USAGE = """
+⚡ **Groq AI Chat**
+
+Usage: `/ai your message here`
+
+**Examples:**
+• `/ai hello how are you`
+• `/ai tell me a joke`
+• `/ai explain something`
+
+🚀 **Powered by Groq - Ultra Fast**
+🎯 **Free & Reliable**
+"""
+
+AI_COMMAND_SYSTEM = {
+    "role": "system",
+    "content": "You are a friendly AI assistant. Respond in Hinglish with emojis. Be helpful and engaging."
+}
+
+GEMINI_REPLY_HEAD = "\n🧠 **Google Gemini:**\n\n"
+GEMINI_REPLY_TAIL = "\n\n---\n🔷 *Powered by Google Gemini Pro*\n🎯 *Advanced AI Technology*\n"
+AI_REPLY_HEAD = "\n⚡ **Groq AI:**\n\n"
+AI_REPLY_TAIL = "\n\n---\n⚡ *Powered by Groq - Ultra Fast*\n🎯 *Free AI Service*\n"
+
+# Footer under smart-chat replies, one per provider
+POWERED_BY = {name: f"\n\n---\n🤖 *Powered by {label}*" for name, label in AI_SOURCES.items()}
+
+# ========== OUTBOUND SEND SCHEDULER ==========
+def split_message(text, limit=TELEGRAM_MAX_MESSAGE):
+    """Splits text into as few Telegram messages as possible, preferring line breaks."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+class SendScheduler:
+    """Paces every outgoing Telegram call against per-chat and global token buckets.
+
+    A 429 RetryAfter blocks that chat for the time Telegram asks and the
+    call is retried, instead of failing the handler. Markdown whose entities
+    don't close is sent as plain text up front, and anything else Telegram
+    can't parse is resent as plain text. Calls made with wait=False (typing
+    actions, intermediate streaming edits) are dropped instead of queued
+    when the chat has no budget left. `clock` and `sleep` can be replaced
+    with fakes for testing.
+    """
+
+    def __init__(self, chat_rate, chat_burst, global_rate, global_burst,
+                 max_retries=3, max_tracked_chats=100000, clock=time.monotonic, sleep=asyncio.sleep):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.clock = clock
+        self.sleep = sleep
+        self.sent = 0
+        self.dropped = 0
+        self.flood_waits = 0
+        self._global = TokenBucket(global_rate, global_burst, clock())
+        self._chats = OrderedDict()
+        self._blocked_until = {}
+        self._last_typing = {}
+
+    def stats(self):
+        return {'sent': self.sent, 'dropped': self.dropped, 'flood_waits': self.flood_waits}
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            if len(self._chats) > self.max_tracked_chats:
+                old_chat, _ = self._chats.popitem(last=False)
+                self._blocked_until.pop(old_chat, None)
+                self._last_typing.pop(old_chat, None)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _turn(self, chat_id, wait):
+        while True:
+            now = self.clock()
+            chat = self._chat_bucket(chat_id, now)
+            chat.refill(now)
+            self._global.refill(now)
+            blocked = self._blocked_until.get(chat_id, 0) - now
+            if blocked <= 0 and chat.tokens >= 1 and self._global.tokens >= 1:
+                chat.tokens -= 1
+                self._global.tokens -= 1
+                return True
+            if not wait:
+                return False
+            await self.sleep(max(blocked, chat.wait_time(), self._global.wait_time(), 0.005))
+
+    async def _call(self, chat_id, send, wait=True):
+        attempts = 0
+        while True:
+            if not await self._turn(chat_id, wait):
+                self.dropped += 1
+                return None
+            try:
+                result = await send()
+            except RetryAfter as e:
+                attempts += 1
+                self.flood_waits += 1
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._blocked_until[chat_id] = self.clock() + retry_after
+                logger.warning(f"🐢 Telegram flood limit in chat {chat_id}, retrying in {retry_after}s")
+                if not wait:
+                    self.dropped += 1
+                    return None
+                if attempts > self.max_retries:
+                    raise
+                continue
+            self.sent += 1
+            return result
+
+    async def _send(self, chat_id, send, parse_mode, wait=True):
+        try:
+            return await self._call(chat_id, lambda: send(parse_mode), wait)
+        except BadRequest as e:
+            if parse_mode and "parse entities" in str(e).lower():
+                logger.info("📝 Markdown rejected by Telegram, sending as plain text")
+                return await self._call(chat_id, lambda: send(None), wait)
+            raise
+
+    def _checked_mode(self, text, parse_mode):
+        if parse_mode == 'Markdown' and not markdown_balanced(text):
+            return None
+        return parse_mode
+
+    async def reply(self, message, text, parse_mode=None, **kwargs):
+        parse_mode = self._checked_mode(text, parse_mode)
+        return await self._send(
+            message.chat_id, lambda mode: message.reply_text(text, parse_mode=mode, **kwargs), parse_mode
+        )
+
+    async def reply_long(self, message, text, parse_mode=None):
+        """Replies with text of any length in as few messages as possible."""
+        sent = None
+        for part in split_message(text):
+            sent = await self.reply(message, part, parse_mode=parse_mode)
+        return sent
+
+    async def send(self, bot, chat_id, text, parse_mode=None):
+        """Sends a message that isn't a reply, e.g. a scheduled digest."""
+        parse_mode = self._checked_mode(text, parse_mode)
+        return await self._send(
+            chat_id, lambda mode: bot.send_message(chat_id, text, parse_mode=mode), parse_mode
+        )
+
+    async def broadcast(self, bot, chat_ids, text, parse_mode=None):
+        """Sends one text to many chats as fast as the global budget allows.
+
+        A few workers share the list, so a large fan-out never holds more
+        pending sends than the global burst. Returns the chats that have
+        blocked the bot.
+        """
+        pending = iter(chat_ids)
+        blocked = []
+        
+        async def worker():
+            for chat_id in pending:
+                try:
+                    await self.send(bot, chat_id, text, parse_mode)
+                except Forbidden:
+                    blocked.append(chat_id)
+                except Exception as e:
+                    logger.warning(f"📬 Broadcast to chat {chat_id} failed: {e}")
         
-        # Keep optimal context length
-        if len(user_sessions[user_id]['history']) > 8:
-            user_sessions[user_id]['history'] = user_sessions[user_id]['history'][-8:]
+        workers = max(1, min(len(chat_ids), int(self._global.capacity)))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return blocked
 
-def get_conversation_history(user_id):
-    if user_id in user_sessions:
-        history_text = ""
-        for msg in user_sessions[user_id]['history'][-6:]:
-            role = "You" if msg['role'] == "user" else "AI"
-            history_text += f"{role}: {msg['content']}\n"
-        return history_text
-    return ""
+    async def edit(self, message, text, parse_mode=None, wait=True):
+        """Edits a sent message; returns False if the edit was dropped."""
+        parse_mode = self._checked_mode(text, parse_mode)
+        try:
+            result = await self._send(
+                message.chat_id, lambda mode: message.edit_text(text, parse_mode=mode), parse_mode, wait
+            )
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return True
+            raise
+        return result is not None
+
+    async def typing(self, chat):
+        # A typing status lasts ~5 s, so repeating it sooner only burns budget
+        now = self.clock()
+        if now - self._last_typing.get(chat.id, float('-inf')) < TYPING_INTERVAL:
+            return
+        self._last_typing[chat.id] = now
+        try:
+            await self._call(chat.id, lambda: chat.send_action(action="typing"), wait=False)
+        except Exception as e:
+            logger.debug(f"Typing action failed in chat {chat.id}: {e}")
+
+outbox = SendScheduler(
+    TELEGRAM_CHAT_RATE_PER_MIN, TELEGRAM_CHAT_BURST,
+    TELEGRAM_GLOBAL_RATE_PER_SEC * 60, int(TELEGRAM_GLOBAL_RATE_PER_SEC)
+)
 
 # ========== SMART AI CHAT ==========
+@timed_handler("handle_message")
+@admission_controlled
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    received = time.monotonic()
     try:
         user_id = update.message.from_user.id
         user_name = update.message.from_user.first_name
@@ -135,399 +2397,739 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_message.startswith('/'):
             return
         
-        logger.info(f"💬 {user_name}: {user_message}")
+        logger.debug(f"💬 {user_name}: {user_message}")
         
         # Get user session
-        session = get_user_session(user_id, user_name)
+        session = await get_user_session(user_id, user_name)
         add_to_memory(user_id, "user", user_message)
         
-        await update.message.chat.send_action(action="typing")
+        await outbox.typing(update.message.chat)
         
-        # Try Gemini first if available
-        ai_response = None
-        ai_source = "Groq"
+        # Gemini first if preferred, Groq as the fallback
+        providers = []
         
-        if session.get('preferred_ai') == 'gemini' and GEMINI_API_KEY:
-            conversation_history = get_conversation_history(user_id)
-            ai_response = get_gemini_response(user_message, user_name, conversation_history)
-            if ai_response:
-                ai_source = "Google Gemini 🧠"
-        
-        # Fallback to Groq
-        if not ai_response and GROQ_API_KEY:
-            headers = {
-                "Authorization": f"Bearer {GROQ_API_KEY}",
-                "Content-Type": "application/json"
-            }
-            
-            messages = [
-                {
-                    "role": "system", 
-                    "content": f"You are {user_name}'s friendly assistant. Respond in Hinglish. Be conversational and use emojis. Remember context: {get_conversation_history(user_id)}"
-                },
-                {
-                    "role": "user", 
-                    "content": user_message
-                }
-            ]
-            
-            data = {
-                "messages": messages,
-                "model": "llama-3.1-8b-instant",
-                "temperature": 0.8,
-                "max_tokens": 500
-            }
-            
-            response = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                ai_response = response.json()['choices'][0]['message']['content']
-                ai_source = "Groq AI ⚡"
+        # Providers with an open circuit are skipped instead of waited on
+        if session.preferred_ai == 'gemini' and GEMINI_API_KEY and gemini_healthy():
+            contents = build_gemini_contents(user_id, user_name)
+            if STREAM_REPLIES:
+                gemini_call = lambda: stream_gemini_response(contents)
+            else:
+                gemini_call = lambda: _single_reply(get_gemini_response(contents))
+            providers.append(("gemini", functools.partial(_rate_limited, "gemini", gemini_call)))
+        
+        if GROQ_API_KEY and breakers.get("groq", GROQ_MODEL).available():
+            messages = build_groq_messages(user_id, user_name)
+            if STREAM_REPLIES:
+                groq_call = lambda: stream_groq_response(messages, temperature=0.8)
+            else:
+                groq_call = lambda: _single_reply(get_groq_response(messages, temperature=0.8))
+            providers.append(("groq", functools.partial(_rate_limited, "groq", groq_call)))
+        
+        provider, stream = await chat_router.first_response(providers)
+        ai_source = AI_SOURCES.get(provider)
+        reply = StreamingReply(update.message) if STREAM_REPLIES else None
+        
+        if stream is None:
+            ai_response = None
+        elif reply:
+            ai_response = await reply.consume(stream)
+        else:
+            ai_response = "".join([chunk async for chunk in stream])
         
         if ai_response:
             add_to_memory(user_id, "assistant", ai_response)
             
             # Format response
-            if len(ai_response) > 400:
-                parts = [ai_response[i:i+400] for i in range(0, len(ai_response), 400)]
-                for i, part in enumerate(parts):
-                    if i == len(parts) - 1:
-                        part += f"\n\n---\n🤖 *Powered by {ai_source}*"
-                    await update.message.reply_text(part, parse_mode='Markdown')
-                    await asyncio.sleep(0.5)
+            if reply:
+                await reply.finish(POWERED_BY[provider])
+                first_sent_at = reply.first_sent_at or time.monotonic()
             else:
-                formatted_response = f"{ai_response}\n\n---\n🤖 *Powered by {ai_source}*"
-                await update.message.reply_text(formatted_response, parse_mode='Markdown')
+                formatted_response = prepare_markdown(ai_response) + POWERED_BY[provider]
+                await outbox.reply_long(update.message, formatted_response, parse_mode='Markdown')
+                first_sent_at = time.monotonic()
+            metrics.observe("time_to_first_reply_seconds", first_sent_at - received, handler="handle_message")
                 
-            logger.info(f"✅ Response from {ai_source}")
+            logger.debug(f"✅ Response from {ai_source}")
         else:
-            await update.message.reply_text("❌ All AI services are busy. Try again!")
+            await outbox.reply(update.message, "❌ All AI services are busy. Try again!")
             
     except Exception as e:
         logger.error(f"💥 Chat error: {str(e)}")
-        await update.message.reply_text("❌ Oops! Something went wrong.")
+        await outbox.reply(update.message, "❌ Oops! Something went wrong.")
+
+# ========== ANSWER CACHE ==========
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize_question(text):
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class AnswerCache:
+    """Bounded LRU cache of AI answers for questions asked without context.
+
+    Lookups match on normalized text first. If `similarity` is above zero,
+    a trigram index also matches near-duplicates ("tell me a joke" vs
+    "tell me a joke!!") whose Jaccard similarity reaches the threshold.
+    """
+
+    def __init__(self, ttl, max_entries, similarity=0.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.clock = clock
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._index = {}
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'similar_hits': self.similar_hits,
+            'misses': self.misses, 'size': len(self._entries)
+        }
+
+    def get(self, question):
+        key = normalize_question(question)
+        answer = self._lookup(key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        
+        if self.similarity > 0:
+            match = self._similar(key)
+            if match is not None:
+                answer = self._lookup(match)
+                if answer is not None:
+                    self.similar_hits += 1
+                    return answer
+        
+        self.misses += 1
+        return None
+
+    def put(self, question, answer):
+        key = normalize_question(question)
+        if not key:
+            return
+        if key in self._entries:
+            self._remove(key)
+        grams = _trigrams(key) if self.similarity > 0 else frozenset()
+        self._entries[key] = (answer, self.clock() + self.ttl, grams)
+        for gram in grams:
+            self._index.setdefault(gram, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self.clock():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _similar(self, key):
+        grams = _trigrams(key)
+        overlap = {}
+        for gram in grams:
+            for candidate in self._index.get(gram, ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        
+        best, best_score = None, self.similarity
+        for candidate, shared in overlap.items():
+            candidate_grams = self._entries[candidate][2]
+            score = shared / (len(grams) + len(candidate_grams) - shared)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    def _remove(self, key):
+        answer, expires_at, grams = self._entries.pop(key)
+        for gram in grams:
+            keys = self._index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[gram]
+
+ai_answer_cache = AnswerCache(ANSWER_CACHE_TTL, ANSWER_CACHE_MAX, ANSWER_CACHE_SIMILARITY)
+gemini_answer_cache = AnswerCache(ANSWER_CACHE_TTL, ANSWER_CACHE_MAX, ANSWER_CACHE_SIMILARITY)
 
 # ========== GEMINI COMMAND ==========
+@timed_handler("gemini_command")
+@admission_controlled
 async def gemini_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    received = time.monotonic()
     try:
         user_message = " ".join(context.args) if context.args else ""
         user_id = update.message.from_user.id
         user_name = update.message.from_user.first_name
         
         if not user_message:
-            await update.message.reply_text("""
-🧠 **Google Gemini Pro**
-
-Usage: `/gemini your question here`
-
-**Examples:**
-• `/gemini explain quantum computing`
-• `/gemini write a python code`
-• `/gemini how to learn AI`
-
-🚀 **Powered by Google's most advanced AI**
-🎯 **High quality responses**
-""", parse_mode='Markdown')
+            await outbox.reply(update.message, GEMINI_USAGE, parse_mode='Markdown')
             return
         
         if not GEMINI_API_KEY:
-            await update.message.reply_text("❌ Gemini service not configured")
+            await outbox.reply(update.message, "❌ Gemini service not configured")
             return
         
-        await update.message.reply_text("🧠 Gemini is thinking...")
-        await update.message.chat.send_action(action="typing")
+        await restore_user_session(user_id)
         
         # Set preference to Gemini
-        if user_id in user_sessions:
-            user_sessions[user_id]['preferred_ai'] = 'gemini'
+        set_preferred_ai(user_id, 'gemini')
         
-        conversation_history = get_conversation_history(user_id)
-        response_text = get_gemini_response(user_message, user_name, conversation_history)
+        # Only questions asked without earlier conversation can share answers
+        context_free = not get_conversation_history(user_id)
+        response_text = gemini_answer_cache.get(user_message) if context_free else None
+        
+        if response_text is None:
+            if not admission.provider_allowed("gemini"):
+                await outbox.reply(update.message, "🚦 Gemini is at its request limit. Try again in a minute or use `/ai`.", parse_mode='Markdown')
+                return
+            
+            await outbox.reply(update.message, "🧠 Gemini is thinking...")
+            await outbox.typing(update.message.chat)
+            
+            # A shareable answer must not be written for one user by name
+            contents = build_gemini_contents(user_id, None if context_free else user_name, pending=user_message)
+            try:
+                response_text = await get_gemini_response(contents)
+            except GeminiBusyError as busy:
+                logger.warning(f"🚦 Gemini saturated ({busy})")
+                await outbox.reply(update.message, "🚦 Gemini is overloaded right now. Try again in a few seconds or use `/ai`.", parse_mode='Markdown')
+                return
+            if response_text and context_free:
+                gemini_answer_cache.put(user_message, response_text)
         
         if response_text:
             add_to_memory(user_id, "user", user_message)
             add_to_memory(user_id, "assistant", response_text)
             
-            formatted_response = f"""
-🧠 **Google Gemini:**
-
-{response_text}
-
----
-🔷 *Powered by Google Gemini Pro*
-🎯 *Advanced AI Technology*
-"""
-            await update.message.reply_text(formatted_response, parse_mode='Markdown')
+            formatted_response = GEMINI_REPLY_HEAD + prepare_markdown(response_text) + GEMINI_REPLY_TAIL
+            await outbox.reply_long(update.message, formatted_response, parse_mode='Markdown')
+            metrics.observe("time_to_first_reply_seconds", time.monotonic() - received, handler="gemini_command")
         else:
-            await update.message.reply_text("❌ Gemini service busy. Try `/ai` command.")
+            await outbox.reply(update.message, "❌ Gemini service busy. Try `/ai` command.")
             
     except Exception as e:
         logger.error(f"Gemini command error: {str(e)}")
-        await update.message.reply_text("❌ Gemini service error")
+        await outbox.reply(update.message, "❌ Gemini service error")
 
 # ========== AI COMMAND (GROQ) ==========
+@timed_handler("ai_command")
+@admission_controlled
 async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    received = time.monotonic()
     try:
         user_message = " ".join(context.args) if context.args else ""
-        user_id = update.message.from_user.id
-        user_name = update.message.from_user.first_name
-        
-        if not user_message:
-            await update.message.reply_text("""
-⚡ **Groq AI Chat**
-
-Usage: `/ai your message here`
-
-**Examples:**
-• `/ai hello how are you`
-• `/ai tell me a joke`
-• `/ai explain something`
-
-🚀 **Powered by Groq - Ultra Fast**
-🎯 **Free & Reliable**
-""", parse_mode='Markdown')
+        user_id = update.message.from_user.id
+        user_name = update.message.from_user.first_name
+        
+        if not user_message:
+            await outbox.reply(update.message, AI_USAGE, parse_mode='Markdown')
             return
         
         if not GROQ_API_KEY:
-            await update.message.reply_text("❌ AI service not available")
+            await outbox.reply(update.message, "❌ AI service not available")
             return
         
-        await update.message.reply_text("⚡ AI is thinking...")
+        await restore_user_session(user_id)
         
         # Set preference to Groq
-        if user_id in user_sessions:
-            user_sessions[user_id]['preferred_ai'] = 'groq'
-        
-        headers = {
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "messages": [
-                {
-                    "role": "system", 
-                    "content": "You are a friendly AI assistant. Respond in Hinglish with emojis. Be helpful and engaging."
-                },
-                {
-                    "role": "user", 
-                    "content": user_message
-                }
-            ],
-            "model": "llama-3.1-8b-instant",
-            "temperature": 0.7,
-            "max_tokens": 500
-        }
+        set_preferred_ai(user_id, 'groq')
         
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        # /ai never sends history, so every answer is safe to share
+        ai_response = ai_answer_cache.get(user_message)
         
-        if response.status_code == 200:
-            ai_response = response.json()['choices'][0]['message']['content']
+        if ai_response is None:
+            if not admission.provider_allowed("groq"):
+                await outbox.reply(update.message, "🚦 AI is at its request limit. Try again in a minute!")
+                return
+            
+            await outbox.reply(update.message, "⚡ AI is thinking...")
             
+            messages = [AI_COMMAND_SYSTEM, {"role": "user", "content": user_message}]
+            
+            ai_response = await get_groq_response(messages, temperature=0.7)
+            if ai_response:
+                ai_answer_cache.put(user_message, ai_response)
+        
+        if ai_response:
             add_to_memory(user_id, "user", user_message)
             add_to_memory(user_id, "assistant", ai_response)
             
-            formatted_response = f"""
-⚡ **Groq AI:**
-
-{ai_response}
-
----
-⚡ *Powered by Groq - Ultra Fast*
-🎯 *Free AI Service*
-"""
-            await update.message.reply_text(formatted_response, parse_mode='Markdown')
+            formatted_response = AI_REPLY_HEAD + prepare_markdown(ai_response) + AI_REPLY_TAIL
+            await outbox.reply_long(update.message, formatted_response, parse_mode='Markdown')
+            metrics.observe("time_to_first_reply_seconds", time.monotonic() - received, handler="ai_command")
         else:
-            await update.message.reply_text("❌ AI service busy")
+            await outbox.reply(update.message, "❌ AI service busy")
             
     except Exception as e:
         logger.error(f"AI command error: {str(e)}")
-        await update.message.reply_text("❌ AI service error")
+        await outbox.reply(update.message, "❌ AI service error")
 
-# ========== WEATHER COMMAND ==========
-async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        city = " ".join(context.args) if context.args else "Mumbai"
-        
-        await update.message.reply_text(f"🌤️ Checking weather for {city}...")
-        await update.message.chat.send_action(action="typing")
-        
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric"
-        response = requests.get(url, timeout=10)
+# ========== RESPONSE CACHE ==========
+class AsyncTTLCache:
+    """TTL cache for upstream API results with single-flight loading.
+
+    Concurrent misses for one key share a single upstream call. Entries
+    past their TTL but within `stale_ttl` are still served while one
+    background refresh runs. Loaders return None for results that should
+    not be cached (errors, not found).
+    """
+
+    def __init__(self, name, ttl, stale_ttl, max_entries, clock=time.monotonic):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'stale_hits': self.stale_hits,
+            'misses': self.misses, 'coalesced': self.coalesced,
+            'size': len(self._entries), 'inflight': len(self._inflight)
+        }
+
+    async def get(self, key, loader):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = self.clock() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._load(key, loader)
+                return value
         
-        if response.status_code == 200:
-            data = response.json()
-            
-            weather_emoji = "🌤️"
-            main_weather = data['weather'][0]['main'].lower()
-            if 'rain' in main_weather:
-                weather_emoji = "🌧️"
-            elif 'cloud' in main_weather:
-                weather_emoji = "☁️"
-            elif 'clear' in main_weather:
-                weather_emoji = "☀️"
-            
-            weather_text = f"""
-{weather_emoji} **Weather in {data['name']}**
+        if key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        # shield() so one impatient caller can't cancel the load for everyone
+        return await asyncio.shield(self._load(key, loader))
+
+    async def refresh(self, key, loader):
+        return await asyncio.shield(self._load(key, loader))
+
+    def peek(self, key):
+        """The cached value if it is still within its TTL, without loading anything."""
+        entry = self._entries.get(key)
+        if entry is None or self.clock() - entry[1] >= self.ttl:
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _load(self, key, loader):
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch(key, loader))
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return task
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"🗃️ {self.name} refresh for '{key}' failed: {task.exception()}")
+
+    async def _fetch(self, key, loader):
+        value = await loader()
+        if value is not None:
+            self._entries[key] = (value, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+weather_cache = AsyncTTLCache("weather", WEATHER_CACHE_TTL, CACHE_STALE_TTL, CACHE_MAX_ENTRIES)
+news_cache = AsyncTTLCache("news", NEWS_CACHE_TTL, CACHE_STALE_TTL, CACHE_MAX_ENTRIES)
+
+def _normalize_city(city):
+    return " ".join(city.lower().split())
+
+async def fetch_weather(city, refresh=False):
+    """OpenWeatherMap data for a city (cached), or None if it couldn't be found."""
+    async def load():
+        if not breakers.get("openweathermap", "current").allow():
+            raise CircuitOpenError("OpenWeatherMap circuit is open")
+        started = time.monotonic()
+        try:
+            response = await http_get(
+                WEATHER_URL,
+                params={"q": city, "appid": WEATHER_API_KEY, "units": "metric"},
+                timeout=10
+            )
+        except Exception:
+            observe_call("openweathermap", "current", started, ok=False)
+            raise
+        # 404 is an unknown city, not an upstream failure
+        observe_call("openweathermap", "current", started, ok=response.status_code in (200, 404))
+        return response.json() if response.status_code == 200 else None
+    
+    if refresh:
+        return await weather_cache.refresh(_normalize_city(city), load)
+    return await weather_cache.get(_normalize_city(city), load)
+
+async def fetch_news(category, refresh=False):
+    """NewsAPI top headlines for a category (cached), or None if the service failed."""
+    async def load():
+        if not breakers.get("newsapi", "top-headlines").allow():
+            raise CircuitOpenError("NewsAPI circuit is open")
+        started = time.monotonic()
+        try:
+            response = await http_get(
+                NEWS_URL,
+                params={"country": "in", "category": category, "pageSize": 5, "apiKey": NEWS_API_KEY},
+                timeout=15
+            )
+        except Exception:
+            observe_call("newsapi", "top-headlines", started, ok=False)
+            raise
+        observe_call("newsapi", "top-headlines", started, ok=response.status_code == 200)
+        return response.json() if response.status_code == 200 else None
+    
+    if refresh:
+        return await news_cache.refresh(category, load)
+    return await news_cache.get(category, load)
+
+def render_weather(data):
+    weather_emoji = "🌤️"
+    main_weather = data['weather'][0]['main'].lower()
+    if 'rain' in main_weather:
+        weather_emoji = "🌧️"
+    elif 'cloud' in main_weather:
+        weather_emoji = "☁️"
+    elif 'clear' in main_weather:
+        weather_emoji = "☀️"
+    
+    weather_text = f"""
+{weather_emoji} **Weather in {escape_md(data['name'])}**
 
 📊 **Temperature:** {data['main']['temp']}°C
 🌡️ **Feels Like:** {data['main']['feels_like']}°C
-🌈 **Condition:** {data['weather'][0]['description'].title()}
+🌈 **Condition:** {escape_md(data['weather'][0]['description'].title())}
 💧 **Humidity:** {data['main']['humidity']}%
 💨 **Wind Speed:** {data['wind']['speed']} m/s
 """
-            temp = data['main']['temp']
-            if temp > 35:
-                weather_text += "\n🥵 Bahut garmi hai! Thanda paani piyo! 🥤"
-            elif temp < 10:
-                weather_text += "\n🥶 Thand hai! Garam kapde pehno! 🧣"
+    temp = data['main']['temp']
+    if temp > 35:
+        weather_text += "\n🥵 Bahut garmi hai! Thanda paani piyo! 🥤"
+    elif temp < 10:
+        weather_text += "\n🥶 Thand hai! Garam kapde pehno! 🧣"
+    else:
+        weather_text += "\n😎 Mausam mast hai! Bahar ghumne ka plan banao! 🚶‍♂️"
+    return weather_text, 'Markdown'
+
+def render_news(category, data):
+    if not data.get('articles'):
+        return f"📰 No articles in {category}\n\nTry: /news sports", None
+    
+    news_text = f"📢 **Top {category.title()} News:**\n\n"
+    for i, article in enumerate(data['articles'][:5], 1):
+        title = article.get('title', 'No title available').split(' - ')[0]
+        source = article.get('source', {}).get('name', 'Unknown')
+        
+        if title and title != '[Removed]':
+            news_text += f"**{i}.** {escape_md(title)}\n"
+            news_text += f"   _📰 Source: {escape_md(source)}_\n\n"
+    
+    if len(news_text) <= 100:
+        return f"📰 No recent news in {category}\n\nTry: /news technology", None
+    news_text += "🌐 _Stay updated with latest news!_"
+    return news_text, 'Markdown'
+
+# ========== PREFETCH ==========
+class Prefetcher:
+    """Keeps /news and /weather replies rendered ahead of time.
+
+    Rendered replies are remembered per cached API result, so each result
+    is turned into Markdown once no matter how many users ask for it. When
+    run from the job queue, refresh() reloads every news category and the
+    most requested cities before their cache entries expire, and the
+    commands answer straight from the rendered text without a
+    "Fetching..." round trip.
+    """
+
+    SOURCES = {
+        'weather': (weather_cache, fetch_weather, lambda key, data: render_weather(data)),
+        'news': (news_cache, fetch_news, render_news),
+    }
+
+    def __init__(self, top_cities, max_entries=CACHE_MAX_ENTRIES):
+        self.top_cities = top_cities
+        self.max_entries = max_entries
+        self.served = 0
+        self.refreshed = 0
+        self._city_requests = OrderedDict()
+        self._rendered = OrderedDict()
+
+    def note_city(self, city):
+        self._city_requests[city] = self._city_requests.get(city, 0) + 1
+        self._city_requests.move_to_end(city)
+        if len(self._city_requests) > self.max_entries:
+            self._city_requests.popitem(last=False)
+
+    def popular_cities(self):
+        return heapq.nlargest(self.top_cities, self._city_requests, key=self._city_requests.get)
+
+    def render(self, kind, key, data):
+        """(text, parse_mode) for an API result, rendered once per result."""
+        entry = self._rendered.get((kind, key))
+        if entry is not None and entry[0] is data:
+            return entry[1]
+        rendered = self.SOURCES[kind][2](key, data)
+        self._rendered[(kind, key)] = (data, rendered)
+        self._rendered.move_to_end((kind, key))
+        if len(self._rendered) > self.max_entries:
+            self._rendered.popitem(last=False)
+        return rendered
+
+    def ready(self, kind, key):
+        """The rendered reply if fresh data is cached, else None."""
+        data = self.SOURCES[kind][0].peek(key)
+        if data is None:
+            return None
+        self.served += 1
+        return self.render(kind, key, data)
+
+    async def load(self, kind, key, refresh=False):
+        """Fetches (or reuses) the data for one topic and renders it; None if the API had nothing."""
+        data = await self.SOURCES[kind][1](key, refresh=refresh)
+        return self.render(kind, key, data) if data is not None else None
+
+    async def refresh(self, context):
+        """Job queue callback: reloads every news category and the popular cities."""
+        topics = [('news', category) for category in NEWS_CATEGORIES]
+        topics += [('weather', city) for city in self.popular_cities()]
+        results = await asyncio.gather(
+            *(self.load(kind, key, refresh=True) for kind, key in topics), return_exceptions=True
+        )
+        for (kind, key), result in zip(topics, results):
+            if isinstance(result, Exception):
+                logger.warning(f"🔄 Prefetch of {kind} '{key}' failed: {result}")
             else:
-                weather_text += "\n😎 Mausam mast hai! Bahar ghumne ka plan banao! 🚶‍♂️"
-            
-            await update.message.reply_text(weather_text, parse_mode='Markdown')
-            
+                self.refreshed += 1
+
+prefetcher = Prefetcher(PREFETCH_TOP_CITIES)
+
+# ========== DIGESTS ==========
+class DigestSubscriptions:
+    """Chats subscribed to regular /weather or /news digests, by topic.
+
+    Topics are ('weather', city) or ('news', category), so each digest
+    run fetches and renders a topic once however many chats follow it.
+    Subscriptions are kept in memory and start empty after a restart.
+    """
+
+    def __init__(self, max_per_chat):
+        self.max_per_chat = max_per_chat
+        self.sent = 0
+        self._chats = {}
+        self._topics = {}
+
+    def __len__(self):
+        return sum(len(chats) for chats in self._topics.values())
+
+    def add(self, chat_id, topic):
+        """Returns False if the chat already has as many subscriptions as allowed."""
+        topics = self._topics.setdefault(chat_id, set())
+        if topic not in topics and len(topics) >= self.max_per_chat:
+            return False
+        topics.add(topic)
+        self._chats.setdefault(topic, set()).add(chat_id)
+        return True
+
+    def remove(self, chat_id, topic=None):
+        """Drops one subscription, or all of a chat's; returns how many were removed."""
+        topics = self._topics.get(chat_id, set())
+        removed = [topic] if topic in topics else ([] if topic else list(topics))
+        for each in removed:
+            topics.discard(each)
+            chats = self._chats.get(each)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self._chats[each]
+        if not topics:
+            self._topics.pop(chat_id, None)
+        return len(removed)
+
+    def topics(self, chat_id):
+        return sorted(self._topics.get(chat_id, ()))
+
+    async def send(self, context):
+        """Job queue callback: one fetch and render per topic, then a paced fan-out."""
+        for topic, chats in list(self._chats.items()):
+            kind, key = topic
+            try:
+                rendered = await prefetcher.load(kind, key)
+            except Exception as e:
+                logger.warning(f"📬 Digest for {kind} '{key}' failed: {e}")
+                continue
+            if rendered is None:
+                continue
+            text, parse_mode = rendered
+            blocked = await outbox.broadcast(context.bot, list(chats), text, parse_mode)
+            self.sent += len(chats) - len(blocked)
+            for chat_id in blocked:
+                self.remove(chat_id)
+
+digests = DigestSubscriptions(DIGEST_MAX_PER_CHAT)
+
+def _digest_topic(args):
+    """('news', category) or ('weather', city) from /subscribe arguments, or None."""
+    if not args or args[0].lower() not in ('news', 'weather'):
+        return None
+    kind, rest = args[0].lower(), " ".join(args[1:])
+    if kind == 'news':
+        category = rest.lower() or "general"
+        return (kind, category) if category in NEWS_CATEGORIES else None
+    return (kind, _normalize_city(rest)) if rest.strip() else None
+
+def _describe_topic(topic):
+    kind, key = topic
+    return f"📰 news: {key}" if kind == 'news' else f"🌤️ weather: {key.title()}"
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    if DIGEST_INTERVAL <= 0 or context.application.job_queue is None:
+        await outbox.reply(update.message, "ℹ️ Digests are not enabled on this bot.")
+        return
+    
+    topic = _digest_topic(context.args)
+    if topic is None:
+        current = "\n".join(f"• {_describe_topic(each)}" for each in digests.topics(chat_id)) or "• none yet"
+        await outbox.reply(
+            update.message,
+            f"📬 Usage: /subscribe news [category] or /subscribe weather <city>\n\nYour digests:\n{current}"
+        )
+        return
+    
+    if not digests.add(chat_id, topic):
+        await outbox.reply(update.message, f"❌ You can follow at most {DIGEST_MAX_PER_CHAT} digests. Try /unsubscribe first.")
+        return
+    every = f"{DIGEST_INTERVAL / 3600:g}h" if DIGEST_INTERVAL >= 3600 else f"{DIGEST_INTERVAL / 60:g} min"
+    await outbox.reply(update.message, f"✅ Subscribed to {_describe_topic(topic)}, every {every}.")
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Only a bare /unsubscribe means "all"; a topic that doesn't parse removes nothing
+    topic = _digest_topic(context.args)
+    if context.args and topic is None:
+        await outbox.reply(
+            update.message,
+            "📬 Usage: /unsubscribe news [category], /unsubscribe weather <city>, or /unsubscribe for all"
+        )
+        return
+    removed = digests.remove(update.message.chat_id, topic)
+    if removed:
+        await outbox.reply(update.message, f"🧹 Removed {removed} digest subscription(s).")
+    else:
+        await outbox.reply(update.message, "ℹ️ No matching digest subscriptions.")
+
+def schedule_jobs(application):
+    """Puts prefetch and digests on PTB's job queue (needs python-telegram-bot[job-queue])."""
+    if PREFETCH_INTERVAL <= 0 and DIGEST_INTERVAL <= 0:
+        return
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.warning('⚠️ JobQueue unavailable (pip install "python-telegram-bot[job-queue]"), prefetch and digests are off')
+        return
+    if PREFETCH_INTERVAL > 0:
+        job_queue.run_repeating(prefetcher.refresh, interval=PREFETCH_INTERVAL, first=0, name="prefetch")
+    if DIGEST_INTERVAL > 0:
+        job_queue.run_repeating(digests.send, interval=DIGEST_INTERVAL, first=DIGEST_INTERVAL, name="digests")
+
+# ========== WEATHER COMMAND ==========
+@timed_handler("weather_command")
+async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        city = " ".join(context.args) if context.args else "Mumbai"
+        key = _normalize_city(city)
+        prefetcher.note_city(key)
+        
+        rendered = prefetcher.ready('weather', key)
+        if rendered is None:
+            await outbox.reply(update.message, f"🌤️ Checking weather for {city}...")
+            await outbox.typing(update.message.chat)
+            rendered = await prefetcher.load('weather', key)
+        
+        if rendered is not None:
+            text, parse_mode = rendered
+            await outbox.reply(update.message, text, parse_mode=parse_mode)
         else:
-            await update.message.reply_text(f"❌ Could not find weather for '{city}'\n\nTry: /weather Mumbai")
+            await outbox.reply(update.message, f"❌ Could not find weather for '{city}'\n\nTry: /weather Mumbai")
             
     except Exception as e:
-        await update.message.reply_text("❌ Weather service unavailable")
+        await outbox.reply(update.message, "❌ Weather service unavailable")
 
 # ========== NEWS COMMAND ==========
+@timed_handler("news_command")
 async def news_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        category = " ".join(context.args) if context.args else "general"
-        valid_categories = ['general', 'technology', 'sports', 'business', 'entertainment', 'science', 'health']
+        category = " ".join(context.args).lower() if context.args else "general"
         
-        if category.lower() not in valid_categories:
+        if category not in NEWS_CATEGORIES:
             category = "general"
         
-        await update.message.reply_text(f"📡 Fetching {category} news...")
-        await update.message.chat.send_action(action="typing")
-        
-        url = f"https://newsapi.org/v2/top-headlines?country=in&category={category}&pageSize=5&apiKey={NEWS_API_KEY}"
-        response = requests.get(url, timeout=15)
+        rendered = prefetcher.ready('news', category)
+        if rendered is None:
+            await outbox.reply(update.message, f"📡 Fetching {category} news...")
+            await outbox.typing(update.message.chat)
+            rendered = await prefetcher.load('news', category)
         
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('articles'):
-                news_text = f"📢 **Top {category.title()} News:**\n\n"
-                
-                for i, article in enumerate(data['articles'][:5], 1):
-                    title = article.get('title', 'No title available').split(' - ')[0]
-                    source = article.get('source', {}).get('name', 'Unknown')
-                    
-                    if title and title != '[Removed]':
-                        news_text += f"**{i}.** {title}\n"
-                        news_text += f"   _📰 Source: {source}_\n\n"
-                
-                if len(news_text) > 100:
-                    news_text += "🌐 _Stay updated with latest news!_"
-                    await update.message.reply_text(news_text, parse_mode='Markdown')
-                else:
-                    await update.message.reply_text(f"📰 No recent news in {category}\n\nTry: /news technology")
-            else:
-                await update.message.reply_text(f"📰 No articles in {category}\n\nTry: /news sports")
+        if rendered is not None:
+            text, parse_mode = rendered
+            await outbox.reply(update.message, text, parse_mode=parse_mode)
         else:
-            await update.message.reply_text("❌ News service busy\n\nTry again in 2 minutes! ⏰")
+            await outbox.reply(update.message, "❌ News service busy\n\nTry again in 2 minutes! ⏰")
             
     except Exception as e:
-        await update.message.reply_text("❌ News service temporarily down")
+        await outbox.reply(update.message, "❌ News service temporarily down")
 
 # ========== START COMMAND ==========
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_name = update.message.from_user.first_name
-    gemini_status = "✅ Available" if GEMINI_API_KEY else "❌ Not configured"
-    
-    welcome_text = f"""
-🎉 **Hello {user_name}!** 
-
-🤖 **I'm MeraAI - Now with Google Gemini!**
-
-✨ **AI Options:**
-• 🧠 `/gemini` - Google Gemini (High Quality)
-• ⚡ `/ai` - Groq AI (Ultra Fast)  
-• 💬 Normal chat - Auto smart selection
-
-🛠 **Other Features:**
-• 🌤️ Weather updates
-• 📰 Latest news  
-• 🧠 Conversation memory
-• 😊 Friendly personality
-
-🔧 **Commands:**
-/start - This message
-/help - Full guide
-/weather [city] - Weather
-/news [category] - News
-/gemini [question] - Gemini AI
-/ai [message] - Groq AI
-/clear - Clear memory
-
-🚀 **Gemini Status:** {gemini_status}
-
-**Let's chat! I'll remember our conversation!** 😊
-"""
-    await update.message.reply_text(welcome_text, parse_mode='Markdown')
+    user_name = escape_md(update.message.from_user.first_name)
+    await outbox.reply(update.message, START_TEMPLATE.format(user_name=user_name), parse_mode='Markdown')
 
 # ========== HELP COMMAND ==========
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
-🆘 **MeraAI Help Guide**
-
-🎯 **AI Chat Options:**
-• **Normal Chat** - I automatically choose best AI
-• **/gemini** - Google Gemini (Highest quality)
-• **/ai** - Groq AI (Fastest responses)
-
-📝 **All Commands:**
-/start - Welcome message
-/help - This guide
-/weather [city] - Weather
-/news [category] - News
-/gemini [question] - Gemini AI
-/ai [message] - Groq AI
-/clear - Clear memory
-/stats - Conversation stats
-
-🌐 **News Categories:**
-technology, sports, business, entertainment, science, health, general
-
-💡 **Pro Tip:** Use `/gemini` for complex questions and `/ai` for quick chats!
-
-🚀 **Now with dual AI power!**
-"""
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await outbox.reply(update.message, HELP_TEXT, parse_mode='Markdown')
 
 # ========== CLEAR MEMORY COMMAND ==========
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     user_name = update.message.from_user.first_name
     
-    if user_id in user_sessions:
-        del user_sessions[user_id]
-        await update.message.reply_text(f"🧹 **Memory cleared!**\n\nHey {user_name}! Fresh start! 😊\n\nWhat would you like to talk about?")
+    if clear_user_session(user_id):
+        await outbox.reply(update.message, f"🧹 **Memory cleared!**\n\nHey {user_name}! Fresh start! 😊\n\nWhat would you like to talk about?")
     else:
-        await update.message.reply_text("ℹ️ No active conversation to clear.\n\nLet's start chatting! 💬")
+        await outbox.reply(update.message, "ℹ️ No active conversation to clear.\n\nLet's start chatting! 💬")
 
 # ========== STATS COMMAND ==========
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    user_name = update.message.from_user.first_name
+    user_name = escape_md(update.message.from_user.first_name)
     
-    if user_id in user_sessions:
-        session = user_sessions[user_id]
-        message_count = session.get('message_count', 0)
-        preferred_ai = session.get('preferred_ai', 'gemini').upper()
+    session = user_sessions.get(user_id) or await session_backend.load(user_id)
+    if session is not None:
+        message_count = session.message_count
+        preferred_ai = session.preferred_ai.upper()
         
         stats_text = f"""
 📊 **Your Conversation Stats**
@@ -535,7 +3137,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 👤 **User:** {user_name}
 💬 **Messages exchanged:** {message_count}
 🧠 **Preferred AI:** {preferred_ai}
-🕒 **Active since:** {session['last_activity'].strftime('%I:%M %p')}
+🕒 **Active since:** {datetime.fromtimestamp(session.last_activity).strftime('%I:%M %p')}
 
 🎯 **Keep chatting! I'm learning more about you!**
 """
@@ -550,26 +3152,629 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💡 **Start chatting to build our conversation memory!**
 """
     
-    await update.message.reply_text(stats_text, parse_mode='Markdown')
+    await outbox.reply(update.message, stats_text, parse_mode='Markdown')
+
+# ========== ADMIN STATS COMMAND ==========
+def _latency_summary(hist):
+    if not hist.recent:
+        return "no data"
+    return f"p50 {hist.quantile(0.5) * 1000:.0f}ms, p95 {hist.quantile(0.95) * 1000:.0f}ms, n={hist.total}"
+
+def _hit_rate(hits, misses):
+    total = hits + misses
+    return f"{hits / total:.0%}" if total else "n/a"
+
+async def botstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id not in ADMIN_USER_IDS:
+        await outbox.reply(update.message, "🔒 This command is for bot admins only.")
+        return
+    
+    lines = ["📈 **Bot Stats**", ""]
+    
+    lines.append(f"👥 **Sessions:** {len(user_sessions)} active, {user_sessions.expired} expired, {user_sessions.evicted} evicted")
+    
+    lines.append("")
+    lines.append("⏱️ **Handlers:**")
+    for labels, hist in metrics.series("handler_seconds").items():
+        lines.append(f"• `{dict(labels)['handler']}`: {_latency_summary(hist)}")
+    for labels, hist in metrics.series("time_to_first_reply_seconds").items():
+        lines.append(f"• first reply (`{dict(labels)['handler']}`): {_latency_summary(hist)}")
+    
+    lines.append("")
+    lines.append("🤖 **Providers:**")
+    for labels, hist in metrics.series("provider_call_seconds").items():
+        label = dict(labels)
+        errors = metrics.counter_value("provider_errors_total", **label)
+        lines.append(f"• `{label['provider']}/{label['model']}`: {_latency_summary(hist)}, {errors} errors")
+    
+    lines.append("")
+    lines.append("🗄️ **Caches:**")
+    for name, cache in (("weather", weather_cache), ("news", news_cache)):
+        stats = cache.stats()
+        lines.append(f"• {name}: {_hit_rate(stats['hits'] + stats['stale_hits'] + stats['coalesced'], stats['misses'])} hit rate, {stats['size']} entries")
+    for name, cache in (("ai answers", ai_answer_cache), ("gemini answers", gemini_answer_cache)):
+        stats = cache.stats()
+        lines.append(f"• {name}: {_hit_rate(stats['hits'] + stats['similar_hits'], stats['misses'])} hit rate, {stats['size']} entries")
+    lines.append(f"• prefetched replies served: {prefetcher.served}, topics refreshed: {prefetcher.refreshed}")
+    lines.append(f"📬 **Digests:** {len(digests)} subscriptions, {digests.sent} sent")
+    
+    gemini_load = gemini_gate.stats()
+    admitted = admission.stats()
+    sends = outbox.stats()
+    lines.append("")
+    lines.append(f"🚦 **Gemini load:** {gemini_load['in_flight']} running, {gemini_load['queued']} waiting, {gemini_load['rejected']} rejected")
+    lines.append(f"🚦 **Admission:** {admitted['active']} active, {admitted['queued']} queued, {admitted['shed']} shed")
+    lines.append(f"📤 **Outbox:** {sends['sent']} sent, {sends['dropped']} dropped, {sends['flood_waits']} flood waits")
+    if update_processor is not None:
+        updates = update_processor.stats()
+        lines.append(f"📥 **Updates:** {updates['active']} of {updates['workers']} workers busy, {updates['chats_pending']} chats pending")
+        deepest = [(chat_id, depth) for chat_id, depth in update_processor.chat_depths(5) if depth > 1]
+        if deepest:
+            lines.append("• deepest chats: " + ", ".join(f"`{chat_id}` ({depth})" for chat_id, depth in deepest))
+    
+    unhealthy = [breaker for _, breaker in breakers.items() if breaker.state != CircuitBreaker.CLOSED]
+    if unhealthy:
+        lines.append("🔌 **Open circuits:** " + ", ".join(f"`{breaker.name}` ({breaker.state})" for breaker in unhealthy))
+    else:
+        lines.append("🔌 **Circuits:** all closed")
+    
+    await outbox.reply_long(update.message, "\n".join(lines), parse_mode='Markdown')
+
+# ========== UPDATE DISPATCH ==========
+class _ChatLane:
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, one at a time per chat.
+
+    Each chat gets a lane (a FIFO lock) that exists only while it has
+    updates pending. The worker limit is applied after an update reaches
+    the head of its lane: PTB's own semaphore is taken first, so one busy
+    chat's backlog would otherwise hold every slot while it sat waiting
+    on its own lane.
+    """
+
+    def __init__(self, workers, backlog_per_worker=16):
+        super().__init__(max_concurrent_updates=workers * backlog_per_worker)
+        self.workers = workers
+        self.active = 0
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._lanes = {}
+
+    def stats(self):
+        depths = [lane.depth for lane in self._lanes.values()]
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'chats_pending': len(depths),
+            'max_chat_depth': max(depths, default=0)
+        }
+
+    def chat_depths(self, limit=10):
+        """The chats with the most pending updates, deepest first."""
+        depths = sorted(((lane.depth, chat_id) for chat_id, lane in self._lanes.items()), reverse=True)
+        return [(chat_id, depth) for depth, chat_id in depths[:limit]]
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._worker_slots:
+                await self._run(coroutine)
+            return
+        
+        lane = self._lanes.get(chat.id)
+        if lane is None:
+            lane = self._lanes[chat.id] = _ChatLane()
+        lane.depth += 1
+        try:
+            async with lane.lock:
+                async with self._worker_slots:
+                    await self._run(coroutine)
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0:
+                del self._lanes[chat.id]
+
+    async def _run(self, coroutine):
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# AI handlers hold their worker slot while they wait in admission control. With
+# fewer slots than admission can run and queue, those waits would fill every
+# worker: admission's per-user queue would never form and /weather or /news
+# would sit behind AI requests, so each of those gets a slot of its own.
+update_processor = (
+    ChatOrderedUpdateProcessor(UPDATE_WORKERS + MAX_CONCURRENT_AI + MAX_QUEUED_AI) if UPDATE_WORKERS > 1 else None
+)
+
+# ========== WEBHOOK SERVER ==========
+class HttpRequest:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+class HttpServer:
+    """Small asyncio HTTP/1.1 server for the webhook and local admin endpoints.
+
+    Handlers take an HttpRequest and return (status, content_type, body).
+    stop() closes the listener first and then waits for requests already
+    being handled, so a shutdown never cuts off an update mid-delivery.
+    """
+
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+               503: "Service Unavailable"}
+
+    def __init__(self, host, port, max_body=1 << 20, keepalive=75):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.keepalive = keepalive
+        self.routes = {}
+        self._server = None
+        self._connections = {}
+        self._busy = 0
+        self._stopping = False
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"🌐 HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self, timeout=10):
+        self._stopping = True
+        if self._server is not None:
+            self._server.close()
+        deadline = time.monotonic() + timeout
+        while self._busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        # Whatever is left is idle keep-alive connections
+        for task, writer in list(self._connections.items()):
+            task.cancel()
+            writer.close()
+        if self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while not self._stopping:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                
+                lines = head.decode('latin-1').split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                path, _, query = target.partition("?")
+                
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, "text/plain", b"bad content-length", close=True)
+                    break
+                if length > self.max_body:
+                    await self._respond(writer, 413, "text/plain", b"too large", close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                self._busy += 1
+                try:
+                    status, content_type, payload = await self._dispatch(HttpRequest(method, path, query, headers, body))
+                finally:
+                    self._busy -= 1
+                await self._respond(writer, status, content_type, payload, close=not keep_alive or self._stopping)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return 405, "text/plain", b"method not allowed"
+            return 404, "text/plain", b"not found"
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"💥 HTTP handler error on {request.path}: {e}")
+            return 500, "text/plain", b"error"
+
+    async def _respond(self, writer, status, content_type, payload, close=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+
+def webhook_handler(application, secret=None):
+    """Accepts Telegram updates and queues them for the application."""
+    async def handle(request):
+        if secret and request.headers.get("x-telegram-bot-api-secret-token") != secret:
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception:
+            return 400, "text/plain", b"bad update"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    return handle
+
+async def run_webhook(application):
+    """Serves updates over a webhook until SIGINT/SIGTERM, then drains and exits."""
+    server = HttpServer(WEBHOOK_HOST, WEBHOOK_PORT)
+    server.route("POST", WEBHOOK_PATH, webhook_handler(application, WEBHOOK_SECRET))
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    # run_webhook()/run_polling() would call these hooks; we drive the application ourselves
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    await server.start()
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        allowed_updates=Update.ALL_TYPES
+    )
+    logger.info(f"🪝 Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    
+    try:
+        await stop.wait()
+    finally:
+        # Stop taking updates, finish the ones already queued, then tear down.
+        # The webhook stays registered so Telegram holds new updates for the next start.
+        logger.info("🛑 Draining pending updates...")
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+# ========== METRICS ENDPOINT ==========
+def _cache_requests():
+    samples = []
+    for name, cache in (("weather", weather_cache), ("news", news_cache)):
+        stats = cache.stats()
+        for result in ('hits', 'stale_hits', 'misses', 'coalesced'):
+            samples.append(({'cache': name, 'result': result}, stats[result]))
+    for name, cache in (("ai_answers", ai_answer_cache), ("gemini_answers", gemini_answer_cache)):
+        stats = cache.stats()
+        for result in ('hits', 'similar_hits', 'misses'):
+            samples.append(({'cache': name, 'result': result}, stats[result]))
+    return samples
+
+_CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+def _cache_entries():
+    caches = (("weather", weather_cache), ("news", news_cache),
+              ("ai_answers", ai_answer_cache), ("gemini_answers", gemini_answer_cache))
+    return [({'cache': name}, cache.stats()['size']) for name, cache in caches]
+
+metrics.collect("sessions", "gauge", "Sessions held in memory", lambda: len(user_sessions))
+metrics.collect("sessions_expired_total", "counter", "Sessions dropped after SESSION_TTL", lambda: user_sessions.expired)
+metrics.collect("sessions_evicted_total", "counter", "Sessions dropped to stay under SESSION_MAX", lambda: user_sessions.evicted)
+metrics.collect("sessions_packed_total", "counter", "Idle session histories compressed", lambda: user_sessions.packed)
+metrics.collect("cache_requests_total", "counter", "Cache lookups by result", _cache_requests)
+metrics.collect("cache_entries", "gauge", "Entries held per cache", _cache_entries)
+metrics.collect("prefetch_served_total", "counter", "/news and /weather replies answered from prefetched text", lambda: prefetcher.served)
+metrics.collect("prefetch_refreshed_total", "counter", "Topics reloaded by the prefetch job", lambda: prefetcher.refreshed)
+metrics.collect("digest_subscriptions", "gauge", "Digest subscriptions across all chats", lambda: len(digests))
+metrics.collect("digests_sent_total", "counter", "Digest messages delivered", lambda: digests.sent)
+metrics.collect("provider_first_response_seconds", "histogram", "Time until a routed provider call answered, failed or was cancelled",
+                lambda: [({'provider': name}, hist) for name, hist in chat_router.latency.items()])
+metrics.collect("router_failures_total", "counter", "Routed provider attempts that gave no answer",
+                lambda: [({'provider': name}, count) for name, count in chat_router.errors.items()])
+metrics.collect("router_rejections_total", "counter", "Routed provider attempts refused before calling the provider",
+                lambda: [({'provider': name}, count) for name, count in chat_router.rejected.items()])
+metrics.collect("gemini_in_flight", "gauge", "Gemini calls running", lambda: gemini_gate.stats()['in_flight'])
+metrics.collect("gemini_queued", "gauge", "Gemini calls waiting for a slot", lambda: gemini_gate.stats()['queued'])
+metrics.collect("gemini_rejected_total", "counter", "Gemini calls shed by the gate", lambda: gemini_gate.stats()['rejected'])
+metrics.collect("groq_in_flight", "gauge", "Groq calls running", lambda: groq_in_flight)
+metrics.collect("admission_active", "gauge", "AI requests holding a slot", lambda: admission.stats()['active'])
+metrics.collect("admission_queued", "gauge", "AI requests waiting for a slot", lambda: admission.stats()['queued'])
+metrics.collect("admission_shed_total", "counter", "AI requests turned away", lambda: admission.stats()['shed'])
+metrics.collect("telegram_sent_total", "counter", "Telegram calls made by the outbox", lambda: outbox.stats()['sent'])
+metrics.collect("telegram_dropped_total", "counter", "Optional Telegram calls skipped", lambda: outbox.stats()['dropped'])
+metrics.collect("telegram_flood_waits_total", "counter", "RetryAfter responses from Telegram", lambda: outbox.stats()['flood_waits'])
+metrics.collect("circuit_state", "gauge", "Circuit per upstream: 0 closed, 1 half-open, 2 open",
+                lambda: [({'provider': provider, 'model': model}, _CIRCUIT_STATES[breaker.state])
+                         for (provider, model), breaker in breakers.items()])
+metrics.collect("circuit_opened_total", "counter", "Times each circuit opened",
+                lambda: [({'provider': provider, 'model': model}, breaker.opened)
+                         for (provider, model), breaker in breakers.items()])
+metrics.collect("circuit_rejected_total", "counter", "Calls failed fast by an open circuit",
+                lambda: [({'provider': provider, 'model': model}, breaker.rejected)
+                         for (provider, model), breaker in breakers.items()])
+if groq_batcher is not None:
+    metrics.collect("groq_batches_total", "counter", "Groq micro-batches sent", lambda: groq_batcher.batches)
+    metrics.collect("groq_batched_requests_total", "counter", "Groq calls that went through a batch", lambda: groq_batcher.requests)
+    metrics.collect("groq_coalesced_requests_total", "counter", "Batched Groq calls answered by an identical request", lambda: groq_batcher.coalesced)
+if update_processor is not None:
+    metrics.collect("updates_active", "gauge", "Updates being handled", lambda: update_processor.stats()['active'])
+    metrics.collect("chats_pending", "gauge", "Chats with updates waiting", lambda: update_processor.stats()['chats_pending'])
+    metrics.collect("max_chat_depth", "gauge", "Longest per-chat update queue", lambda: update_processor.stats()['max_chat_depth'])
+    metrics.collect("chat_queue_depth", "gauge", "Pending updates for the ten busiest chats",
+                    lambda: [({'chat': chat_id}, depth) for chat_id, depth in update_processor.chat_depths()])
+
+async def metrics_handler(request):
+    return 200, "text/plain; version=0.0.4", metrics.render()
+
+async def start_metrics_server(port):
+    server = HttpServer(METRICS_HOST, port)
+    server.route("GET", "/metrics", metrics_handler)
+    try:
+        await server.start()
+    except OSError as e:
+        logger.warning(f"📈 Metrics endpoint not started on {METRICS_HOST}:{port}: {e}")
+        return None
+    return server
+
+# ========== SHARDED WORKERS ==========
+# The front process only receives webhooks. Each update is routed by
+# chat_id % SHARD_WORKERS to a worker process over a socketpair, framed
+# as a 4-byte length followed by the raw update JSON. A chat always lands
+# on the same worker, so its updates stay in order without shared state.
+#
+# Sessions are keyed by user, though, not by chat. In a private chat the two
+# are the same; a user who also talks to the bot in a group has that group's
+# updates handled by whichever worker owns the group, so they end up with a
+# separate session (history, preferred AI) in each process. A shared
+# SESSION_BACKEND doesn't merge them: each worker keeps its own copy in
+# memory and the last flush wins. Per-user and per-provider rate limits are
+# likewise kept per worker.
+_FRAME_HEADER = struct.Struct(">I")
+
+def update_chat_id(data):
+    """Finds the chat an update belongs to without building an Update object."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        sender = value.get('from')
+        if sender:
+            return sender['id']
+    return 0
+
+def shard_for(chat_id, shards):
+    return chat_id % shards
+
+async def run_shard_worker(index, sock):
+    application = build_application()
+    application.bot_data['shard'] = index
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    reader, writer = await asyncio.open_connection(sock=sock)
+    logger.info(f"🧩 Shard {index} ready")
+    
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(_FRAME_HEADER.size)
+                body = await reader.readexactly(_FRAME_HEADER.unpack(header)[0])
+            except asyncio.IncompleteReadError:
+                # The front closed our channel: it is shutting down
+                break
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except Exception as e:
+                logger.error(f"🧩 Shard {index} got a bad update: {e}")
+                continue
+            await application.update_queue.put(update)
+    finally:
+        logger.info(f"🧩 Shard {index} draining...")
+        writer.close()
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+def _shard_worker_main(index, sock):
+    # Ctrl+C reaches the whole process group; let the front decide when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if GEMINI_DISCOVERY == 'blocking':
+        discover_gemini_models()
+    asyncio.run(run_shard_worker(index, sock))
+
+def shard_router(writers, secret=None):
+    """Webhook handler that forwards each raw update to its chat's shard."""
+    async def handle(request):
+        if secret and request.headers.get("x-telegram-bot-api-secret-token") != secret:
+            return 403, "text/plain", b"forbidden"
+        try:
+            chat_id = update_chat_id(json.loads(request.body))
+        except Exception:
+            return 400, "text/plain", b"bad update"
+        writer = writers[shard_for(chat_id, len(writers))]
+        writer.write(_FRAME_HEADER.pack(len(request.body)) + request.body)
+        # Waiting for the worker to take it gives Telegram natural backpressure
+        await writer.drain()
+        return 200, "text/plain", b"ok"
+    return handle
+
+async def run_shard_front(sockets):
+    writers = []
+    for sock in sockets:
+        _, writer = await asyncio.open_connection(sock=sock)
+        writers.append(writer)
+    
+    server = HttpServer(WEBHOOK_HOST, WEBHOOK_PORT)
+    server.route("POST", WEBHOOK_PATH, shard_router(writers, WEBHOOK_SECRET))
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    await server.start()
+    async with Bot(TELEGRAM_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot") as bot:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            allowed_updates=Update.ALL_TYPES
+        )
+    logger.info(f"🪝 Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH} ({len(writers)} shards)")
+    
+    try:
+        await stop.wait()
+    finally:
+        logger.info("🛑 Stopping front, shards will drain...")
+        await server.stop()
+        for writer in writers:
+            writer.close()
+
+def run_sharded(workers):
+    # spawn, not fork: the gRPC client behind the Gemini SDK does not survive fork
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    processes, sockets = [], []
+    for index in range(workers):
+        front_sock, worker_sock = socket.socketpair()
+        process = context.Process(
+            target=_shard_worker_main, args=(index, worker_sock), name=f"meraai-shard-{index}"
+        )
+        process.start()
+        worker_sock.close()
+        processes.append(process)
+        sockets.append(front_sock)
+    
+    try:
+        asyncio.run(run_shard_front(sockets))
+    finally:
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                logger.warning(f"⚠️ {process.name} did not drain in time, terminating")
+                process.terminate()
+
+# ========== LIFECYCLE ==========
+async def post_init(application):
+    global session_backend
+    if GEMINI_API_KEY and GEMINI_DISCOVERY != 'blocking':
+        application.bot_data['gemini_discovery'] = asyncio.get_running_loop().create_task(
+            discover_gemini_models_later()
+        )
+    session_backend = create_session_backend()
+    session_backend.start()
+    history_summarizer.start()
+    if HISTORY_PACK_AFTER > 0:
+        application.bot_data['history_packer'] = asyncio.get_running_loop().create_task(
+            pack_idle_sessions(HISTORY_PACK_AFTER)
+        )
+    schedule_jobs(application)
+    if METRICS_PORT > 0:
+        application.bot_data['metrics_server'] = await start_metrics_server(
+            METRICS_PORT + application.bot_data.get('shard', 0)
+        )
+
+async def post_shutdown(application):
+    discovery = application.bot_data.pop('gemini_discovery', None)
+    if discovery is not None:
+        discovery.cancel()
+    packer = application.bot_data.pop('history_packer', None)
+    if packer is not None:
+        packer.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await history_summarizer.stop()
+    await session_backend.stop()
+    await close_http_client()
 
 # ========== MAIN FUNCTION ==========
-def main():
-    # Temporary model check - ADD THIS
+def _list_gemini_models():
+    # Blocking: imports the SDK and makes a network call
+    available_models = []
+    for model in get_genai().list_models():
+        if 'gemini' in model.name.lower() and 'generateContent' in model.supported_generation_methods:
+            available_models.append(model.name)
+            logger.info(f"🔍 Found model: {model.name}")
+    return available_models
+
+def _use_gemini_models(available_models):
+    if available_models:
+        logger.info(f"✅ Available Gemini models: {available_models}")
+        gemini_models.set_available(available_models)
+    else:
+        logger.error("❌ No Gemini models found!")
+
+def discover_gemini_models():
+    if not GEMINI_API_KEY:
+        return
+    try:
+        _use_gemini_models(_list_gemini_models())
+    except Exception as e:
+        logger.error(f"❌ Error checking models: {e}")
+
+async def discover_gemini_models_later():
+    """Loads the Gemini SDK and discovers models off the event loop while the bot already serves.
+
+    Until discovery finishes, replies use the default GEMINI_MODELS order.
+    """
     try:
-        available_models = []
-        for model in genai.list_models():
-            if 'gemini' in model.name.lower():
-                available_models.append(model.name)
-                logger.info(f"🔍 Found model: {model.name}")
-        
-        if available_models:
-            logger.info(f"✅ Available Gemini models: {available_models}")
+        if GEMINI_DISCOVERY == 'off':
+            await asyncio.to_thread(get_genai)
         else:
-            logger.error("❌ No Gemini models found!")
+            _use_gemini_models(await asyncio.to_thread(_list_gemini_models))
     except Exception as e:
         logger.error(f"❌ Error checking models: {e}")
-    
-    # Rest of your main function...
+
+def main():
     logger.info("🚀 Starting MeraAI with Google Gemini...")
     
     # Log AI status
@@ -583,7 +3788,34 @@ def main():
     else:
         logger.warning("❌ Groq AI: Not configured")
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if WEBHOOK_URL and SHARD_WORKERS > 1:
+        logger.info(f"🤖 MeraAI starting {SHARD_WORKERS} shard workers (webhook mode)")
+        run_sharded(SHARD_WORKERS)
+        return
+    
+    if GEMINI_DISCOVERY == 'blocking':
+        discover_gemini_models()
+    application = build_application()
+    
+    if WEBHOOK_URL:
+        logger.info("🤖 MeraAI with Gemini started successfully! (webhook mode)")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("🤖 MeraAI with Gemini started successfully!")
+        application.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
+
+def build_application():
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if update_processor is not None:
+        builder = builder.concurrent_updates(update_processor)
+    application = builder.build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -592,14 +3824,15 @@ def main():
     application.add_handler(CommandHandler("news", news_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("botstats", botstats_command))
     application.add_handler(CommandHandler("gemini", gemini_command))
     application.add_handler(CommandHandler("ai", ai_command))
+    application.add_handler(CommandHandler("subscribe", subscribe_command))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
     
     # Add message handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
-    logger.info("🤖 MeraAI with Gemini started successfully!")
-    application.run_polling(drop_pending_updates=True)
+    return application
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,1275 @@
+"""Offline load test and benchmark harness for MeraAI.
+
+Runs the bot against local stand-ins for every upstream: a fake Telegram Bot
+API, plus Groq, Gemini (gRPC), OpenWeatherMap and NewsAPI stubs with
+configurable latency and error rates. Synthetic users then drive
+handle_message and every command. Nothing leaves the machine.
+
+    python loadtest.py traffic --users 200 --duration 60
+    python loadtest.py traffic --stub groq:latency=0.6,errors=0.05 --stub gemini:outage=10-25
+    python loadtest.py traffic --transport webhook
+    python loadtest.py sessions --sessions 100000
+    python loadtest.py lookup --sizes 100000,300000,1000000
+    python loadtest.py context --history 8,40,200
+    python loadtest.py render
+    python loadtest.py batching --rate 100 --windows 0,10,25
+    python loadtest.py startup
+    python loadtest.py sharded --shards 1,2,4 --users 300 --think 0.5
+    python loadtest.py all --compare          # check against loadtest_baseline.json
+    python loadtest.py all --save-baseline    # record a new baseline
+
+Bot settings can be changed through the environment as usual, e.g.
+`ROUTING_POLICY=hedged python loadtest.py traffic`. The harness only fills in
+endpoints, fake keys and a higher global Telegram send rate (so the outbox
+pacing doesn't hide everything else; see --telegram-rate).
+
+Stubs run in a separate process so their CPU time doesn't count against the
+bot. Upstream latency is log-normal around the given median; `errors` is the
+chance of an HTTP 500 / gRPC UNAVAILABLE, and `outage=START-END` fails every
+call in that window (seconds into the run), e.g. to watch circuit breakers.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+TOKEN = "123456:loadtest"
+
+# ========== UPSTREAM STUBS ==========
+# Each upstream gets its own loopback address so the bot's per-host
+# connection limits apply the same way they do against the real services
+STUB_HOSTS = {'groq': "127.0.0.2", 'weather': "127.0.0.3", 'news': "127.0.0.4", 'gemini': "127.0.0.5"}
+
+DEFAULT_STUBS = {
+    'groq': {'latency': 0.35, 'sigma': 0.4, 'errors': 0.0, 'ttft': 0.25},
+    'gemini': {'latency': 0.8, 'sigma': 0.4, 'errors': 0.0, 'ttft': 0.3},
+    'weather': {'latency': 0.15, 'sigma': 0.3, 'errors': 0.0},
+    'news': {'latency': 0.25, 'sigma': 0.3, 'errors': 0.0},
+}
+
+GRPC_SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+REPLY_WORDS = ("Bilkul", "yaar", "ye", "bahut", "simple", "hai", "😊", "pehle", "samjho", "ki", "AI",
+               "kaise", "kaam", "karta", "hai", "**step", "by", "step**", "🚀", "aur", "phir", "try", "karo")
+
+def parse_stub_spec(spec):
+    """'groq:latency=0.5,errors=0.1,outage=10-20' -> ('groq', {...})"""
+    name, _, options = spec.partition(":")
+    if name not in DEFAULT_STUBS:
+        raise argparse.ArgumentTypeError(f"unknown upstream '{name}', expected one of {', '.join(DEFAULT_STUBS)}")
+    settings = {}
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        if key == "outage":
+            start, _, end = value.partition("-")
+            settings[key] = (float(start), float(end))
+        elif key in ('latency', 'sigma', 'errors', 'ttft'):
+            settings[key] = float(value)
+        else:
+            raise argparse.ArgumentTypeError(f"unknown stub option '{key}'")
+    return name, settings
+
+class Behaviour:
+    """Latency and failure model for one stubbed upstream."""
+
+    def __init__(self, latency, sigma, errors, ttft=0.3, outage=None):
+        self.latency = latency
+        self.sigma = sigma
+        self.errors = errors
+        self.ttft = ttft
+        self.outage = outage
+        self.rng = random.Random()
+
+    def delay(self):
+        return self.latency * math.exp(self.rng.gauss(0, self.sigma))
+
+    def fails(self, elapsed):
+        if self.outage and self.outage[0] <= elapsed < self.outage[1]:
+            return True
+        return self.rng.random() < self.errors
+
+def _reply_text(rng, words=60):
+    return " ".join(rng.choice(REPLY_WORDS) for _ in range(words))
+
+class UpstreamStubs:
+    """Groq, OpenWeatherMap and NewsAPI over HTTP/1.1 and Gemini over gRPC, in one event loop."""
+
+    def __init__(self, settings):
+        self.behaviours = {name: Behaviour(**values) for name, values in settings.items()}
+        self.counts = {name: {'calls': 0, 'errors': 0} for name in settings}
+        self.started = time.monotonic()
+        self.rng = random.Random(1)
+
+    def _begin(self, name):
+        self.counts[name]['calls'] += 1
+        behaviour = self.behaviours[name]
+        failed = behaviour.fails(time.monotonic() - self.started)
+        if failed:
+            self.counts[name]['errors'] += 1
+        return behaviour, failed
+
+    # ---- HTTP ----
+    async def serve_http(self, name, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode('latin-1').split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0") or 0)
+                body = await reader.readexactly(length) if length else b""
+                await getattr(self, f"_handle_{name}")(writer, method, target, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, payload, content_type="application/json"):
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+        )
+
+    async def _handle_groq(self, writer, method, target, body):
+        behaviour, failed = self._begin('groq')
+        delay = behaviour.delay()
+        if failed:
+            await asyncio.sleep(delay * behaviour.ttft)
+            self._respond(writer, 500, {"error": {"message": "stubbed failure"}})
+            return
+        request = json.loads(body)
+        text = _reply_text(self.rng)
+        if not request.get("stream"):
+            await asyncio.sleep(delay)
+            self._respond(writer, 200, {"choices": [{"message": {"role": "assistant", "content": text}}]})
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(delay * behaviour.ttft)
+        words = text.split(" ")
+        pieces = [" ".join(words[i:i + 6]) + " " for i in range(0, len(words), 6)]
+        for piece in pieces:
+            event = f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n".encode()
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(delay * (1 - behaviour.ttft) / len(pieces))
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        await writer.drain()
+
+    async def _handle_weather(self, writer, method, target, body):
+        behaviour, failed = self._begin('weather')
+        await asyncio.sleep(behaviour.delay())
+        if failed:
+            self._respond(writer, 500, {"message": "stubbed failure"})
+            return
+        city = parse_qs(urlparse(target).query).get("q", ["Mumbai"])[0]
+        self._respond(writer, 200, {
+            "name": city.title(),
+            "main": {"temp": 29.5, "feels_like": 33.1, "humidity": 71},
+            "weather": [{"main": "Clouds", "description": "scattered clouds"}],
+            "wind": {"speed": 4.2}
+        })
+
+    async def _handle_news(self, writer, method, target, body):
+        behaviour, failed = self._begin('news')
+        await asyncio.sleep(behaviour.delay())
+        if failed:
+            self._respond(writer, 500, {"status": "error"})
+            return
+        category = parse_qs(urlparse(target).query).get("category", ["general"])[0]
+        self._respond(writer, 200, {"status": "ok", "articles": [
+            {"title": f"{category.title()} headline number {i} - Stub Times", "source": {"name": "Stub Times"}}
+            for i in range(1, 6)
+        ]})
+
+    # ---- gRPC (Gemini) ----
+    def _gemini_reply(self, text):
+        import google.ai.generativelanguage as glm
+        return glm.GenerateContentResponse(candidates=[glm.Candidate(
+            content=glm.Content(parts=[glm.Part(text=text)], role="model"), finish_reason=1, index=0
+        )])
+
+    async def _gemini_generate(self, request, context):
+        import grpc
+        behaviour, failed = self._begin('gemini')
+        await asyncio.sleep(behaviour.delay())
+        if failed:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "stubbed failure")
+        return self._gemini_reply(_reply_text(self.rng))
+
+    async def _gemini_stream(self, request, context):
+        import grpc
+        behaviour, failed = self._begin('gemini')
+        delay = behaviour.delay()
+        await asyncio.sleep(delay * behaviour.ttft)
+        if failed:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "stubbed failure")
+        words = _reply_text(self.rng).split(" ")
+        pieces = [" ".join(words[i:i + 10]) + " " for i in range(0, len(words), 10)]
+        for piece in pieces:
+            yield self._gemini_reply(piece)
+            await asyncio.sleep(delay * (1 - behaviour.ttft) / len(pieces))
+
+    async def _gemini_count_tokens(self, request, context):
+        import google.ai.generativelanguage as glm
+        return glm.CountTokensResponse(total_tokens=1)
+
+    async def start_grpc(self):
+        import grpc
+        import google.ai.generativelanguage as glm
+        server = grpc.aio.server()
+        handlers = {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                self._gemini_generate, request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize),
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                self._gemini_stream, request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize),
+            "CountTokens": grpc.unary_unary_rpc_method_handler(
+                self._gemini_count_tokens, request_deserializer=glm.CountTokensRequest.deserialize,
+                response_serializer=glm.CountTokensResponse.serialize),
+        }
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(GRPC_SERVICE, handlers),))
+        port = server.add_insecure_port(f"{STUB_HOSTS['gemini']}:0")
+        await server.start()
+        return server, port
+
+    # ---- control ----
+    async def serve_control(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            if head.startswith(b"POST /reset"):
+                self.started = time.monotonic()
+                for counts in self.counts.values():
+                    counts.update(calls=0, errors=0)
+            self._respond(writer, 200, self.counts)
+            await writer.drain()
+        finally:
+            writer.close()
+
+def _stub_main(settings, ready):
+    async def serve():
+        stubs = UpstreamStubs(settings)
+        ports = {}
+        for name in ('groq', 'weather', 'news'):
+            server = await asyncio.start_server(
+                lambda r, w, name=name: stubs.serve_http(name, r, w), STUB_HOSTS[name], 0
+            )
+            ports[name] = server.sockets[0].getsockname()[1]
+        control = await asyncio.start_server(stubs.serve_control, "127.0.0.1", 0)
+        ports['control'] = control.sockets[0].getsockname()[1]
+        _grpc_server, ports['gemini'] = await stubs.start_grpc()
+        ready.put(ports)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def start_stubs(overrides):
+    settings = {name: dict(values) for name, values in DEFAULT_STUBS.items()}
+    for name, values in overrides:
+        settings[name].update(values)
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(target=_stub_main, args=(settings, ready), name="loadtest-stubs", daemon=True)
+    process.start()
+    return process, ready.get(timeout=60), settings
+
+async def stub_control(ports, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", ports['control'])
+    writer.write(f"{'POST' if path == '/reset' else 'GET'} {path} HTTP/1.1\r\nHost: stub\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+def configure_environment(ports, telegram_url, telegram_rate):
+    """Points the bot at the stubs. Must run before `import bot`."""
+    defaults = {
+        "TELEGRAM_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": telegram_url,
+        "GROQ_API_KEY": "loadtest",
+        "GEMINI_API_KEY": "loadtest",
+        "WEATHER_API_KEY": "loadtest",
+        "NEWS_API_KEY": "loadtest",
+        "GEMINI_DISCOVERY": "off",
+        "METRICS_PORT": "0",
+        "SESSION_BACKEND": "memory",
+        "TELEGRAM_GLOBAL_RATE_PER_SEC": str(telegram_rate),
+    }
+    if ports:
+        defaults.update({
+            "GROQ_API_URL": f"http://{STUB_HOSTS['groq']}:{ports['groq']}/openai/v1/chat/completions",
+            "OPENWEATHER_API_URL": f"http://{STUB_HOSTS['weather']}:{ports['weather']}/data/2.5/weather",
+            "NEWS_API_URL": f"http://{STUB_HOSTS['news']}:{ports['news']}/v2/top-headlines",
+        })
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+def use_gemini_stub(bot, port):
+    """The Gemini SDK can't be pointed at a plaintext endpoint, so swap in an insecure gRPC client."""
+    import grpc
+    import google.ai.generativelanguage as glm
+    from google.generativeai import client
+    from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+        GenerativeServiceGrpcAsyncIOTransport
+    )
+    bot.get_genai()
+    channel = grpc.aio.insecure_channel(f"{STUB_HOSTS['gemini']}:{port}")
+    client._client_manager.clients["generative_async"] = glm.GenerativeServiceAsyncClient(
+        transport=GenerativeServiceGrpcAsyncIOTransport(channel=channel)
+    )
+
+# ========== FAKE TELEGRAM ==========
+class FakeTelegram:
+    """Bot API stand-in that answers the calls the bot makes and reports what it sends.
+
+    Markdown the real API would reject comes back as a 400, so the bot's
+    plain-text fallback is exercised and counted.
+    """
+
+    METHODS = ("getMe", "sendMessage", "editMessageText", "sendChatAction", "setWebhook", "deleteWebhook",
+               "getWebhookInfo", "getUpdates", "setMyCommands", "close", "logOut")
+
+    def __init__(self, bot, latency=0.03, on_message=None):
+        self.bot = bot
+        self.latency = latency
+        self.on_message = on_message
+        self.server = bot.HttpServer("127.0.0.1", 0)
+        for method in self.METHODS:
+            self.server.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+        self.calls = {}
+        self.markdown_rejections = 0
+        self.updates = []
+        self._message_id = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.port}"
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop(timeout=1)
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            params = self._params(request)
+            if method == "getUpdates":
+                return await self._get_updates(params)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if params.get("parse_mode") == "Markdown" and not self.bot.markdown_balanced(str(params.get("text", ""))):
+                self.markdown_rejections += 1
+                return self._result({"ok": False, "error_code": 400,
+                                     "description": "Bad Request: can't parse entities: unclosed entity"}, 400)
+            if method in ("sendMessage", "editMessageText"):
+                chat_id = params.get("chat_id")
+                if method == "sendMessage":
+                    self._message_id += 1
+                    message_id = self._message_id
+                else:
+                    message_id = params.get("message_id")
+                if self.on_message:
+                    self.on_message(chat_id, str(params.get("text", "")))
+                return self._result({"ok": True, "result": {
+                    "message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": str(params.get("text", ""))
+                }})
+            if method == "getMe":
+                return self._result({"ok": True, "result": {
+                    "id": 123456, "is_bot": True, "first_name": "MeraAI", "username": "meraai_loadtest_bot"
+                }})
+            return self._result({"ok": True, "result": True})
+        return handle
+
+    def _params(self, request):
+        content_type = request.headers.get("content-type", "")
+        if "json" in content_type:
+            return json.loads(request.body or b"{}")
+        params = {}
+        for key, values in parse_qs(request.body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def _result(self, payload, status=200):
+        return status, "application/json", json.dumps(payload).encode()
+
+    async def _get_updates(self, params):
+        offset = params.get("offset") or 0
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), 1.0)
+        while True:
+            pending = [update for update in self.updates if update["update_id"] >= offset]
+            if pending or time.monotonic() >= deadline:
+                return self._result({"ok": True, "result": pending})
+            await asyncio.sleep(0.01)
+
+# ========== SYNTHETIC USERS ==========
+COMMAND_WEIGHTS = {
+    'chat': 50, 'ai': 12, 'gemini': 8, 'weather': 10, 'news': 8,
+    'start': 3, 'help': 3, 'stats': 3, 'clear': 3,
+}
+
+# A reply containing one of these finishes the command; ❌/🚦 replies finish it as an error/shed
+FINAL_MARKERS = {
+    'chat': ("Powered by",),
+    'ai': ("Groq AI:",),
+    'gemini': ("Google Gemini:",),
+    'weather': ("Weather in",),
+    'news': ("News:", "No recent news", "No articles"),
+    'start': ("Hello",),
+    'help': ("Help Guide",),
+    'stats': ("Conversation Stats",),
+    'clear': ("Memory cleared", "No active conversation"),
+}
+
+CHAT_LINES = ("kya haal hai", "mujhe python sikhna hai", "ek joke sunao", "aaj ka plan kya hona chahiye",
+              "explain recursion simply", "best way to learn AI?", "movie suggest karo", "thoda motivation do",
+              "how does the internet work", "chai ya coffee?")
+QUESTIONS = tuple(f"question {i} about {topic}" for i, topic in
+                  enumerate(("space", "cricket", "cooking", "history", "coding")) for _ in range(4))
+CITIES = ("Mumbai", "Delhi", "Pune", "Bengaluru", "Chennai", "Kolkata", "Jaipur", "Lucknow")
+NEWS_TOPICS = ("technology", "sports", "business", "entertainment", "science", "health", "general")
+
+def command_text(command, rng):
+    if command == 'chat':
+        return f"{rng.choice(CHAT_LINES)} {rng.randrange(1000)}"
+    if command in ('ai', 'gemini'):
+        return f"/{command} {rng.choice(QUESTIONS)}"
+    if command == 'weather':
+        return f"/weather {rng.choice(CITIES)}"
+    if command == 'news':
+        return f"/news {rng.choice(NEWS_TOPICS)}"
+    return f"/{command}"
+
+def make_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text, "from": user,
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(" ", 1)[0])}]
+    return {"update_id": update_id, "message": message}
+
+class Pending:
+    __slots__ = ('command', 'sent_at', 'first_at', 'future')
+
+    def __init__(self, command):
+        self.command = command
+        self.sent_at = time.monotonic()
+        self.first_at = None
+        self.future = asyncio.get_running_loop().create_future()
+
+class ReplyTracker:
+    """Matches what the bot sends back to the one update each synthetic user has in flight."""
+
+    def __init__(self):
+        self.pending = {}
+        self.stray = 0
+        self.errors = {}
+
+    def expect(self, chat_id, command):
+        pending = self.pending[chat_id] = Pending(command)
+        return pending
+
+    def on_message(self, chat_id, text):
+        pending = self.pending.get(chat_id)
+        if pending is None or pending.future.done():
+            self.stray += 1
+            return
+        now = time.monotonic()
+        if pending.first_at is None:
+            pending.first_at = now
+        if text.startswith("🚦"):
+            pending.future.set_result(('shed', now))
+        elif text.startswith("❌"):
+            reason = text.split("\n", 1)[0][:80]
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+            pending.future.set_result(('error', now))
+        elif any(marker in text for marker in FINAL_MARKERS[pending.command]):
+            pending.future.set_result(('ok', now))
+
+def percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 1)
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+# ========== TRAFFIC BENCHMARK ==========
+async def run_traffic(args):
+    stub_process, ports, stub_settings = start_stubs(args.stub)
+    tracker = ReplyTracker()
+    configure_environment(ports, "http://127.0.0.1:0", args.telegram_rate)
+
+    # The fake Bot API lives in this process; its port is only known once it listens
+    import bot
+    telegram = FakeTelegram(bot, latency=args.telegram_latency, on_message=tracker.on_message)
+    await telegram.start()
+    bot.TELEGRAM_API_URL = telegram.url
+    use_gemini_stub(bot, ports['gemini'])
+
+    application = bot.build_application()
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+
+    webhook = None
+    if args.transport == "webhook":
+        import httpx
+        webhook = bot.HttpServer("127.0.0.1", 0)
+        webhook.route("POST", "/telegram", bot.webhook_handler(application))
+        await webhook.start()
+        poster = httpx.AsyncClient(base_url=f"http://127.0.0.1:{webhook.port}",
+                                   limits=httpx.Limits(max_connections=args.users))
+        async def inject(update):
+            await poster.post("/telegram", content=json.dumps(update))
+    else:
+        from telegram import Update
+        async def inject(update):
+            await application.update_queue.put(Update.de_json(update, application.bot))
+
+    await stub_control(ports, "/reset")
+    results = {command: {'ok': [], 'first': [], 'error': 0, 'shed': 0, 'timeout': 0} for command in COMMAND_WEIGHTS}
+    commands, weights = zip(*COMMAND_WEIGHTS.items())
+    update_ids = iter(range(1, 10 ** 9))
+    started = time.monotonic()
+    until = started + args.duration
+    cpu_started = time.process_time()
+
+    async def user(index):
+        rng = random.Random(args.seed * 100003 + index)
+        user_id = 100000 + index
+        # Spread the first messages over one think time
+        await asyncio.sleep(rng.uniform(0, args.think))
+        while time.monotonic() < until:
+            command = rng.choices(commands, weights)[0]
+            pending = tracker.expect(user_id, command)
+            await inject(make_update(next(update_ids), user_id, command_text(command, rng)))
+            record = results[command]
+            try:
+                status, finished = await asyncio.wait_for(asyncio.shield(pending.future), args.timeout)
+            except asyncio.TimeoutError:
+                record['timeout'] += 1
+            else:
+                if status == 'ok':
+                    record['ok'].append(finished - pending.sent_at)
+                    record['first'].append(pending.first_at - pending.sent_at)
+                else:
+                    record[status] += 1
+            await asyncio.sleep(min(rng.expovariate(1 / args.think), max(until - time.monotonic(), 0)))
+
+    await asyncio.gather(*(user(index) for index in range(args.users)))
+    elapsed = time.monotonic() - started
+    cpu_seconds = time.process_time() - cpu_started
+    upstream = await stub_control(ports, "/stats")
+
+    sessions = len(bot.user_sessions)
+    open_circuits = [breaker.name for _, breaker in bot.breakers.items() if breaker.state != "closed"]
+    outbox = bot.outbox.stats()
+
+    if webhook is not None:
+        await webhook.stop(timeout=1)
+        await poster.aclose()
+    await application.stop()
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    await telegram.stop()
+    stub_process.terminate()
+
+    completed = sum(len(record['ok']) + record['error'] + record['shed'] for record in results.values())
+    report = {
+        'settings': {
+            'users': args.users, 'duration': args.duration, 'think': args.think, 'transport': args.transport,
+            'telegram_rate': args.telegram_rate, 'telegram_latency': args.telegram_latency,
+            'stubs': {name: {k: v for k, v in values.items()} for name, values in stub_settings.items()},
+        },
+        'throughput': round(completed / elapsed, 2),
+        'completed': completed,
+        'cpu_ms_per_update': round(cpu_seconds * 1000 / max(completed, 1), 3),
+        'commands': {
+            command: {
+                'ok': len(record['ok']), 'error': record['error'], 'shed': record['shed'], 'timeout': record['timeout'],
+                'final_ms': percentiles(record['ok']), 'first_ms': percentiles(record['first']),
+            }
+            for command, record in results.items()
+        },
+        'upstream_calls': upstream,
+        'telegram_calls': telegram.calls,
+        'markdown_rejections': telegram.markdown_rejections,
+        'outbox': outbox,
+        'sessions': sessions,
+        'open_circuits': open_circuits,
+        'stray_replies': tracker.stray,
+        'error_replies': tracker.errors,
+    }
+    return report
+
+def print_traffic(report):
+    settings = report['settings']
+    print(f"\n🚦 Traffic: {settings['users']} users for {settings['duration']}s "
+          f"(think {settings['think']}s, {settings['transport']} transport)")
+    print(f"   {report['completed']} updates, {report['throughput']} updates/s, "
+          f"{report['cpu_ms_per_update']} ms CPU per update, {report['sessions']} sessions")
+    print(f"   {'command':<9}{'ok':>6}{'err':>5}{'shed':>6}{'t/o':>5}   "
+          f"{'final p50/p95/p99 (ms)':>26}   {'first p50/p95/p99 (ms)':>26}")
+    for command, row in report['commands'].items():
+        final = "/".join(str(row['final_ms'][q]) for q in ('p50', 'p95', 'p99'))
+        first = "/".join(str(row['first_ms'][q]) for q in ('p50', 'p95', 'p99'))
+        print(f"   {command:<9}{row['ok']:>6}{row['error']:>5}{row['shed']:>6}{row['timeout']:>5}   {final:>26}   {first:>26}")
+    upstream = ", ".join(f"{name} {counts['calls']} ({counts['errors']} failed)" for name, counts in report['upstream_calls'].items())
+    print(f"   upstream calls: {upstream}")
+    print(f"   telegram calls: {report['telegram_calls']}, markdown rejections: {report['markdown_rejections']}")
+    for reason, count in report['error_replies'].items():
+        print(f"   {count} x {reason}")
+    if report['open_circuits']:
+        print(f"   open circuits at the end: {', '.join(report['open_circuits'])}")
+
+# ========== SHARDED BENCHMARK ==========
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def run_sharded_once(args, shards, ports, env):
+    """Runs `bot.py` in webhook mode with `shards` workers and drives it through its webhook."""
+    import bot
+    import httpx
+    tracker = ReplyTracker()
+    telegram = FakeTelegram(bot, latency=args.telegram_latency, on_message=tracker.on_message)
+    await telegram.start()
+    webhook_port = _free_port()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py"),
+        env={**env, "TELEGRAM_API_URL": telegram.url, "SHARD_WORKERS": str(shards),
+             "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}", "WEBHOOK_HOST": "127.0.0.1",
+             "WEBHOOK_PORT": str(webhook_port)},
+        stdout=None if args.verbose else subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL
+    )
+    # Ready once the webhook is registered and every worker has called getMe (the front calls it too)
+    workers_ready = lambda: telegram.calls.get("getMe", 0) >= shards + (shards > 1)
+    deadline = time.monotonic() + 60
+    while not (telegram.calls.get("setWebhook") and workers_ready()):
+        if time.monotonic() > deadline or process.returncode is not None:
+            raise RuntimeError(f"bot with {shards} shards did not start")
+        await asyncio.sleep(0.05)
+
+    poster = httpx.AsyncClient(base_url=f"http://127.0.0.1:{webhook_port}", limits=httpx.Limits(max_connections=args.users))
+    await stub_control(ports, "/reset")
+    commands, weights = zip(*((command, weight) for command, weight in COMMAND_WEIGHTS.items() if command != 'gemini'))
+    update_ids = iter(range(1, 10 ** 9))
+    final, outcomes = [], {'ok': 0, 'error': 0, 'shed': 0, 'timeout': 0}
+    started = time.monotonic()
+    until = started + args.duration
+
+    async def user(index):
+        rng = random.Random(args.seed * 100003 + index)
+        user_id = 100000 + index
+        await asyncio.sleep(rng.uniform(0, args.think))
+        while time.monotonic() < until:
+            command = rng.choices(commands, weights)[0]
+            pending = tracker.expect(user_id, command)
+            await poster.post("/telegram", content=json.dumps(make_update(next(update_ids), user_id, command_text(command, rng))))
+            try:
+                status, finished = await asyncio.wait_for(asyncio.shield(pending.future), args.timeout)
+            except asyncio.TimeoutError:
+                outcomes['timeout'] += 1
+            else:
+                outcomes[status] += 1
+                if status == 'ok':
+                    final.append(finished - pending.sent_at)
+            await asyncio.sleep(min(rng.expovariate(1 / args.think), max(until - time.monotonic(), 0)))
+
+    try:
+        await asyncio.gather(*(user(index) for index in range(args.users)))
+        elapsed = time.monotonic() - started
+    finally:
+        await poster.aclose()
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 60)
+        except asyncio.TimeoutError:
+            process.kill()
+        await telegram.stop()
+
+    completed = outcomes['ok'] + outcomes['error'] + outcomes['shed']
+    return {
+        'throughput': round(completed / elapsed, 2),
+        'completed': completed,
+        **outcomes,
+        'final_ms': percentiles(final),
+        'upstream_calls': await stub_control(ports, "/stats"),
+        'error_replies': tracker.errors,
+    }
+
+async def run_sharded(args):
+    stub_process, ports, stub_settings = start_stubs(args.stub)
+    configure_environment(ports, "http://127.0.0.1:0", args.telegram_rate)
+    # Workers are separate processes the Gemini gRPC stub can't be injected into, so Groq answers everything
+    env = {**os.environ, "GEMINI_API_KEY": ""}
+    # Measure capacity, not the quotas; every worker would apply these limits on its own anyway
+    for key in ("GROQ_RATE_PER_MIN", "USER_RATE_PER_MIN"):
+        env.setdefault(key, "0")
+    shard_counts = [int(count) for count in args.shards.split(",")]
+    try:
+        runs = {str(shards): await run_sharded_once(args, shards, ports, env) for shards in shard_counts}
+    finally:
+        stub_process.terminate()
+    return {
+        'settings': {'shards': shard_counts, 'users': args.users, 'duration': args.duration, 'think': args.think,
+                     'cpus': os.cpu_count()},
+        'runs': runs,
+    }
+
+def print_sharded(report):
+    settings = report['settings']
+    print(f"\n🧩 Sharded webhook: {settings['users']} users for {settings['duration']}s per run "
+          f"(think {settings['think']}s, {settings['cpus']} CPUs)")
+    print(f"   {'shards':>7}{'updates/s':>11}{'ok':>7}{'err':>5}{'shed':>6}{'t/o':>5}   {'final p50/p95/p99 (ms)':>26}")
+    for shards, row in report['runs'].items():
+        final = "/".join(str(row['final_ms'][q]) for q in ('p50', 'p95', 'p99'))
+        label = shards if shards != "1" else "1*"
+        print(f"   {label:>7}{row['throughput']:>11}{row['ok']:>7}{row['error']:>5}{row['shed']:>6}{row['timeout']:>5}   {final:>26}")
+    if "1" in report['runs']:
+        print("   * one process serving the webhook itself, no front")
+
+# ========== GROQ BATCHING BENCHMARK ==========
+async def run_batching(args):
+    stub_process, ports, stub_settings = start_stubs(args.stub)
+    configure_environment(ports, "http://127.0.0.1:9", args.telegram_rate)
+    import bot
+
+    windows = [float(window) for window in args.windows.split(",")]
+    runs = {}
+    try:
+        for window in windows:
+            # Same as starting the bot with GROQ_BATCH_WINDOW_MS=window
+            bot.groq_batcher = bot.GroqBatcher(window / 1000, bot.GROQ_BATCH_MAX) if window > 0 else None
+            bot.breakers = bot.CircuitBreakers(**bot.breakers.settings)
+            await stub_control(ports, "/reset")
+            rng = random.Random(args.seed)
+            latencies, failures = [], 0
+
+            async def call(index):
+                nonlocal failures
+                # Distinct bodies, as the answer cache already absorbs repeated questions
+                messages = [bot.AI_COMMAND_SYSTEM, {"role": "user", "content": f"{rng.choice(QUESTIONS)} #{index}"}]
+                sent = time.monotonic()
+                try:
+                    reply = await bot.get_groq_response(messages, temperature=0.7)
+                except Exception:
+                    reply = None
+                if reply:
+                    latencies.append(time.monotonic() - sent)
+                else:
+                    failures += 1
+
+            # Open-loop Poisson arrivals: requests keep coming however slow the replies get
+            calls = []
+            started = time.monotonic()
+            cpu_started = time.process_time()
+            arrival = started
+            while arrival < started + args.duration:
+                calls.append(asyncio.ensure_future(call(len(calls))))
+                arrival += rng.expovariate(args.rate)
+                await asyncio.sleep(max(arrival - time.monotonic(), 0))
+            await asyncio.gather(*calls)
+            elapsed = time.monotonic() - started
+            cpu_seconds = time.process_time() - cpu_started
+
+            runs[_format_window(window)] = {
+                'throughput': round(len(latencies) / elapsed, 2),
+                'requests': len(calls),
+                'failed': failures,
+                'latency_ms': percentiles(latencies),
+                'cpu_ms_per_call': round(cpu_seconds * 1000 / max(len(calls), 1), 3),
+                'upstream_calls': (await stub_control(ports, "/stats"))['groq']['calls'],
+                'batches': bot.groq_batcher.stats()['batches'] if bot.groq_batcher is not None else None,
+            }
+        await bot.close_http_client()
+    finally:
+        stub_process.terminate()
+
+    return {
+        'settings': {'rate': args.rate, 'duration': args.duration, 'windows_ms': windows,
+                     'batch_max': bot.GROQ_BATCH_MAX, 'stubs': {'groq': stub_settings['groq']}},
+        'runs': runs,
+    }
+
+def _format_window(window):
+    return str(int(window)) if window == int(window) else str(window)
+
+def print_batching(report):
+    settings = report['settings']
+    print(f"\n📦 Groq batching: Poisson {settings['rate']} req/s for {settings['duration']}s, batches of up to {settings['batch_max']}")
+    print(f"   {'window ms':>10}{'req/s':>9}{'failed':>8}{'batches':>9}{'CPU ms':>8}   {'p50/p95/p99 (ms)':>22}")
+    for window, row in report['runs'].items():
+        latency = "/".join(str(row['latency_ms'][q]) for q in ('p50', 'p95', 'p99'))
+        batches = row['batches'] if row['batches'] is not None else "-"
+        print(f"   {window:>10}{row['throughput']:>9}{row['failed']:>8}{batches:>9}{row['cpu_ms_per_call']:>8}   {latency:>22}")
+
+# ========== SESSION BENCHMARK ==========
+async def run_sessions(args):
+    configure_environment(None, "http://127.0.0.1:9", 1000)
+    import bot
+    import tracemalloc
+
+    rng = random.Random(args.seed)
+    user_lines = [f"{rng.choice(CHAT_LINES)} {i}" for i in range(50)]
+    ai_lines = [_reply_text(rng, 70) for _ in range(50)]
+
+    def fill(user_ids):
+        for user_id in user_ids:
+            for turn in range(args.turns):
+                # Distinct strings per session, as real traffic would have
+                bot.add_to_memory(user_id, "user", f"{user_lines[(user_id + turn) % 50]} #{user_id}")
+                bot.add_to_memory(user_id, "assistant", f"{ai_lines[(user_id * 7 + turn) % 50]} #{user_id}")
+
+    def per_session_us(fn, user_ids):
+        started = time.perf_counter()
+        for user_id in user_ids:
+            fn(user_id)
+        return round((time.perf_counter() - started) / len(user_ids) * 1e6, 2)
+
+    # Memory, with every session active and then with every one idle
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user_id in range(args.sessions):
+        await bot.get_user_session(user_id, f"User{user_id}")
+    fill(range(args.sessions))
+    active = tracemalloc.get_traced_memory()[0]
+    bot.user_sessions.pack_idle(-1)
+    idle = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Timings run untraced on a sample; the sample is packed at this point
+    sample = list(range(min(args.sessions, 1000)))
+    build_groq = lambda user_id: bot.build_groq_messages(user_id, f"User{user_id}", pending="next question")
+    build_gemini = lambda user_id: bot.build_gemini_contents(user_id, f"User{user_id}", pending="next question")
+    unpack_us = per_session_us(build_groq, sample)
+    for user_id in sample:
+        bot.clear_user_session(user_id)
+        await bot.get_user_session(user_id, f"User{user_id}")
+    started = time.perf_counter()
+    fill(sample)
+    message_us = (time.perf_counter() - started) / (len(sample) * args.turns * 2) * 1e6
+    groq_us = per_session_us(build_groq, sample)
+    gemini_us = per_session_us(build_gemini, sample)
+    pack_us = per_session_us(lambda user_id: bot.user_sessions.get(user_id).history.pack(), sample)
+
+    return {
+        'settings': {'sessions': args.sessions, 'turns': args.turns},
+        'bytes_per_session': round((active - before) / args.sessions),
+        'idle_bytes_per_session': round((idle - before) / args.sessions),
+        'us_per_message': round(message_us, 2),
+        'groq_context_us': groq_us,
+        'gemini_context_us': gemini_us,
+        'pack_us': pack_us,
+        'unpack_us': unpack_us,
+    }
+
+def print_sessions(report):
+    settings = report['settings']
+    print(f"\n🧠 Sessions: {settings['sessions']} sessions x {settings['turns']} exchanges")
+    print(f"   {report['bytes_per_session']} bytes per session, {report['idle_bytes_per_session']} once compressed as idle")
+    print(f"   {report['us_per_message']} us per stored message, "
+          f"compress {report['pack_us']} us and first use after {report['unpack_us']} us per session")
+    print(f"   context build: Groq {report['groq_context_us']} us, Gemini {report['gemini_context_us']} us")
+
+# ========== SESSION LOOKUP BENCHMARK ==========
+def _full_scan_session(user_sessions, user_id, user_name):
+    """The original get_user_session: expires old sessions by scanning all of them on every call."""
+    current_time = datetime.now()
+    for uid in list(user_sessions.keys()):
+        if current_time - user_sessions[uid]['last_activity'] > timedelta(hours=2):
+            del user_sessions[uid]
+    if user_id not in user_sessions:
+        user_sessions[user_id] = {
+            'history': [], 'last_activity': current_time, 'user_name': user_name,
+            'message_count': 0, 'preferred_ai': 'groq'
+        }
+    user_sessions[user_id]['last_activity'] = current_time
+    user_sessions[user_id]['message_count'] += 1
+    return user_sessions[user_id]
+
+async def run_lookup(args):
+    configure_environment(None, "http://127.0.0.1:9", 1000)
+    import bot
+
+    rng = random.Random(args.seed)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    rows = {}
+    for size in sizes:
+        user_ids = [rng.randrange(size) for _ in range(args.lookups)]
+        # The old scan costs O(sessions) per call, so it gets far fewer calls than the store
+        scan_ids = user_ids[:max(3, min(args.lookups, 2_000_000 // size))]
+
+        now = datetime.now()
+        old = {uid: {'history': [], 'last_activity': now, 'user_name': f"User{uid}", 'message_count': 0,
+                     'preferred_ai': 'groq'} for uid in range(size)}
+        started = time.perf_counter()
+        for user_id in scan_ids:
+            _full_scan_session(old, user_id, f"User{user_id}")
+        scan_us = (time.perf_counter() - started) / len(scan_ids) * 1e6
+        del old
+
+        store = bot.SessionStore(bot.SESSION_TTL, max(size, bot.SESSION_MAX))
+        for uid in range(size):
+            store.touch(uid, f"User{uid}", 'groq')
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.touch(user_id, f"User{user_id}", 'groq')[0].message_count += 1
+        store_us = (time.perf_counter() - started) / len(user_ids) * 1e6
+        del store
+
+        rows[str(size)] = {
+            'full_scan_us': round(scan_us, 2),
+            'store_us': round(store_us, 3),
+            'speedup': round(scan_us / store_us),
+        }
+
+    return {'settings': {'sizes': sizes, 'lookups': args.lookups}, 'sizes': rows}
+
+def print_lookup(report):
+    print(f"\n🔎 Session lookup ({report['settings']['lookups']} lookups per size, fewer for the full scan)")
+    print(f"   {'sessions':>10}{'full scan (us)':>18}{'SessionStore (us)':>20}{'speedup':>10}")
+    for size, row in report['sizes'].items():
+        print(f"   {size:>10}{row['full_scan_us']:>18}{row['store_us']:>20}{row['speedup']:>9}x")
+
+# ========== CONTEXT BENCHMARK ==========
+async def run_context(args):
+    configure_environment(None, "http://127.0.0.1:9", 1000)
+    import bot
+
+    rng = random.Random(args.seed)
+    system_prompt = "You are User1's friendly assistant. Respond in Hinglish. Be conversational and use emojis."
+    persona = "You are User1's friendly AI assistant. Respond in Hinglish naturally, like a real friend."
+    lengths = [int(turns) for turns in args.history.split(",")]
+    rows = {}
+    for turns in lengths:
+        # Mostly short replies with the occasional long one, which a message-count cap let through whole
+        script = []
+        for turn in range(turns):
+            script.append(("user", f"{rng.choice(CHAT_LINES)} {turn}"))
+            script.append(("assistant", _reply_text(rng, 400 if turn % 10 == 9 else 60)))
+        def filled():
+            context = bot.ConversationContext()
+            for role, content in script:
+                context.append(role, content)
+            return context
+
+        context = filled()
+        messages = context.groq_messages(system_prompt, "next question")
+        contents = context.gemini_contents(persona, "next question")
+        groq_chars = sum(len(message['content']) for message in messages)
+        gemini_chars = sum(len(part) for content in contents for part in content['parts'])
+
+        # Per incoming message: store it, then build the prompt from the changed history.
+        # Each sample uses its own context, so every build sees a history of this length.
+        samples = [filled() for _ in range(min(args.iterations, 2000))]
+
+        def per_message_us(build):
+            started = time.perf_counter()
+            for sample in samples:
+                sample.append("user", "next question")
+                build(sample)
+            return round((time.perf_counter() - started) / len(samples) * 1e6, 2)
+
+        rows[str(turns)] = {
+            'history_chars': sum(len(content) for _, content in script),
+            'kept_turns': len(context.turns()),
+            'groq_chars': groq_chars,
+            'gemini_chars': gemini_chars,
+            'groq_tokens': sum(bot.estimate_tokens(message['content']) for message in messages),
+            'gemini_tokens': sum(bot.estimate_tokens(part) for content in contents for part in content['parts']),
+            'groq_build_us': per_message_us(lambda sample: sample.groq_messages(system_prompt)),
+            'gemini_build_us': per_message_us(lambda sample: sample.gemini_contents(persona)),
+        }
+
+    return {
+        'settings': {'history': lengths, 'samples': min(args.iterations, 2000),
+                     'token_budget': bot.CONTEXT_TOKEN_BUDGET, 'max_messages': bot.CONTEXT_MAX_MESSAGES},
+        'lengths': rows,
+    }
+
+def print_context(report):
+    settings = report['settings']
+    print(f"\n📚 Context: budget {settings['token_budget']} tokens, at most {settings['max_messages']} messages")
+    print(f"   {'exchanges':>10}{'history':>10}{'kept':>6}{'Groq chars/tokens':>20}{'Gemini chars/tokens':>22}"
+          f"{'Groq us':>9}{'Gemini us':>11}")
+    for turns, row in report['lengths'].items():
+        groq = f"{row['groq_chars']}/{row['groq_tokens']}"
+        gemini = f"{row['gemini_chars']}/{row['gemini_tokens']}"
+        print(f"   {turns:>10}{row['history_chars']:>10}{row['kept_turns']:>6}{groq:>20}{gemini:>22}"
+              f"{row['groq_build_us']:>9}{row['gemini_build_us']:>11}")
+
+# ========== RENDER BENCHMARK ==========
+async def run_render(args):
+    configure_environment(None, "http://127.0.0.1:9", 1000)
+    import bot
+    import tracemalloc
+
+    rng = random.Random(args.seed)
+    answer = _reply_text(rng, 120)
+    unbalanced = answer + " some_snake_case and a stray *"
+    long_answer = "\n".join(_reply_text(rng, 40) for _ in range(60))
+    context = bot.ConversationContext()
+    for turn in range(args.turns):
+        context.append("user", f"{rng.choice(CHAT_LINES)} {turn}")
+        context.append("assistant", _reply_text(rng, 70))
+    messages = context.groq_messages("You are User1's friendly assistant. Respond in Hinglish.", "next question")
+    weather = {'name': "Mumbai", 'weather': [{'main': "Clouds", 'description': "scattered clouds"}],
+               'main': {'temp': 31.2, 'feels_like': 35.0, 'humidity': 70}, 'wind': {'speed': 4.1}}
+    news = {'articles': [{'title': f"Headline {i} about *markets* - Source", 'source': {'name': "The_Daily"}}
+                         for i in range(10)]}
+
+    operations = {
+        'groq_request_body': lambda: bot.groq_request_body(messages),
+        'start_template': lambda: bot.START_TEMPLATE.format(user_name="User_1"),
+        'ai_reply': lambda: bot.AI_REPLY_HEAD + bot.prepare_markdown(answer) + bot.AI_REPLY_TAIL,
+        'prepare_markdown': lambda: bot.prepare_markdown(answer),
+        'prepare_markdown_escaped': lambda: bot.prepare_markdown(unbalanced),
+        'render_weather': lambda: bot.render_weather(weather),
+        'render_news': lambda: bot.render_news("business", news),
+        'split_message': lambda: bot.split_message(long_answer),
+    }
+
+    rows = {}
+    for name, fn in operations.items():
+        fn()
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        us = (time.perf_counter() - started) / args.iterations * 1e6
+        # Peak bytes allocated during one call, over and above what was already live
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        rows[name] = {'us': round(us, 2), 'peak_bytes': peak, 'output_chars': len(str(result))}
+
+    return {'settings': {'iterations': args.iterations, 'turns': args.turns}, 'operations': rows}
+
+def print_render(report):
+    print(f"\n🖨️ Render ({report['settings']['iterations']} calls each)")
+    print(f"   {'operation':<26}{'us/call':>10}{'peak bytes':>12}{'output':>9}")
+    for name, row in report['operations'].items():
+        print(f"   {name:<26}{row['us']:>10}{row['peak_bytes']:>12}{row['output_chars']:>9}")
+
+# ========== STARTUP BENCHMARK ==========
+async def run_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    configure_environment(None, "http://127.0.0.1:9", 1000)
+    env = dict(os.environ)
+
+    imports = []
+    for _ in range(args.repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", "import time; t = time.perf_counter(); import bot; print(time.perf_counter() - t)"],
+            cwd=here, env=env, capture_output=True, text=True, check=True
+        ).stdout.split()[-1]
+        imports.append(float(output))
+
+    # Time from process start until the reply to the first update reaches Telegram
+    import bot
+    first_replies = []
+    for attempt in range(args.repeat):
+        arrived = asyncio.get_running_loop().create_future()
+        telegram = FakeTelegram(bot, latency=0, on_message=lambda chat_id, text: arrived.done() or arrived.set_result(time.monotonic()))
+        telegram.updates.append(make_update(1, 4242, "/start"))
+        await telegram.start()
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "bot.py", cwd=here, env={**env, "TELEGRAM_API_URL": telegram.url},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            first_replies.append(await asyncio.wait_for(arrived, 60) - started)
+        finally:
+            process.terminate()
+            await process.wait()
+            await telegram.stop()
+
+    return {
+        'settings': {'repeat': args.repeat},
+        'import_seconds': round(sorted(imports)[len(imports) // 2], 3),
+        'first_update_seconds': round(sorted(first_replies)[len(first_replies) // 2], 3),
+    }
+
+def print_startup(report):
+    print(f"\n⏱️ Startup (median of {report['settings']['repeat']})")
+    print(f"   import bot: {report['import_seconds']}s, process start to first reply: {report['first_update_seconds']}s")
+
+# ========== BASELINE ==========
+# (path into the report, True if bigger is better)
+def _tracked_metrics(results):
+    tracked = []
+    if 'traffic' in results:
+        tracked.append((('traffic', 'throughput'), True))
+        tracked.append((('traffic', 'cpu_ms_per_update'), False))
+        for command in results['traffic']['commands']:
+            tracked.append((('traffic', 'commands', command, 'final_ms', 'p95'), False))
+    if 'sessions' in results:
+        for key in ('bytes_per_session', 'idle_bytes_per_session', 'us_per_message', 'groq_context_us',
+                    'gemini_context_us', 'pack_us', 'unpack_us'):
+            tracked.append((('sessions', key), False))
+    if 'lookup' in results:
+        for size in results['lookup']['sizes']:
+            tracked.append((('lookup', 'sizes', size, 'store_us'), False))
+    if 'context' in results:
+        for turns in results['context']['lengths']:
+            for key in ('groq_tokens', 'gemini_tokens', 'groq_build_us', 'gemini_build_us'):
+                tracked.append((('context', 'lengths', turns, key), False))
+    if 'render' in results:
+        for name in results['render']['operations']:
+            tracked.append((('render', 'operations', name, 'us'), False))
+            tracked.append((('render', 'operations', name, 'peak_bytes'), False))
+    if 'startup' in results:
+        tracked.append((('startup', 'import_seconds'), False))
+        tracked.append((('startup', 'first_update_seconds'), False))
+    return tracked
+
+def _lookup(report, path):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Prints each tracked metric next to the baseline; returns the regressions."""
+    regressions = []
+    print(f"\n📏 Against baseline from {baseline.get('created', '?')} (tolerance {tolerance:.0%})")
+    for path, higher_is_better in _tracked_metrics(results):
+        current, previous = _lookup(results, path), _lookup(baseline['results'], path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        flag = "❌" if worse > tolerance else ("✅" if worse < -tolerance else "  ")
+        print(f"   {flag} {'.'.join(path):<48} {previous:>10} -> {current:<10} ({change:+.0%})")
+        if worse > tolerance:
+            regressions.append('.'.join(path))
+    return regressions
+
+# ========== MAIN ==========
+def build_parser():
+    parser = argparse.ArgumentParser(description="Offline load test and benchmarks for MeraAI")
+    parser.add_argument("benchmark", choices=("traffic", "sharded", "batching", "sessions", "lookup", "context", "render", "startup", "all"))
+    parser.add_argument("--users", type=int, default=100, help="synthetic users (traffic)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic")
+    parser.add_argument("--think", type=float, default=4.0, help="mean seconds between a user's messages")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before an update counts as lost")
+    parser.add_argument("--transport", choices=("queue", "webhook"), default="queue",
+                        help="hand updates straight to the application or POST them to the webhook server")
+    parser.add_argument("--stub", type=parse_stub_spec, action="append", default=[],
+                        help="upstream behaviour, e.g. groq:latency=0.5,sigma=0.4,errors=0.05,outage=10-20")
+    parser.add_argument("--telegram-rate", type=float, default=1000,
+                        help="TELEGRAM_GLOBAL_RATE_PER_SEC for the run (Telegram's real limit is 30)")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="seconds per fake Bot API call")
+    parser.add_argument("--shards", default="1,2,4", help="comma-separated worker counts (sharded)")
+    parser.add_argument("--rate", type=float, default=50, help="mean Groq requests per second (batching)")
+    parser.add_argument("--windows", default="0,20", help="comma-separated GROQ_BATCH_WINDOW_MS values (batching)")
+    parser.add_argument("--sessions", type=int, default=100000, help="sessions to create (sessions)")
+    parser.add_argument("--turns", type=int, default=10, help="exchanges per session (sessions)")
+    parser.add_argument("--sizes", default="100000,300000,1000000", help="comma-separated session counts (lookup)")
+    parser.add_argument("--lookups", type=int, default=100000, help="session lookups per size (lookup)")
+    parser.add_argument("--history", default="8,40,200", help="comma-separated exchanges of history (context)")
+    parser.add_argument("--iterations", type=int, default=20000, help="calls per operation (render) or sampled contexts, up to 2000 (context)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per startup measurement")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's info logs")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--compare", action="store_true", help="fail if a tracked metric regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    return parser
+
+def _child_args(argv):
+    """The options of an `all` run minus the ones only the parent acts on."""
+    forwarded = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in ("--compare", "--save-baseline") or arg.startswith("--json="):
+            continue
+        elif arg == "--json":
+            skip_value = True
+        else:
+            forwarded.append(arg)
+    return forwarded
+
+def main():
+    args = build_parser().parse_args()
+    if not args.verbose:
+        # Per-request logs from the bot and httpx would drown the report
+        import logging
+        logging.basicConfig(level=logging.WARNING)
+        for name in ("bot", "httpx", "telegram"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    # Each benchmark imports the bot with its own settings, so `all` runs them in child processes
+    if args.benchmark == "all":
+        results = {}
+        for benchmark in ("sessions", "lookup", "context", "render", "startup", "traffic"):
+            child = [sys.executable, os.path.abspath(__file__), benchmark, "--json", "-"] + _child_args(sys.argv[2:])
+            output = subprocess.run(child, capture_output=True, text=True, check=True).stdout
+            results[benchmark] = json.loads(output.rsplit("\n@@RESULT@@\n", 1)[1])
+    else:
+        runner = {'traffic': run_traffic, 'sharded': run_sharded, 'batching': run_batching, 'sessions': run_sessions, 'lookup': run_lookup, 'context': run_context, 'render': run_render, 'startup': run_startup}[args.benchmark]
+        results = {args.benchmark: asyncio.run(runner(args))}
+        if args.json == "-":
+            print("\n@@RESULT@@\n" + json.dumps(results[args.benchmark]))
+            return
+
+    printers = {'traffic': print_traffic, 'sharded': print_sharded, 'batching': print_batching, 'sessions': print_sessions, 'lookup': print_lookup, 'context': print_context, 'render': print_render, 'startup': print_startup}
+    for name, report in results.items():
+        printers[name](report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {
+            'created': time.strftime("%Y-%m-%d"),
+            'machine': {'python': platform.python_version(), 'cpus': os.cpu_count(), 'platform': platform.platform()},
+            'results': results,
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"\n💾 Baseline saved to {args.baseline}")
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
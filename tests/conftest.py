@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import asyncio
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+os.environ.setdefault("METRICS_PORT", "0")
+
+@asynccontextmanager
+async def stub_server(respond):
+    """Local HTTP/1.1 server; `respond(method, path, body)` is awaited and returns (status, payload)."""
+    async def serve(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode('latin-1').split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                length = 0
+                for line in lines[1:]:
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":", 1)[1])
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await respond(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    try:
+        yield f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    finally:
+        server.close()
+
+class FakeRedis:
+    """What a redis_stub holds: keys per database, TTLs and every command received."""
+
+    def __init__(self, password=None):
+        self.password = password
+        self.databases = {}
+        self.ttls = {}
+        self.commands = []
+        self.delays = {}
+
+@asynccontextmanager
+async def redis_stub(password=None):
+    """Local server speaking enough RESP for RedisSessionBackend; yields (url, FakeRedis).
+
+    `delays` maps a command name to seconds the server waits before answering it.
+    """
+    state = FakeRedis(password)
+
+    async def read_command(reader):
+        count = int((await reader.readuntil(b"\r\n"))[1:-2])
+        args = []
+        for _ in range(count):
+            size = int((await reader.readuntil(b"\r\n"))[1:-2])
+            args.append((await reader.readexactly(size + 2))[:-2].decode())
+        return args
+
+    async def serve(reader, writer):
+        db, authed = 0, password is None
+        try:
+            while True:
+                command, *args = await read_command(reader)
+                command = command.upper()
+                state.commands.append((command, *args))
+                if command in state.delays:
+                    await asyncio.sleep(state.delays[command])
+                data = state.databases.setdefault(db, {})
+                if command == "AUTH":
+                    authed = args[-1] == password
+                    reply = b"+OK\r\n" if authed else b"-WRONGPASS invalid password\r\n"
+                elif not authed:
+                    reply = b"-NOAUTH Authentication required.\r\n"
+                elif command == "SELECT":
+                    db = int(args[0])
+                    reply = b"+OK\r\n"
+                elif command == "GET":
+                    value = data.get(args[0])
+                    reply = b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value.encode()), value.encode())
+                elif command == "SET":
+                    data[args[0]] = args[1]
+                    if len(args) >= 4 and args[2].upper() == "EX":
+                        state.ttls[args[0]] = int(args[3])
+                    reply = b"+OK\r\n"
+                elif command == "DEL":
+                    reply = b":%d\r\n" % sum(data.pop(key, None) is not None for key in args)
+                else:
+                    reply = b"-ERR unknown command\r\n"
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    try:
+        yield f"127.0.0.1:{server.sockets[0].getsockname()[1]}", state
+    finally:
+        server.close()
@@ -0,0 +1,159 @@
+import asyncio
+
+import pytest
+
+import bot
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_controller(clock, user_rate=0, user_burst=5, provider_rates=None, max_concurrent=2, max_queued=3):
+    return bot.AdmissionController(user_rate, user_burst, provider_rates or {}, max_concurrent, max_queued, clock=clock)
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = bot.TokenBucket(60, 2, now=0.0)
+    assert bucket.try_take(0.0) and bucket.try_take(0.0)
+    assert not bucket.try_take(0.5)
+    assert bucket.wait_time() == pytest.approx(0.5)
+    assert bucket.try_take(1.0)
+    # Never more than `capacity` saved up
+    bucket.refill(100.0)
+    assert bucket.tokens == 2
+
+def test_user_is_shed_and_refilled():
+    clock = FakeClock()
+    admission = make_controller(clock, user_rate=6, user_burst=2, max_concurrent=10)
+
+    async def run():
+        for _ in range(2):
+            await admission.acquire(1)
+            admission.release()
+        with pytest.raises(bot.AdmissionRejected) as rejected:
+            await admission.acquire(1)
+        assert rejected.value.reason == 'user'
+        # Other users have their own bucket
+        await admission.acquire(2)
+        admission.release()
+        clock.now += 10
+        await admission.acquire(1)
+        admission.release()
+
+    asyncio.run(run())
+    assert admission.shed == 1 and admission.active == 0
+
+def test_queues_are_served_round_robin():
+    admission = make_controller(FakeClock(), max_concurrent=1, max_queued=10)
+    served = []
+
+    async def request(user_id, label):
+        await admission.acquire(user_id)
+        served.append(label)
+
+    async def run():
+        await admission.acquire(0)
+        # User 1 queues three requests before user 2 and 3 queue one each
+        tasks = [asyncio.ensure_future(request(1, f"a{i}")) for i in range(3)]
+        tasks += [asyncio.ensure_future(request(2, "b0")), asyncio.ensure_future(request(3, "c0"))]
+        await asyncio.sleep(0)
+        assert admission.queued == 5
+        for _ in range(5):
+            admission.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert served == ["a0", "b0", "c0", "a1", "a2"]
+    assert admission.active == 1 and admission.queued == 0
+
+def test_sheds_once_the_queue_is_full():
+    admission = make_controller(FakeClock(), max_concurrent=1, max_queued=2)
+
+    async def run():
+        await admission.acquire(0)
+        waiting = [asyncio.ensure_future(admission.acquire(user_id)) for user_id in (1, 2)]
+        await asyncio.sleep(0)
+        with pytest.raises(bot.AdmissionRejected) as rejected:
+            await admission.acquire(3)
+        assert rejected.value.reason == 'overloaded'
+        for _ in waiting:
+            admission.release()
+        await asyncio.gather(*waiting)
+
+    asyncio.run(run())
+    assert admission.shed == 1
+
+def test_cancelled_waiter_is_skipped_and_slot_passed_on():
+    admission = make_controller(FakeClock(), max_concurrent=1, max_queued=5)
+
+    async def run():
+        await admission.acquire(0)
+        gone = asyncio.ensure_future(admission.acquire(1))
+        next_up = asyncio.ensure_future(admission.acquire(2))
+        await asyncio.sleep(0)
+        gone.cancel()
+        await asyncio.gather(gone, return_exceptions=True)
+        assert admission.queued == 1
+        # The slot goes straight to the remaining waiter instead of being freed
+        admission.release()
+        await next_up
+        assert admission.active == 1
+        admission.release()
+        assert admission.active == 0
+
+        # Cancelled just after being handed the slot: it is passed on, not lost
+        await admission.acquire(0)
+        late = asyncio.ensure_future(admission.acquire(1))
+        after = asyncio.ensure_future(admission.acquire(2))
+        await asyncio.sleep(0)
+        admission.release()
+        late.cancel()
+        await asyncio.gather(late, return_exceptions=True)
+        await after
+        assert admission.active == 1 and admission.queued == 0
+
+    asyncio.run(run())
+
+def test_provider_bucket_refills():
+    clock = FakeClock()
+    admission = make_controller(clock, provider_rates={'groq': 30, 'gemini': 0})
+    # Burst is a sixth of the per-minute rate
+    assert [admission.provider_allowed('groq') for _ in range(6)] == [True] * 5 + [False]
+    assert admission.provider_wait('groq') == pytest.approx(2.0)
+    assert admission.provider_allowed('gemini') and admission.provider_wait('gemini') == 0
+    clock.now += 2
+    assert admission.provider_allowed('groq')
+    assert not admission.provider_allowed('groq')
+
+def test_summaries_wait_for_provider_budget(monkeypatch):
+    clock = FakeClock()
+    admission = make_controller(clock, provider_rates={'groq': 6})
+    calls = []
+
+    async def fake_groq(messages, temperature=0.8, max_tokens=500):
+        calls.append(messages)
+        return "User likes chai"
+
+    store = bot.SessionStore(3600, 10)
+    session, _ = store.touch(5, "Asha", 'groq')
+    monkeypatch.setattr(bot, "admission", admission)
+    monkeypatch.setattr(bot, "user_sessions", store)
+    monkeypatch.setattr(bot, "GEMINI_API_KEY", None)
+    monkeypatch.setattr(bot, "GROQ_API_KEY", "key")
+    monkeypatch.setattr(bot, "get_groq_response", fake_groq)
+    summarizer = bot.HistorySummarizer(True, 300)
+    turns = [("user", "mujhe chai pasand hai")]
+
+    async def run():
+        # Replies have used up the Groq budget
+        assert admission.provider_allowed('groq')
+        assert await summarizer._summarize(5, turns) is False
+        assert not calls
+        clock.now += admission.provider_wait('groq')
+        assert await summarizer._summarize(5, turns) is True
+
+    asyncio.run(run())
+    assert len(calls) == 1 and session.history.summary == "User likes chai"
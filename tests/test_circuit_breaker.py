@@ -0,0 +1,96 @@
+import asyncio
+
+import bot
+from conftest import stub_server
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_breaker(clock):
+    return bot.CircuitBreaker("test/model", window=10, window_seconds=60, min_calls=4, error_rate=0.5,
+                              slow_call=5.0, cooldown=30.0, max_cooldown=100.0, clock=clock)
+
+def test_opens_fails_fast_and_recovers():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    for ok in (True, False, True):
+        assert breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == breaker.CLOSED
+    # The fourth call reaches min_calls with half of them failed
+    breaker.record(False)
+    assert breaker.state == breaker.OPEN
+
+    clock.now += 29
+    assert not breaker.allow() and not breaker.available()
+    assert breaker.rejected == 1
+
+    # After the cooldown a single trial goes through
+    clock.now += 1
+    assert breaker.available() and breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # A failed trial reopens it with the cooldown doubled
+    breaker.record(False)
+    assert breaker.state == breaker.OPEN and breaker.cooldown == 60
+    clock.now += 59
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.cooldown == 100
+    clock.now += 100
+
+    # A successful trial closes it and resets the cooldown
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == breaker.CLOSED and breaker.cooldown == 30
+    assert breaker.opened == 3
+
+def test_slow_calls_count_as_failures():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    for seconds in (1, 6, 1, 6):
+        breaker.record(True, seconds)
+    assert breaker.state == breaker.OPEN
+
+def test_old_outcomes_leave_the_window():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    for _ in range(3):
+        breaker.record(False)
+    clock.now += 61
+    breaker.record(False)
+    assert breaker.state == breaker.CLOSED
+
+def test_groq_http_500_opens_the_circuit(monkeypatch):
+    calls = []
+
+    async def failing(method, path, body):
+        calls.append(path)
+        return 500, {"error": {"message": "internal"}}
+
+    async def run():
+        async with stub_server(failing) as url:
+            monkeypatch.setattr(bot, "GROQ_URL", f"{url}/openai/v1/chat/completions")
+            monkeypatch.setattr(bot, "groq_batcher", None)
+            monkeypatch.setattr(bot, "breakers", bot.CircuitBreakers(min_calls=2, cooldown=30.0))
+            messages = [{"role": "user", "content": "hi"}]
+            try:
+                replies = [await bot.get_groq_response(messages) for _ in range(3)]
+            finally:
+                await bot.close_http_client()
+        return replies
+
+    errors_before = bot.metrics.counter_value("provider_errors_total", provider="groq", model=bot.GROQ_MODEL)
+    replies = asyncio.run(run())
+    assert replies == [None, None, None]
+    # Two failures open the circuit, so the third call never reaches Groq
+    assert len(calls) == 2
+    assert bot.breakers.get("groq", bot.GROQ_MODEL).state == bot.CircuitBreaker.OPEN
+    assert bot.metrics.counter_value("provider_errors_total", provider="groq", model=bot.GROQ_MODEL) == errors_before + 2
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+class FakeOutbox:
+    def __init__(self):
+        self.replies = []
+
+    async def reply(self, message, text, parse_mode=None, **kwargs):
+        self.replies.append(text)
+
+def unsubscribe(monkeypatch, digests, *args):
+    outbox = FakeOutbox()
+    monkeypatch.setattr(bot, "outbox", outbox)
+    monkeypatch.setattr(bot, "digests", digests)
+    update = SimpleNamespace(message=SimpleNamespace(chat_id=7))
+    asyncio.run(bot.unsubscribe_command(update, SimpleNamespace(args=list(args))))
+    return outbox.replies[-1]
+
+def test_topic_parsing():
+    assert bot._digest_topic(["news"]) == ('news', 'general')
+    assert bot._digest_topic(["News", "Sports"]) == ('news', 'sports')
+    assert bot._digest_topic(["weather", "New", "Delhi"]) == ('weather', bot._normalize_city("New Delhi"))
+    for args in ([], ["news", "sprots"], ["weather"], ["foo"]):
+        assert bot._digest_topic(args) is None
+
+def test_unsubscribe_only_removes_what_was_asked(monkeypatch):
+    digests = bot.DigestSubscriptions(max_per_chat=5)
+    for topic in [('news', 'general'), ('news', 'sports'), ('weather', 'mumbai')]:
+        assert digests.add(7, topic)
+    assert digests.add(8, ('news', 'sports'))
+
+    for args in (["news", "sprots"], ["weather"], ["foo"]):
+        assert "Usage" in unsubscribe(monkeypatch, digests, *args)
+    assert len(digests.topics(7)) == 3
+
+    assert "Removed 1" in unsubscribe(monkeypatch, digests, "news", "sports")
+    assert digests.topics(7) == [('news', 'general'), ('weather', 'mumbai')]
+    assert digests.topics(8) == [('news', 'sports')]
+
+    assert "Removed 2" in unsubscribe(monkeypatch, digests)
+    assert digests.topics(7) == [] and len(digests) == 1
+    assert "No matching" in unsubscribe(monkeypatch, digests)
+
+def test_subscription_limit_per_chat():
+    digests = bot.DigestSubscriptions(max_per_chat=2)
+    assert digests.add(7, ('news', 'general')) and digests.add(7, ('news', 'sports'))
+    assert not digests.add(7, ('news', 'business'))
+    # Subscribing again to a followed topic is not a new subscription
+    assert digests.add(7, ('news', 'sports'))
+    assert digests.remove(7, ('news', 'business')) == 0
+    assert len(digests) == 2
@@ -0,0 +1,77 @@
+import asyncio
+
+from google.api_core import exceptions as api_errors
+
+import bot
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    @property
+    def text(self):
+        if self._text is None:
+            # What the SDK does for a safety-blocked candidate
+            raise ValueError("The `response.text` quick accessor only works when the response contains a valid `Part`")
+        return self._text
+
+class FakeModel:
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.calls = 0
+
+    async def generate_content_async(self, contents, stream=False):
+        self.calls += 1
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return FakeResponse(self.outcome)
+
+def make_pool(monkeypatch, outcomes):
+    pool = bot.GeminiModelPool(list(outcomes), demote_ttl=300)
+    pool._models = {name: FakeModel(outcome) for name, outcome in outcomes.items()}
+    monkeypatch.setattr(bot, "gemini_models", pool)
+    monkeypatch.setattr(bot, "breakers", bot.CircuitBreakers(min_calls=5))
+    return pool
+
+def generate():
+    return asyncio.run(bot._generate_gemini([{"role": "user", "parts": ["hi"]}]))
+
+def test_missing_or_forbidden_model_falls_through(monkeypatch):
+    for error in (api_errors.NotFound("models/old is not found"), api_errors.PermissionDenied("no access"),
+                  api_errors.InvalidArgument("models/old is not supported for generateContent")):
+        pool = make_pool(monkeypatch, {"old": error, "new": "namaste"})
+        assert generate() == "namaste"
+        assert "old" in pool._demoted
+        assert pool.ordered() == ["new", "old"]
+        assert pool._models["old"].calls == 1
+
+def test_prompt_problems_do_not_demote(monkeypatch):
+    for outcome in (None, api_errors.InvalidArgument("Request contains an invalid argument: text is too long")):
+        pool = make_pool(monkeypatch, {"first": outcome, "second": "namaste"})
+        assert generate() is None
+        assert not pool._demoted
+        assert pool._models["second"].calls == 0
+        assert bot.breakers.get("gemini", "first").state == bot.CircuitBreaker.CLOSED
+
+def test_server_errors_demote(monkeypatch):
+    pool = make_pool(monkeypatch, {"first": api_errors.ServiceUnavailable("down"), "second": "namaste"})
+    assert generate() == "namaste"
+    assert pool.active == "second" and "first" in pool._demoted
+
+def test_probe_survives_discovery_dropping_the_model(monkeypatch):
+    class FakeClient:
+        async def count_tokens(self, request):
+            # Discovery finishes while the probe is in flight and no longer offers "old"
+            pool.set_available(["models/new"])
+            return {}
+
+    from google.generativeai import client
+    monkeypatch.setattr(client, "get_default_generative_async_client", lambda: FakeClient())
+    pool = bot.GeminiModelPool(["old", "new"], demote_ttl=300)
+    pool._models = {"old": type("M", (), {"model_name": "models/old"})()}
+    pool._demoted["old"] = 0
+    pool._probing.add("old")
+
+    asyncio.run(pool._probe("old"))
+    assert pool.candidates == ["new"] and pool.active == "new"
+    assert not pool._probing
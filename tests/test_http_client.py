@@ -0,0 +1,39 @@
+import time
+import asyncio
+
+import bot
+from conftest import stub_server
+
+DELAY = 0.3
+
+async def slow_ok(method, path, body):
+    await asyncio.sleep(DELAY)
+    return 200, {"ok": True}
+
+def test_concurrent_posts_overlap():
+    async def run():
+        async with stub_server(slow_ok) as url:
+            try:
+                started = time.monotonic()
+                responses = await asyncio.gather(*(bot.http_post(f"{url}/call", json={"n": i}) for i in range(10)))
+                elapsed = time.monotonic() - started
+            finally:
+                await bot.close_http_client()
+        return responses, elapsed
+
+    responses, elapsed = asyncio.run(run())
+    assert [r.status_code for r in responses] == [200] * 10
+    # Ten calls sharing the pool take about as long as one, not ten times as long
+    assert elapsed < DELAY * 2.5
+
+def test_client_is_shared_and_reopened():
+    async def run():
+        first = bot.get_http_client()
+        assert bot.get_http_client() is first
+        await bot.close_http_client()
+        second = bot.get_http_client()
+        await bot.close_http_client()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first is not second and first.is_closed and second.is_closed
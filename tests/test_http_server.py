@@ -0,0 +1,34 @@
+import asyncio
+
+import bot
+
+async def ok(request):
+    return 200, "text/plain", request.body
+
+async def raw_request(port, data):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+def test_bad_content_length_is_rejected():
+    async def run():
+        server = bot.HttpServer("127.0.0.1", 0)
+        server.route("POST", "/hook", ok)
+        await server.start()
+        try:
+            responses = [
+                await raw_request(server.port, f"POST /hook HTTP/1.1\r\nContent-Length: {value}\r\n\r\n".encode())
+                for value in ("abc", "-5")
+            ]
+            echoed = await raw_request(server.port, b"POST /hook HTTP/1.1\r\nContent-Length: 2\r\nConnection: close\r\n\r\nhi")
+        finally:
+            await server.stop(timeout=1)
+        return responses, echoed
+
+    responses, echoed = asyncio.run(run())
+    for response in responses:
+        assert response.startswith(b"HTTP/1.1 400 ")
+    assert echoed.startswith(b"HTTP/1.1 200 ") and echoed.endswith(b"\r\n\r\nhi")
@@ -0,0 +1,43 @@
+import asyncio
+
+import bot
+
+def provider(delay, text=None, error=None):
+    async def stream():
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        if text:
+            yield text
+    return stream
+
+def route(router, providers):
+    async def run():
+        name, stream = await router.first_response(providers)
+        return name, [chunk async for chunk in stream] if stream is not None else None
+    return asyncio.run(run())
+
+def make_router(policy='sequential'):
+    return bot.ProviderRouter(policy, default_delay=1.0, min_delay=0.05, max_delay=5.0)
+
+def test_instant_rejections_leave_latency_alone():
+    router = make_router()
+    for _ in range(3):
+        assert route(router, [("gemini", provider(0.05, "slow answer"))]) == ("gemini", ["slow answer"])
+    for error in (bot.ProviderRateLimited("gemini rate limit reached"), bot.CircuitOpenError("open"),
+                  bot.GeminiBusyError("full")):
+        for _ in range(3):
+            assert route(router, [("gemini", provider(0, error=error)), ("groq", provider(0, "ok"))]) == ("groq", ["ok"])
+    assert router.rejected["gemini"] == 9
+    assert router.latency["gemini"].total == 3
+    assert router.hedge_delay("gemini") == router.default_delay
+    assert router.latency["gemini"].quantile(0.5) >= 0.05
+
+def test_failures_and_losers_are_timed():
+    router = make_router('race')
+    route(router, [("gemini", provider(0.2, "late")), ("groq", provider(0.01, "fast"))])
+    route(router, [("gemini", provider(0.02, error=RuntimeError("boom"))), ("groq", provider(0.05, "ok"))])
+    gemini = router.latency["gemini"]
+    assert gemini.total == 2 and router.errors["gemini"] == 1
+    # The cancelled loser is recorded at the time it was cut off
+    assert min(gemini.recent) >= 0.01
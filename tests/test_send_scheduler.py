@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+class VirtualTime:
+    """A clock plus a sleep() that only advances it once every task is waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._sleepers = []
+        self._order = itertools.count()
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        wake = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + seconds, next(self._order), wake))
+        await wake
+
+    async def run(self, *coroutines):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        while not all(task.done() for task in tasks):
+            for _ in range(50):
+                await asyncio.sleep(0)
+            if self._sleepers:
+                self.now, _, wake = heapq.heappop(self._sleepers)
+                wake.set_result(None)
+        return [task.result() for task in tasks]
+
+def make_outbox(time_source, chat_rate=60, chat_burst=3, global_rate=30 * 60, global_burst=30):
+    return bot.SendScheduler(chat_rate, chat_burst, global_rate, global_burst,
+                             clock=time_source, sleep=time_source.sleep)
+
+def test_one_message_per_second_per_chat_after_the_burst():
+    time_source = VirtualTime()
+    outbox = make_outbox(time_source)
+    sent_at = []
+
+    async def send():
+        sent_at.append(time_source.now)
+        return True
+
+    async def burst():
+        for _ in range(8):
+            await outbox._call(42, send)
+
+    asyncio.run(time_source.run(burst()))
+    assert sent_at[:3] == [0.0, 0.0, 0.0]
+    assert [round(b - a, 3) for a, b in zip(sent_at[2:], sent_at[3:])] == [1.0] * 5
+    assert outbox.sent == 8
+
+def test_global_cap_of_thirty_per_second():
+    time_source = VirtualTime()
+    outbox = make_outbox(time_source, chat_burst=1)
+    sent_at = []
+
+    async def deliver(chat_id):
+        async def send():
+            sent_at.append(time_source.now)
+        await outbox._call(chat_id, send)
+
+    asyncio.run(time_source.run(*(deliver(chat_id) for chat_id in range(120))))
+    assert len(sent_at) == 120
+    # The global burst goes out at once, then the rest at 30/s, whatever the chat budgets allow
+    assert sent_at[:30] == [0.0] * 30
+    paced = sent_at[30:]
+    for end in paced:
+        assert sum(1 for t in paced if end - 1 < t <= end) <= 31
+    assert max(sent_at) == pytest.approx(3.0)
+
+def test_retry_after_blocks_the_chat_and_retries():
+    time_source = VirtualTime()
+    outbox = make_outbox(time_source)
+    attempts, other = [], []
+
+    async def flooded():
+        attempts.append(time_source.now)
+        if len(attempts) == 1:
+            raise RetryAfter(5)
+        return "ok"
+
+    async def other_chat():
+        await time_source.sleep(1)
+        async def send():
+            other.append(time_source.now)
+        await outbox._call(7, send)
+
+    results = asyncio.run(time_source.run(outbox._call(42, flooded), other_chat()))
+    assert results[0] == "ok"
+    assert attempts == [0.0, 5.0]
+    # Only the flooded chat waits
+    assert other == [1.0]
+    assert outbox.flood_waits == 1 and outbox.sent == 2
+
+def test_retry_after_gives_up_after_max_retries():
+    time_source = VirtualTime()
+    outbox = make_outbox(time_source)
+    outbox.max_retries = 1
+
+    async def always_flooded():
+        raise RetryAfter(2)
+
+    async def run():
+        try:
+            await outbox._call(42, always_flooded)
+        except RetryAfter:
+            return "raised"
+
+    assert asyncio.run(time_source.run(run())) == ["raised"]
+    assert outbox.flood_waits == 2
+
+def test_calls_without_wait_are_dropped():
+    time_source = VirtualTime()
+    outbox = make_outbox(time_source, chat_burst=2)
+    calls = []
+
+    async def send():
+        calls.append(time_source.now)
+        return True
+
+    async def run():
+        results = [await outbox._call(42, send, wait=False) for _ in range(4)]
+        # A flood wait on a no-wait call drops it instead of retrying
+        async def flooded():
+            raise RetryAfter(3)
+        time_source.now += 10
+        results.append(await outbox._call(42, flooded, wait=False))
+        results.append(await outbox._call(42, send, wait=False))
+        return results
+
+    (results,) = asyncio.run(time_source.run(run()))
+    assert results == [True, True, None, None, None, None]
+    assert len(calls) == 2 and outbox.dropped == 4
@@ -0,0 +1,120 @@
+import json
+import time
+import asyncio
+
+import bot
+from conftest import redis_stub
+
+def test_history_survives_restart(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.db")
+
+    async def run():
+        backend = bot.SQLiteSessionBackend(path, ttl=3600, flush_interval=60)
+        monkeypatch.setattr(bot, "session_backend", backend)
+        monkeypatch.setattr(bot, "user_sessions", bot.SessionStore(3600, 100))
+        await bot.get_user_session(7, "Asha")
+        bot.add_to_memory(7, "user", "mera naam Asha hai")
+        bot.add_to_memory(7, "assistant", "Hi Asha!")
+        await backend.stop()
+
+        # A fresh process: nothing in memory, only what the backend saved
+        backend = bot.SQLiteSessionBackend(path, ttl=3600, flush_interval=60)
+        monkeypatch.setattr(bot, "session_backend", backend)
+        monkeypatch.setattr(bot, "user_sessions", bot.SessionStore(3600, 100))
+        try:
+            assert bot.get_conversation_history(7) == ""
+            session = await bot.restore_user_session(7)
+            assert session is not None and session.user_name == "Asha"
+            assert "mera naam Asha hai" in bot.get_conversation_history(7)
+            bot.add_to_memory(7, "user", "aur kya haal?")
+            assert [content for _, content in session.history.turns()][-1] == "aur kya haal?"
+            assert await bot.restore_user_session(8) is None
+        finally:
+            await backend.stop()
+
+    asyncio.run(run())
+
+def test_sqlite_prune_uses_index(tmp_path):
+    backend = bot.SQLiteSessionBackend(str(tmp_path / "sessions.db"), ttl=3600, flush_interval=60)
+    try:
+        plan = backend._db.execute("EXPLAIN QUERY PLAN DELETE FROM sessions WHERE updated < ?", (0,)).fetchall()
+        assert "sessions_updated" in " ".join(row[-1] for row in plan)
+    finally:
+        asyncio.run(backend.close())
+
+def test_pack_idle_checks_each_idle_session_once():
+    clock = [1000.0]
+    store = bot.SessionStore(ttl=3600, max_sessions=100, clock=lambda: clock[0])
+    for user_id in range(10):
+        session, _ = store.touch(user_id, f"User{user_id}", 'groq')
+        # Even users have enough history to be worth packing
+        text = "kuch lamba sa jawab " * (20 if user_id % 2 == 0 else 1)
+        session.history.append("user", text)
+    clock[0] += 700
+
+    assert store.pack_idle(600, limit=4) == 4
+    assert store.pack_idle(600, limit=4) == 4
+    assert store.pack_idle(600, limit=4) == 2
+    assert store.packed == 5
+    # Packed and too-short sessions are not looked at again
+    assert store.pack_idle(600) == 0
+
+    # A session used again gets checked once it is idle again
+    store.touch(3, "User3", 'groq')[0].history.append("assistant", "ab " * 200)
+    assert store.pack_idle(600) == 0
+    clock[0] += 700
+    assert store.pack_idle(600) == 1
+    assert store.get(3).history.packed and store.packed == 6
+
+def test_redis_backend_round_trip():
+    async def run():
+        async with redis_stub(password="secret") as (address, redis):
+            url = f"redis://:secret@{address}/2"
+            backend = bot.RedisSessionBackend(url, ttl=3600, flush_interval=60)
+            session = bot.Session("Asha", 'groq', time.time())
+            session.history.append("user", "namaste")
+            backend.mark_dirty(7, session)
+            await backend.flush()
+            key = "meraai:session:7"
+            assert key in redis.databases[2] and redis.ttls[key] == 3600
+            # The connection is set up once, before the first command
+            assert redis.commands[:2] == [("AUTH", "secret"), ("SELECT", "2")]
+
+            fresh = bot.RedisSessionBackend(url, ttl=3600, flush_interval=60)
+            loaded = await fresh.load(7)
+            assert loaded.user_name == "Asha" and loaded.history.turns() == [("user", "namaste")]
+            assert await fresh.load(8) is None
+
+            fresh.mark_deleted(7)
+            await fresh.flush()
+            assert key not in redis.databases[2]
+            assert await fresh.load(7) is None
+            await backend.close()
+            await fresh.close()
+
+            wrong = bot.RedisSessionBackend(f"redis://:nope@{address}/2", ttl=3600, flush_interval=60)
+            assert await wrong.load(7) is None
+            await wrong.close()
+
+    asyncio.run(run())
+
+def test_redis_cancelled_pipeline_does_not_leak_replies():
+    async def run():
+        async with redis_stub() as (address, redis):
+            backend = bot.RedisSessionBackend(f"redis://{address}/0", ttl=3600, flush_interval=60)
+            first = bot.Session("Asha", 'groq', time.time())
+            await backend._write_batch([("1", json.dumps(first.to_dict()))])
+
+            # Cancelled while the server is still working on the SET
+            redis.delays["SET"] = 0.2
+            writing = asyncio.ensure_future(backend._write_batch([("2", json.dumps(first.to_dict()))]))
+            await asyncio.sleep(0.05)
+            writing.cancel()
+            await asyncio.gather(writing, return_exceptions=True)
+
+            # The late "+OK" for that SET must not be taken as this GET's reply
+            loaded = await asyncio.wait_for(backend.load(1), 2)
+            assert loaded is not None and loaded.user_name == "Asha"
+            await backend.close()
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import asyncio
+
+import bot
+
+class FakeOutbox:
+    def __init__(self):
+        self.messages = []
+
+    async def reply(self, message, text, parse_mode=None, **kwargs):
+        self.messages.append([text, parse_mode])
+        return len(self.messages) - 1
+
+    async def edit(self, sent, text, parse_mode=None, wait=True):
+        self.messages[sent] = [text, parse_mode]
+        return True
+
+def stream(*deltas):
+    async def generate():
+        for delta in deltas:
+            yield delta
+    return generate()
+
+def finished(monkeypatch, deltas, footer):
+    outbox = FakeOutbox()
+    monkeypatch.setattr(bot, "outbox", outbox)
+
+    async def run():
+        reply = bot.StreamingReply(object(), edit_interval=0)
+        text = await reply.consume(stream(*deltas))
+        await reply.finish(footer)
+        return text
+
+    return asyncio.run(run()), outbox.messages
+
+def test_unbalanced_answer_is_escaped_before_the_footer(monkeypatch):
+    footer = bot.POWERED_BY['groq']
+    text, messages = finished(monkeypatch, ["*Step 1:* chai ", "banao, *yaad rakhna 🚀"], footer)
+    assert text == "*Step 1:* chai banao, *yaad rakhna 🚀"
+    assert messages == [[r"\*Step 1:\* chai banao, \*yaad rakhna 🚀" + footer, 'Markdown']]
+    assert bot.markdown_balanced(messages[0][0])
+
+def test_balanced_answer_keeps_its_formatting(monkeypatch):
+    footer = bot.POWERED_BY['gemini']
+    _, messages = finished(monkeypatch, ["*Step 1:* ", "chai banao"], footer)
+    assert messages == [["*Step 1:* chai banao" + footer, 'Markdown']]
+
+def test_long_answer_puts_the_footer_in_a_new_message(monkeypatch):
+    footer = bot.POWERED_BY['groq']
+    answer = "a" * (bot.TELEGRAM_MAX_MESSAGE - 5)
+    _, messages = finished(monkeypatch, [answer], footer)
+    assert messages == [[answer, 'Markdown'], [footer.lstrip(), 'Markdown']]